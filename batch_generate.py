@@ -0,0 +1,159 @@
+"""
+Mode batch tanpa UI: memproses banyak permintaan pengadaan sekaligus.
+
+Input berupa CSV lokal atau URL Google Sheet dengan kolom:
+    description  - deskripsi kebutuhan (wajib)
+    budget       - budget dalam rupiah (opsional; dideteksi dari deskripsi jika kosong)
+    attachments  - path lampiran .pdf/.txt, dipisah ";" (opsional)
+    id           - nama folder output (opsional; default nomor baris)
+
+Untuk setiap baris ditulis <output-dir>/<id>/result.json dan payload.json (serta dokumen hasil
+render lokal jika --render-local), ditambah <output-dir>/summary.json dan metrics.prom untuk seluruh batch.
+
+Contoh:
+    python batch_generate.py permintaan_q4.csv --output-dir hasil_q4 --concurrency 4
+"""
+import argparse
+import json
+import os
+import re
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import pandas as pd
+
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def sheet_url_to_csv(source):
+    """Mengubah URL Google Sheet menjadi URL ekspor CSV; path lokal dikembalikan apa adanya."""
+    match = re.search(r"docs\.google\.com/spreadsheets/d/([\w-]+)", source)
+    if not match:
+        return source
+    gid_match = re.search(r"[#&?]gid=(\d+)", source)
+    csv_url = f"https://docs.google.com/spreadsheets/d/{match.group(1)}/export?format=csv"
+    return csv_url + (f"&gid={gid_match.group(1)}" if gid_match else "")
+
+
+def load_rows(source):
+    """Membaca baris permintaan dari CSV/Google Sheet menjadi list of dict."""
+    df = pd.read_csv(sheet_url_to_csv(source), dtype=str).fillna("")
+    df.columns = [str(column).strip().lower() for column in df.columns]
+    if "description" not in df.columns:
+        raise ValueError("Kolom 'description' tidak ditemukan di input.")
+    rows = []
+    for index, record in enumerate(df.to_dict(orient="records"), start=1):
+        if not record["description"].strip():
+            continue
+        budget_text = record.get("budget", "").strip()
+        rows.append({
+            "id": re.sub(r"[^\w.-]+", "_", record.get("id", "").strip()) or f"row_{index:03d}",
+            "description": record["description"].strip(),
+            "budget": budget_text,
+            "attachments": [path.strip() for path in record.get("attachments", "").split(";") if path.strip()],
+        })
+    return rows
+
+
+def write_json(path, data):
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False, indent=2, default=str)
+
+
+def render_row_locally(app, result, row_dir):
+    """Merender dokumen dari template DOCX lokal ke row_dir. Mengembalikan daftar pesan error."""
+    recipes = app.recipe_registry.get_template_set(result["template_set"])["recipes"]
+    documents, errors = app.build_local_render_jobs(recipes, result["final_data"])
+    for doc_result in app.render_documents_locally(documents)["results"]:
+        if doc_result["status"] == "success":
+            with open(os.path.join(row_dir, doc_result["fileName"]), "wb") as f:
+                f.write(doc_result["content"])
+        else:
+            errors.append(f"Gagal merender {doc_result['fileName']}: {doc_result['message']}")
+    return errors
+
+
+def process_row(app, row, output_dir, use_cache, send, render_local=False):
+    """Memproses satu baris dan menulis hasilnya ke disk. Mengembalikan ringkasan baris."""
+    started = time.time()
+    try:
+        # Kolom budget boleh berformat bebas ("400jt", "1.500.000.000"); kosong/tak terbaca → dideteksi dari deskripsi
+        budget = app.parse_budget_locally(row["budget"])["amount"] if row["budget"] else None
+        result = app.process_request_headless(
+            row["description"], budget=budget, attachment_paths=row["attachments"], use_cache=use_cache
+        )
+    except Exception as e:
+        result = {"error": f"Kesalahan tak terduga: {e}", "payload": None, "messages": []}
+
+    if send and result.get("payload") and result["payload"]["documents"]:
+        try:
+            result["apps_script_response"] = app.send_batch_payload(result["payload"])
+        except Exception as e:
+            result["messages"].append(f"Gagal mengirim ke Apps Script: {e}")
+
+    row_dir = os.path.join(output_dir, row["id"])
+    os.makedirs(row_dir, exist_ok=True)
+    if render_local and result.get("payload"):
+        result["messages"].extend(render_row_locally(app, result, row_dir))
+    write_json(os.path.join(row_dir, "result.json"), {"input": row, **result})
+    if result.get("payload"):
+        write_json(os.path.join(row_dir, "payload.json"), result["payload"])
+    return {
+        "id": row["id"],
+        "status": "error" if result.get("error") else "ok",
+        "error": result.get("error"),
+        "template_set": result.get("template_set"),
+        "documents": len(result["payload"]["documents"]) if result.get("payload") else 0,
+        "messages": len(result.get("messages", [])),
+        "seconds": round(time.time() - started, 2),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Generate set dokumen untuk banyak permintaan tanpa UI.")
+    parser.add_argument("source", help="Path CSV atau URL Google Sheet")
+    parser.add_argument("--output-dir", default="batch_output", help="Folder hasil (default: batch_output)")
+    parser.add_argument("--concurrency", type=int, default=2, help="Jumlah permintaan yang diproses bersamaan")
+    parser.add_argument("--send", action="store_true", help="Kirim payload ke Apps Script setelah diproses")
+    parser.add_argument("--no-cache", action="store_true", help="Lewati cache respons AI")
+    parser.add_argument("--render-local", action="store_true",
+                        help="Render dokumen dari template DOCX lokal ke folder hasil (tanpa Apps Script)")
+    args = parser.parse_args(argv)
+
+    # Path input diselesaikan dulu, lalu pindah ke folder aplikasi agar path templates/ & .cache/ sama dengan UI
+    source = args.source if re.match(r"https?://", args.source) else os.path.abspath(args.source)
+    output_dir = os.path.abspath(args.output_dir)
+    rows = load_rows(source)
+    for row in rows:
+        row["attachments"] = [os.path.abspath(path) for path in row["attachments"]]
+    os.makedirs(output_dir, exist_ok=True)
+    os.chdir(APP_DIR)
+
+    import streamlit_app as app
+    if not app.model:
+        print(app.model_error or "Model AI tidak dikonfigurasi.", file=sys.stderr)
+        return 1
+
+    print(f"Memproses {len(rows)} permintaan (concurrency={args.concurrency})...")
+    summary = []
+    with ThreadPoolExecutor(max_workers=max(1, args.concurrency)) as executor:
+        futures = [executor.submit(process_row, app, row, output_dir, not args.no_cache, args.send, args.render_local) for row in rows]
+        for future in as_completed(futures):
+            row_summary = future.result()
+            summary.append(row_summary)
+            print(f"[{row_summary['status']}] {row_summary['id']} ({row_summary['seconds']} dtk)"
+                  + (f": {row_summary['error']}" if row_summary["error"] else ""))
+
+    summary.sort(key=lambda item: item["id"])
+    write_json(os.path.join(output_dir, "summary.json"), summary)
+    # Agregat latensi & token per tahap untuk seluruh batch (format Prometheus)
+    with open(os.path.join(output_dir, "metrics.prom"), "w", encoding="utf-8") as f:
+        f.write(app.metrics.render())
+    failed = sum(1 for item in summary if item["status"] == "error")
+    print(f"Selesai: {len(summary) - failed} berhasil, {failed} gagal. Ringkasan: {os.path.join(output_dir, 'summary.json')}")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
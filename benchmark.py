@@ -0,0 +1,367 @@
+"""
+Benchmark end-to-end streamlit_app.py untuk N sesi bersamaan, dengan model Gemini palsu dan
+server lokal pengganti Apps Script. Dua mode:
+
+    headless  - setiap sesi menjalankan process_request_headless() + send_batch_payload() di thread
+                sendiri dalam satu proses, berbagi limiter, cache, dan pool yang sama seperti satu
+                instance systemd. Dipakai untuk angka throughput/konkurensi.
+    apptest   - setiap sesi mengklik state machine UI yang asli (initial_input → processing → results)
+                lewat Streamlit AppTest. AppTest tidak thread-safe, sehingga eksekusi script diserialkan
+                dengan lock; job latar belakang (LLM, pengiriman dokumen) tetap berjalan paralel.
+
+Model palsu mengembalikan JSON kalengan dari "examples" resep di templates/ dengan latensi yang
+bisa diatur, sehingga yang diukur adalah pipeline aplikasi (bukan jaringan/kuota Gemini).
+Latensi per tahap diambil dari span JSON (lihat timed_span di streamlit_app.py).
+
+Hasil ditulis sebagai JSON (stdout atau --output) beserta commit git & konfigurasi,
+agar hasil antar-commit bisa dibandingkan.
+
+Contoh:
+    python benchmark.py --sessions 8 --rounds 2 --llm-latency-ms 800 --output bench.json
+    python benchmark.py --mode apptest --sessions 4
+"""
+import argparse
+import contextlib
+import glob
+import json
+import os
+import random
+import re
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+APP_PATH = os.path.join(APP_DIR, "streamlit_app.py")
+# Jeda antar-rerun saat menunggu job, sama dengan interval poller halaman
+POLL_INTERVAL_S = float(os.environ.get("JOB_POLL_INTERVAL_S", "0.5"))
+
+# Satu skenario per set template (budget & kata kunci menentukan routing di select_template_set).
+# LISENSI_MORE_300 belum diikutkan: resep "RAB Dir. Bidang/RAB Lisensi" belum ada di templates/,
+# sehingga setiap sesinya pasti gagal dan hanya mengotori angka pembanding.
+SCENARIOS = [
+    ("PENGADAAN_LESS_300", "pengadaan fasilitas perangkat laptop penunjang kinerja personil TI. "
+                           "Prognosa 2025 100jt. Terpakai 0. Usulan anggaran 17,5jt. Tanggal 10 Oktober 2025."),
+    ("PENGADAAN_MORE_300", "pengadaan server virtualisasi untuk aplikasi TOS. Usulan anggaran 1.500.000.000. "
+                           "Pos Anggaran VI. 3. Contract execution 3 bulan."),
+    ("LISENSI_LESS_300", "perpanjangan lisensi antivirus endpoint 200 user. Usulan anggaran 95jt. Tanggal 1 November 2025."),
+]
+
+
+def percentiles(values):
+    """p50/p95/p99/max (nearest-rank) dalam milidetik."""
+    if not values:
+        return {"count": 0}
+    ordered = sorted(values)
+    def rank(q):
+        return ordered[min(len(ordered) - 1, max(0, int(round(q * len(ordered) + 0.5)) - 1))]
+    return {"count": len(ordered), "p50_ms": round(rank(0.50), 1), "p95_ms": round(rank(0.95), 1),
+            "p99_ms": round(rank(0.99), 1), "max_ms": round(ordered[-1], 1)}
+
+
+def load_canned_values():
+    """Nilai contoh per placeholder (key huruf kecil) dari semua resep di templates/."""
+    canned = {}
+    for path in sorted(glob.glob(os.path.join(APP_DIR, "templates", "**", "*.json"), recursive=True)):
+        with open(path, encoding="utf-8") as f:
+            recipe = json.load(f)
+        for key, value in (recipe.get("examples") or {}).items():
+            canned.setdefault(key.lower(), value)
+    return canned
+
+
+class FakeUsage:
+    def __init__(self, prompt, text):
+        self.prompt_token_count = len(prompt) // 4 + 1
+        self.candidates_token_count = len(text) // 4 + 1
+        self.total_token_count = self.prompt_token_count + self.candidates_token_count
+
+
+class FakeResponse:
+    def __init__(self, text, usage=None):
+        self.text = text
+        self.parts = [type("Part", (), {"text": text})()]
+        self.candidates = []
+        self.usage_metadata = usage
+
+
+def make_fake_model_class(canned, latency_s, jitter_s, rng, chunk_chars=64):
+    """Kelas pengganti genai.GenerativeModel: latensi tetap + jitter, respons JSON kalengan."""
+    rng_lock = threading.Lock()
+
+    def canned_value(key, field_schema):
+        """Nilai kalengan yang sesuai tipe skema (seperti structured output Gemini)."""
+        value = canned.get(key.lower(), f"contoh {key}")
+        if field_schema["type"] == "number":
+            return value if isinstance(value, (int, float)) else 1_000_000
+        if field_schema["type"] == "array":
+            return value if isinstance(value, list) else []
+        return value if isinstance(value, str) else json.dumps(value, ensure_ascii=False)
+
+    def respond(prompt, generation_config):
+        schema = (generation_config or {}).get("response_schema")
+        if schema and "matches" in schema["properties"]:
+            return json.dumps({"matches": []})
+        if schema:
+            return json.dumps({key: canned_value(key, field_schema) for key, field_schema in schema["properties"].items()},
+                              ensure_ascii=False)
+        amounts = re.findall(r"\d[\d.]{5,}", prompt)
+        return amounts[-1].replace(".", "") if amounts else "null"
+
+    class FakeGenerativeModel:
+        def __init__(self, model_name, **kwargs):
+            self.model_name = f"models/{model_name}"
+
+        def generate_content(self, prompt, stream=False, generation_config=None, **kwargs):
+            prompt = str(prompt)
+            with rng_lock:
+                delay = latency_s + rng.uniform(0, jitter_s)
+            time.sleep(delay)
+            text = respond(prompt, generation_config)
+            usage = FakeUsage(prompt, text)
+            if not stream:
+                return FakeResponse(text, usage)
+            chunks = [text[i:i + chunk_chars] for i in range(0, len(text), chunk_chars)]
+            return iter([FakeResponse(chunk, usage if i == len(chunks) - 1 else None) for i, chunk in enumerate(chunks)])
+
+    return FakeGenerativeModel
+
+
+def start_fake_apps_script(latency_s, jitter_s, rng):
+    """Server HTTP lokal yang meniru Web App Apps Script (satu dokumen 'berhasil' per google_doc_id)."""
+    rng_lock = threading.Lock()
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            payload = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+            with rng_lock:
+                delay = latency_s + rng.uniform(0, jitter_s)
+            time.sleep(delay)
+            results = [{"status": "success", "fileName": f"Dokumen {doc['google_doc_id'][-6:]}",
+                        "docUrl": f"https://docs.google.com/document/d/{doc['google_doc_id']}"}
+                       for doc in payload.get("documents", [])]
+            body = json.dumps({"status": "completed", "results": results}).encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+# AppTest memakai state global Streamlit (runtime, parser script) yang tidak aman dipakai bersamaan
+_apptest_lock = threading.Lock()
+
+
+def run_app(at):
+    with _apptest_lock:
+        at.run()
+
+
+def run_until(at, condition, timeout_s):
+    """Menjalankan rerun AppTest sampai condition(at) terpenuhi (halaman mem-poll job di latar belakang)."""
+    deadline = time.time() + timeout_s
+    while not condition(at):
+        if time.time() > deadline:
+            raise TimeoutError("Batas waktu sesi tercapai")
+        if at.exception:
+            raise RuntimeError(at.exception[0].value)
+        time.sleep(POLL_INTERVAL_S) # Poller halaman (fragment run_every) tidak berjalan sendiri di AppTest
+        run_app(at)
+
+
+def is_job_status(info):
+    """Status job yang belum selesai dari poll_job (Streamlit memindahkan emoji pembuka ke ikon)."""
+    return info.icon == "⏳" or info.value.startswith("⏳")
+
+
+def find_button(at, label_part):
+    for button in at.button:
+        if label_part in button.label:
+            return button
+    return None
+
+
+def run_session_apptest(AppTest, scenario, timeout_s):
+    """Satu sesi UI: input → verifikasi → kirim dokumen. Mengembalikan ringkasan sesi."""
+    expected_set, prompt = scenario
+    started = time.perf_counter()
+    summary = {"scenario": expected_set, "status": "ok", "error": None, "documents": 0}
+    try:
+        with _apptest_lock:
+            at = AppTest.from_file(APP_PATH, default_timeout=timeout_s)
+        run_app(at)
+        at.text_area(key="prompt_input_key").input(prompt)
+        find_button(at, "Analisis").click()
+        run_app(at)
+        run_until(at, lambda at: find_button(at, "Verifikasi Selesai") is not None or at.error, timeout_s)
+        if at.error:
+            raise RuntimeError(at.error[0].value)
+        find_button(at, "Verifikasi Selesai").click()
+        run_app(at)
+        run_until(at, lambda at: at.session_state["page"] == "results", timeout_s)
+        find_button(at, "Kirim Data").click()
+        run_app(at)
+        run_until(at, lambda at: not any(is_job_status(info) for info in at.info), timeout_s)
+        summary["documents"] = sum(1 for success in at.success if "berhasil dibuat" in success.value)
+        failures = [error.value for error in at.error]
+        if failures:
+            raise RuntimeError(failures[0])
+    except Exception as e:
+        summary["status"] = "error"
+        summary["error"] = str(e)[:300]
+    summary["duration_ms"] = round((time.perf_counter() - started) * 1000, 1)
+    return summary
+
+
+def run_session_headless(app, scenario, timeout_s):
+    """Satu permintaan lewat jalur tanpa UI (ekstraksi, kalkulasi, payload, lalu kirim dokumen)."""
+    expected_set, prompt = scenario
+    started = time.perf_counter()
+    summary = {"scenario": expected_set, "status": "ok", "error": None, "documents": 0}
+    try:
+        result = app.process_request_headless(prompt, use_cache=False, priority=app.LLM_PRIORITY_INTERACTIVE)
+        if result["error"]:
+            raise RuntimeError(result["error"])
+        response = app.send_batch_payload(result["payload"])
+        summary["documents"] = sum(1 for doc in response["results"] if doc.get("status") == "success")
+        failures = [doc.get("message") for doc in response["results"] if doc.get("status") != "success"]
+        if failures:
+            raise RuntimeError(failures[0])
+    except Exception as e:
+        summary["status"] = "error"
+        summary["error"] = str(e)[:300]
+    summary["duration_ms"] = round((time.perf_counter() - started) * 1000, 1)
+    return summary
+
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=APP_DIR, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark end-to-end streamlit_app.py dengan LLM & Apps Script palsu.")
+    parser.add_argument("--mode", choices=["headless", "apptest"], default="headless")
+    parser.add_argument("--sessions", type=int, default=4, help="Jumlah sesi bersamaan")
+    parser.add_argument("--rounds", type=int, default=1, help="Berapa kali setiap sesi menjalankan alur penuh")
+    parser.add_argument("--llm-latency-ms", type=float, default=500)
+    parser.add_argument("--llm-jitter-ms", type=float, default=200)
+    parser.add_argument("--apps-script-latency-ms", type=float, default=800)
+    parser.add_argument("--apps-script-jitter-ms", type=float, default=400)
+    parser.add_argument("--scenarios", default=",".join(name for name, _ in SCENARIOS),
+                        help="Set template yang diuji, dipisah koma")
+    parser.add_argument("--session-timeout-s", type=float, default=120)
+    parser.add_argument("--seed", type=int, default=1234)
+    parser.add_argument("--output", help="Tulis hasil JSON ke file ini (default: stdout)")
+    args = parser.parse_args(argv)
+
+    rng = random.Random(args.seed)
+    apps_script = start_fake_apps_script(args.apps_script_latency_ms / 1000, args.apps_script_jitter_ms / 1000, rng)
+    span_log = tempfile.NamedTemporaryFile(prefix="bench_spans_", suffix=".jsonl", delete=False)
+    span_log.close()
+    cache_dir = tempfile.mkdtemp(prefix="bench_cache_")
+
+    # Konfigurasi dibaca streamlit_app.py saat dijalankan oleh AppTest. Semua store persisten diarahkan
+    # ke direktori sementara per run, agar riwayat proyek/cache dari run sebelumnya tidak memengaruhi hasil
+    os.environ.update({
+        "GEMINI_API_KEY": os.environ.get("GEMINI_API_KEY", "benchmark"),
+        "APPS_SCRIPT_URL": f"http://127.0.0.1:{apps_script.server_port}/exec",
+        "METRICS_PORT": "0",
+        "METRICS_LOG_PATH": span_log.name,
+        "LLM_CACHE_PATH": os.path.join(cache_dir, "llm_responses.sqlite3"),
+        "DOC_RESULT_CACHE_PATH": os.path.join(cache_dir, "document_results.sqlite3"),
+        "HISTORY_PATH": os.path.join(cache_dir, "project_history.sqlite3"),
+        "GSHEET_MIRROR_PATH": os.path.join(cache_dir, "gsheet_mirror.sqlite3"),
+        "UPLOAD_TEXT_STORE_DIR": os.path.join(cache_dir, "upload_texts"),
+        "LLM_CACHE_DISABLED": "1", # Setiap sesi benar-benar memanggil model palsu
+        "DOC_RESULT_CACHE_DISABLED": "1", # Setiap sesi benar-benar membuat dokumen
+    })
+    os.chdir(APP_DIR)
+
+    import google.generativeai as genai
+    genai.GenerativeModel = make_fake_model_class(
+        load_canned_values(), args.llm_latency_ms / 1000, args.llm_jitter_ms / 1000, rng
+    )
+    if args.mode == "apptest":
+        from streamlit.testing.v1 import AppTest
+        run_one = lambda scenario: run_session_apptest(AppTest, scenario, args.session_timeout_s)
+    else:
+        sys.path.insert(0, APP_DIR)
+        import streamlit_app as app
+        run_one = lambda scenario: run_session_headless(app, scenario, args.session_timeout_s)
+
+    selected = [scenario for scenario in SCENARIOS if scenario[0] in args.scenarios.split(",")]
+    plan = [selected[i % len(selected)] for i in range(args.sessions)]
+
+    def run_rounds(scenario):
+        return [run_one(scenario) for _ in range(args.rounds)]
+
+    started = time.perf_counter()
+    # Log print() aplikasi dialihkan ke stderr agar stdout hanya berisi laporan JSON
+    with contextlib.redirect_stdout(sys.stderr), ThreadPoolExecutor(max_workers=args.sessions) as executor:
+        sessions = [summary for summaries in executor.map(run_rounds, plan) for summary in summaries]
+    wall_time = time.perf_counter() - started
+    apps_script.shutdown()
+
+    stage_durations = {}
+    with open(span_log.name, encoding="utf-8") as f:
+        for line in f:
+            try:
+                span = json.loads(line)
+            except ValueError:
+                continue
+            stage_durations.setdefault(span["stage"], []).append(span["duration_ms"])
+    os.unlink(span_log.name)
+    shutil.rmtree(cache_dir, ignore_errors=True)
+
+    completed = [session for session in sessions if session["status"] == "ok"]
+    per_scenario = {}
+    for session in sessions:
+        per_scenario.setdefault(session["scenario"], []).append(session)
+    report = {
+        "git_revision": git_revision(),
+        "config": {key: value for key, value in vars(args).items() if key != "output"},
+        "sessions": len(sessions),
+        "completed": len(completed),
+        "failed": len(sessions) - len(completed),
+        "wall_time_s": round(wall_time, 2),
+        "throughput_sessions_per_min": round(len(completed) / wall_time * 60, 2) if wall_time else None,
+        "documents_created": sum(session["documents"] for session in completed),
+        "session_latency": percentiles([session["duration_ms"] for session in completed]),
+        "stage_latency": {stage: percentiles(values) for stage, values in sorted(stage_durations.items())},
+        "scenarios": {
+            name: {"completed": sum(1 for s in items if s["status"] == "ok"),
+                   "errors": sorted({s["error"] for s in items if s["error"]})}
+            for name, items in per_scenario.items()
+        },
+        # ru_maxrss dalam KB di Linux; proses anak = process pool ekstraksi PDF
+        "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        "peak_rss_children_mb": round(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024, 1),
+    }
+
+    output = json.dumps(report, indent=2, ensure_ascii=False)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(output + "\n")
+    print(output)
+    return 0 if completed else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,150 @@
+"""
+Fungsi-fungsi yang dijalankan di process pool.
+
+Disimpan di modul terpisah (tanpa import streamlit) karena streamlit_app.py dijalankan
+oleh Streamlit sebagai __main__, sehingga fungsi di dalamnya tidak bisa di-pickle
+dan di-import ulang oleh proses anak.
+"""
+import html
+import io
+import os
+import re
+import shutil
+import subprocess
+import tempfile
+import time
+import zipfile
+
+
+def iter_pdf_page_texts(reader, start, end, deadline=None):
+    """Menghasilkan teks per halaman (extract_text hanya sekali per halaman) sampai deadline tercapai."""
+    for page_number in range(start, end):
+        if deadline is not None and time.time() > deadline:
+            return
+        page_text = reader.pages[page_number].extract_text()
+        if page_text:
+            yield page_text
+
+
+def extract_pdf_page_range(file_bytes, start, end, deadline=None):
+    """
+    Mengekstrak teks halaman [start, end) dari PDF.
+    Mengembalikan (list_teks_halaman, selesai) — selesai=False jika deadline tercapai lebih dulu.
+    """
+    from pypdf import PdfReader # Di-import di sini agar proses render DOCX dan UI tidak ikut memuat pypdf
+    reader = PdfReader(io.BytesIO(file_bytes))
+    page_texts = list(iter_pdf_page_texts(reader, start, end, deadline))
+    finished = deadline is None or time.time() <= deadline
+    return page_texts, finished
+
+
+# Bagian DOCX yang berisi teks dokumen (isi, header, footer, catatan kaki)
+_DOCX_TEXT_PARTS = re.compile(r"word/(document|header\d*|footer\d*|footnotes|endnotes)\.xml$")
+_DOCX_TEXT_RUN = re.compile(r"<w:t(?: [^>]*)?/>|<w:t(?: [^>]*)?>(.*?)</w:t>", re.DOTALL)
+
+
+def value_to_text(value):
+    """Nilai placeholder sebagai teks: list of dict (Bukti_BA, Pembelian) menjadi satu baris per item."""
+    if value is None:
+        return ""
+    if isinstance(value, list):
+        lines = []
+        for item in value:
+            if isinstance(item, dict):
+                lines.append(" | ".join(str(item_value) for item_value in item.values() if item_value not in (None, "")))
+            else:
+                lines.append(str(item))
+        return "\n".join(lines)
+    return str(value)
+
+
+def placeholder_pattern(placeholder_format):
+    """Regex untuk placeholder berformat placeholder_format (misal "{{%s}}"); group 1 = nama key."""
+    prefix, suffix = placeholder_format.split("%s", 1)
+    return re.compile(f"{re.escape(prefix)}((?:(?!{re.escape(prefix)}).)+?){re.escape(suffix)}")
+
+
+def _run_xml(text):
+    """<w:t> baru untuk teks hasil penggantian; baris baru menjadi <w:br/> di run yang sama."""
+    if not text:
+        return "<w:t/>"
+    escaped = html.escape(text, quote=False).replace("\n", '</w:t><w:br/><w:t xml:space="preserve">')
+    return f'<w:t xml:space="preserve">{escaped}</w:t>'
+
+
+def _fill_paragraph(paragraph_xml, replacements, pattern):
+    """
+    Mengganti placeholder di satu paragraf. Word sering memecah "{{Key}}" ke beberapa run, jadi placeholder
+    dicari di gabungan teks semua <w:t>. Hanya run yang dilalui placeholder yang ditulis ulang: nilai masuk ke
+    run tempat placeholder dimulai, sisa placeholder di run berikutnya dihapus, dan teks serta format run
+    di luar placeholder (misal label tebal sebelum nilai) tidak disentuh.
+    """
+    runs = list(_DOCX_TEXT_RUN.finditer(paragraph_xml))
+    texts = [html.unescape(run.group(1) or "") for run in runs]
+    joined = "".join(texts)
+    matches = [match for match in pattern.finditer(joined) if match.group(1) in replacements]
+    if not matches:
+        return paragraph_xml
+    pieces = []
+    position = 0
+    run_start = 0
+    for run, text in zip(runs, texts):
+        run_end = run_start + len(text)
+        new_text = []
+        cursor = run_start
+        for match in matches:
+            if match.start() >= run_end or match.end() <= run_start:
+                continue
+            new_text.append(joined[cursor:match.start()]) # kosong jika placeholder dimulai di run sebelumnya
+            if match.start() >= run_start:
+                new_text.append(replacements[match.group(1)])
+            cursor = min(match.end(), run_end)
+        new_text.append(joined[cursor:run_end])
+        new_text = "".join(new_text)
+        if new_text != text:
+            pieces.append(paragraph_xml[position:run.start()])
+            pieces.append(_run_xml(new_text))
+            position = run.end()
+        run_start = run_end
+    pieces.append(paragraph_xml[position:])
+    return "".join(pieces)
+
+
+def render_docx_template(template_path, data, placeholder_format="{{%s}}", to_pdf=False):
+    """
+    Mengisi template DOCX dengan data ({nama_placeholder: nilai}) memakai zipfile + penggantian teks XML.
+    Mengembalikan bytes DOCX, atau bytes PDF jika to_pdf=True (membutuhkan LibreOffice/soffice).
+    """
+    replacements = {key: value_to_text(value) for key, value in data.items()}
+    pattern = placeholder_pattern(placeholder_format)
+    output = io.BytesIO()
+    with zipfile.ZipFile(template_path) as source, zipfile.ZipFile(output, "w", zipfile.ZIP_DEFLATED) as target:
+        for item in source.infolist():
+            content = source.read(item.filename)
+            if _DOCX_TEXT_PARTS.match(item.filename):
+                xml = content.decode("utf-8")
+                # Dipecah per akhir paragraf agar placeholder tidak digabung lintas paragraf
+                paragraphs = xml.split("</w:p>")
+                xml = "</w:p>".join(_fill_paragraph(paragraph, replacements, pattern) for paragraph in paragraphs)
+                content = xml.encode("utf-8")
+            target.writestr(item, content)
+    docx_bytes = output.getvalue()
+    return convert_docx_to_pdf(docx_bytes) if to_pdf else docx_bytes
+
+
+def convert_docx_to_pdf(docx_bytes, timeout_s=120):
+    """Konversi DOCX ke PDF dengan LibreOffice headless (profil sementara per panggilan agar bisa paralel)."""
+    soffice = shutil.which("soffice") or shutil.which("libreoffice")
+    if not soffice:
+        raise RuntimeError("LibreOffice (soffice) tidak ditemukan; konversi PDF tidak tersedia.")
+    with tempfile.TemporaryDirectory() as work_dir:
+        docx_path = os.path.join(work_dir, "dokumen.docx")
+        with open(docx_path, "wb") as f:
+            f.write(docx_bytes)
+        subprocess.run(
+            [soffice, f"-env:UserInstallation=file://{work_dir}/profile", "--headless",
+             "--convert-to", "pdf", "--outdir", work_dir, docx_path],
+            check=True, capture_output=True, timeout=timeout_s,
+        )
+        with open(os.path.join(work_dir, "dokumen.pdf"), "rb") as f:
+            return f.read()
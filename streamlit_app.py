@@ -1,18 +1,34 @@
+import time
+_SCRIPT_STARTED = time.perf_counter() # Awal eksekusi script, untuk laporan startup
 import streamlit as st
 import json
 import os
 import re
 import io
 import requests
-from pypdf import PdfReader
-from streamlit_pdf_viewer import pdf_viewer
-import google.generativeai as genai
-import pandas as pd
-from streamlit_gsheets import GSheetsConnection
-from google.oauth2.service_account import Credentials
+# Modul berat (google.generativeai, google.api_core, pandas, pypdf, streamlit_gsheets) di-import lewat lazy_import() saat pertama dipakai
 import ast
-
-conn = st.connection("gsheets", type=GSheetsConnection)
+import hashlib
+import hmac
+import secrets
+import importlib
+import sqlite3
+import threading
+import graphlib
+import heapq
+import itertools
+import math
+import logging
+import sys
+from contextlib import contextmanager
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from collections import Counter, defaultdict
+import multiprocessing
+import random
+import tempfile
+import uuid
+from concurrent.futures import Future, ThreadPoolExecutor, ProcessPoolExecutor, wait, as_completed
+from process_workers import iter_pdf_page_texts, extract_pdf_page_range, render_docx_template
 
 TARGET_PDF_TEMPLATES_PENGADAAN_LESS_300 = [ 
     os.path.join("templates", "Nota dinas izin prinsip(SVP)", "Nota dinas Izin Prinsip Pengadaan(SVP).pdf"),
@@ -38,134 +54,880 @@ TARGET_PDF_TEMPLATES_LISENSI_LESS_300 = [
     os.path.join("templates", "RAB", "RKS Dir. Bidang", "RKS Lisensi.pdf")
 ]
 
-# --- Konfigurasi & Inisialisasi ---
-st.set_page_config(page_title="Generator Dokumen Cerdas", page_icon="📝", layout="wide")
+# Nama set template -> daftar template yang dibuat bersama
+TEMPLATE_SETS = {
+    "PENGADAAN_LESS_300": TARGET_PDF_TEMPLATES_PENGADAAN_LESS_300,
+    "PENGADAAN_MORE_300": TARGET_PDF_TEMPLATES_PENGADAAN_MORE_300,
+    "LISENSI_LESS_300": TARGET_PDF_TEMPLATES_LISENSI_LESS_300,
+    "LISENSI_MORE_300": TARGET_PDF_TEMPLATES_LISENSI_MORE_300,
+}
+TEMPLATES_DIR = "templates"
+
+# Mode ekstraksi AI tahap pertama:
+# - "parallel": satu request kecil per resep, dikirim bersamaan (default)
+# - "single": satu prompt gabungan untuk semua resep (perilaku lama)
+AI_EXTRACTION_MODE = os.environ.get("AI_EXTRACTION_MODE", "parallel").lower()
+AI_EXTRACTION_MAX_WORKERS = int(os.environ.get("AI_EXTRACTION_MAX_WORKERS", "4"))
+# Streaming: field ditampilkan segera setelah pasangan key/value-nya lengkap diterima dari AI
+AI_EXTRACTION_STREAMING = os.environ.get("AI_EXTRACTION_STREAMING", "1") == "1"
+
+# Cache respons LLM di disk (bertahan setelah restart systemd)
+LLM_MODEL_NAME = 'gemini-2.5-flash'
+LLM_CACHE_PATH = os.environ.get("LLM_CACHE_PATH", os.path.join(".cache", "llm_responses.sqlite3"))
+LLM_CACHE_MAX_ENTRIES = int(os.environ.get("LLM_CACHE_MAX_ENTRIES", "2000"))
+LLM_CACHE_MAX_AGE_DAYS = float(os.environ.get("LLM_CACHE_MAX_AGE_DAYS", "30"))
+LLM_CACHE_DISABLED = os.environ.get("LLM_CACHE_DISABLED", "0") == "1"
+
+# Pembatas laju Gemini bersama untuk seluruh sesi di proses ini (sesuaikan dengan kuota project)
+LLM_RATE_LIMIT_RPM = float(os.environ.get("LLM_RATE_LIMIT_RPM", "60"))
+LLM_RATE_LIMIT_TPM = float(os.environ.get("LLM_RATE_LIMIT_TPM", "1000000"))
+LLM_MAX_CONCURRENCY = int(os.environ.get("LLM_MAX_CONCURRENCY", "8"))
+LLM_EXPECTED_OUTPUT_TOKENS = int(os.environ.get("LLM_EXPECTED_OUTPUT_TOKENS", "1024"))
+LLM_QUOTA_MAX_RETRIES = int(os.environ.get("LLM_QUOTA_MAX_RETRIES", "3"))
+LLM_QUOTA_BACKOFF_S = float(os.environ.get("LLM_QUOTA_BACKOFF_S", "5"))
+# Prioritas antrean: panggilan dari UI dilayani sebelum pekerjaan batch
+LLM_PRIORITY_INTERACTIVE = 0
+LLM_PRIORITY_BATCH = 1
+
+# Instrumentasi: span per tahap ditulis sebagai baris JSON, agregatnya diekspor di /metrics (format Prometheus)
+METRICS_PORT = int(os.environ.get("METRICS_PORT", "9464")) # 0 = endpoint dimatikan
+METRICS_HOST = os.environ.get("METRICS_HOST", "127.0.0.1") # Endpoint tanpa autentikasi: default hanya loopback
+METRICS_LOG_PATH = os.environ.get("METRICS_LOG_PATH", "") # Kosong = stderr
+
+# Batas ekstraksi teks dokumen unggahan (per file)
+UPLOAD_MAX_FILE_MB = float(os.environ.get("UPLOAD_MAX_FILE_MB", "25"))
+PDF_MAX_PAGES = int(os.environ.get("PDF_MAX_PAGES", "300"))
+PDF_EXTRACTION_TIMEOUT_S = float(os.environ.get("PDF_EXTRACTION_TIMEOUT_S", "60"))
+# PDF dengan halaman sebanyak ini atau lebih diekstrak paralel di process pool
+PDF_PARALLEL_MIN_PAGES = int(os.environ.get("PDF_PARALLEL_MIN_PAGES", "40"))
+PDF_EXTRACTION_WORKERS = int(os.environ.get("PDF_EXTRACTION_WORKERS", str(min(4, os.cpu_count() or 1))))
+
+# Memori per sesi: unggahan hanya disimpan sebagai hash + teks hasil ekstraksi (teks panjang dipindah ke file
+# sementara), payload sesi dibatasi ukurannya, dan payload sesi yang lama tidak aktif dibuang
+UPLOAD_TEXT_SPILL_CHARS = int(os.environ.get("UPLOAD_TEXT_SPILL_CHARS", "100000"))
+UPLOAD_TEXT_STORE_DIR = os.environ.get("UPLOAD_TEXT_STORE_DIR", os.path.join(tempfile.gettempdir(), "docgen_upload_texts"))
+SESSION_MAX_PAYLOAD_MB = float(os.environ.get("SESSION_MAX_PAYLOAD_MB", "20"))
+SESSION_IDLE_TIMEOUT_S = float(os.environ.get("SESSION_IDLE_TIMEOUT_S", "1800"))
+
+# Retrieval: jika teks dokumen pendukung melebihi anggaran token, hanya potongan yang relevan
+# dengan instruction/description setiap placeholder yang dimasukkan ke prompt
+RETRIEVAL_CONTEXT_TOKEN_BUDGET = int(os.environ.get("RETRIEVAL_CONTEXT_TOKEN_BUDGET", "6000"))
+RETRIEVAL_CHUNK_CHARS = int(os.environ.get("RETRIEVAL_CHUNK_CHARS", "1200"))
+RETRIEVAL_CHUNK_OVERLAP_CHARS = int(os.environ.get("RETRIEVAL_CHUNK_OVERLAP_CHARS", "200"))
+RETRIEVAL_TOP_K = int(os.environ.get("RETRIEVAL_TOP_K", "3"))
+# Regenerasi per field: konteks pendukung untuk satu placeholder dibatasi lebih ketat agar prompt tetap kecil
+FIELD_REGEN_CONTEXT_TOKENS = int(os.environ.get("FIELD_REGEN_CONTEXT_TOKENS", "1500"))
+
+# Prompt ekstraksi: JSON tanpa spasi, contoh dipangkas, dan total perkiraan token dijaga di bawah anggaran
+PROMPT_TOKEN_BUDGET = int(os.environ.get("PROMPT_TOKEN_BUDGET", "8000"))
+PROMPT_EXAMPLE_MAX_CHARS = int(os.environ.get("PROMPT_EXAMPLE_MAX_CHARS", "300"))
+PROMPT_EXAMPLE_MAX_ITEMS = int(os.environ.get("PROMPT_EXAMPLE_MAX_ITEMS", "2")) # Untuk contoh berupa list (Bukti_BA, Pembelian)
+
+# Pencocokan judul proyek Google Sheet: indeks lokal dulu, LLM hanya untuk memilih di antara kandidat teratas
+GSHEET_MATCH_TOP_N = int(os.environ.get("GSHEET_MATCH_TOP_N", "10"))
+GSHEET_MATCH_MIN_SCORE = float(os.environ.get("GSHEET_MATCH_MIN_SCORE", "0.3"))
+GSHEET_MATCH_CLEAR_SCORE = float(os.environ.get("GSHEET_MATCH_CLEAR_SCORE", "0.85"))
+GSHEET_MATCH_CLEAR_MARGIN = float(os.environ.get("GSHEET_MATCH_CLEAR_MARGIN", "0.25"))
+# Riwayat data final per proyek (SQLite): permintaan perpanjangan diisi dari riwayat, AI hanya untuk field yang berubah/kosong
+HISTORY_PATH = os.environ.get("HISTORY_PATH", os.path.join(".cache", "project_history.sqlite3"))
+HISTORY_MAX_ENTRIES = int(os.environ.get("HISTORY_MAX_ENTRIES", "5000"))
+HISTORY_MATCH_MIN_SCORE = float(os.environ.get("HISTORY_MATCH_MIN_SCORE", "0.75"))
+HISTORY_DISABLED = os.environ.get("HISTORY_DISABLED", "0") == "1"
+
+# Salinan lokal Google Sheet (SQLite, key = Title) yang disegarkan di latar belakang
+GSHEET_MIRROR_PATH = os.environ.get("GSHEET_MIRROR_PATH", os.path.join(".cache", "gsheet_mirror.sqlite3"))
+GSHEET_REFRESH_INTERVAL_S = float(os.environ.get("GSHEET_REFRESH_INTERVAL_S", "600"))
+# Kolom yang disalin (dipisah koma, "*" = semua kolom). Default: kolom yang namanya sama dengan field
+# resep (tanpa _CALCULATED), yaitu yang dipakai prefill prompt. Kolom Title selalu ikut.
+GSHEET_COLUMNS = [column.strip() for column in os.environ.get("GSHEET_COLUMNS", "").split(",") if column.strip()]
+
+# Parser budget lokal: LLM hanya dipanggil jika hasil parsing ambigu atau kepercayaannya rendah
+BUDGET_PARSE_MIN_CONFIDENCE = float(os.environ.get("BUDGET_PARSE_MIN_CONFIDENCE", "0.8"))
+
+# Web App Google Apps Script yang membuat dokumen dari payload batch
+APPS_SCRIPT_WEB_APP_URL = os.environ.get(
+    "APPS_SCRIPT_URL",
+    "https://script.google.com/macros/s/AKfycbzly2uf47C9_6pknw9-VmY8n1OmpOmt2sAwqKgtTZSlBiwYF0MAla4DdbqULOhkrUUi/exec"
+)
+# Pengiriman paralel: dokumen dikirim per chunk sehingga satu template lambat tidak menahan yang lain
+APPS_SCRIPT_CHUNK_SIZE = int(os.environ.get("APPS_SCRIPT_CHUNK_SIZE", "1"))
+APPS_SCRIPT_MAX_WORKERS = int(os.environ.get("APPS_SCRIPT_MAX_WORKERS", "6"))
+APPS_SCRIPT_TIMEOUT_S = float(os.environ.get("APPS_SCRIPT_TIMEOUT_S", "120"))
+APPS_SCRIPT_MAX_RETRIES = int(os.environ.get("APPS_SCRIPT_MAX_RETRIES", "3"))
+APPS_SCRIPT_BACKOFF_S = float(os.environ.get("APPS_SCRIPT_BACKOFF_S", "1.0"))
+# Cache hasil dokumen: template + data yang sama tidak dibuat ulang, kiriman ganda yang masih berjalan digabung
+DOC_RESULT_CACHE_PATH = os.environ.get("DOC_RESULT_CACHE_PATH", os.path.join(".cache", "document_results.sqlite3"))
+DOC_RESULT_CACHE_MAX_AGE_DAYS = float(os.environ.get("DOC_RESULT_CACHE_MAX_AGE_DAYS", "30"))
+DOC_RESULT_CACHE_DISABLED = os.environ.get("DOC_RESULT_CACHE_DISABLED", "0") == "1"
+
+# Render lokal (alternatif Apps Script): template "<nama resep>.docx" di folder yang sama dengan file resep
+LOCAL_RENDER_FORMAT = os.environ.get("LOCAL_RENDER_FORMAT", "docx").lower() # "docx" atau "pdf" (butuh LibreOffice)
+LOCAL_RENDER_PLACEHOLDER = os.environ.get("LOCAL_RENDER_PLACEHOLDER", "{{%s}}")
+LOCAL_RENDER_WORKERS = int(os.environ.get("LOCAL_RENDER_WORKERS", str(min(4, os.cpu_count() or 1))))
+
+# Job latar belakang: pekerjaan lama (LLM, pengiriman dokumen) tidak memblokir thread script
+JOB_MAX_WORKERS = int(os.environ.get("JOB_MAX_WORKERS", "8"))
+JOB_RETENTION_S = float(os.environ.get("JOB_RETENTION_S", "3600"))
+JOB_POLL_INTERVAL_S = float(os.environ.get("JOB_POLL_INTERVAL_S", "0.5"))
 
-# --- Custom Modern Styling (visual only, no functional changes) ---
-st.markdown(
-    '''
-    <style>
-    /* Background and container card */
-    .stApp {
-        background: linear-gradient(120deg, #f9fafc 0%, #f1f6fa 100%);
-        color: #222;
-    }
-    section[data-testid="stSidebar"] {
-        background-color: #f6fbff !important;
-    }
-    /* Card effect for forms and main panels */
-    div[class*="stForm"] {
-        background: #fff !important;
-        border-radius: 18px;
-        padding: 2rem 2.2rem;
-        box-shadow: 0 6px 32px #19537515;
-        border: 1.5px solid #ecf3fc;
-        margin-bottom: 24px;
-    }
-    /* Headings */
-    h1, h2, h3, h4 {
-        color: #195375;
-        letter-spacing: 0.5px;
-    }
-    /* Buttons */
-    button[kind="primary"] {
-        background: linear-gradient(90deg, #318af2 0%, #56c7ff 100%) !important;
-        color: #fff !important;
-        border-radius: 8px !important;
-        box-shadow: 0 2px 12px #318af236;
-        border: none !important;
-        font-weight: 600;
-    }
-    button[kind="secondary"] {
-        background: #fff !important;
-        border: 1.2px solid #56c7ff !important;
-        border-radius: 8px !important;
-        color: #318af2 !important;
-    }
-    /* Text Input and Text Area */
-    input, textarea {
-        background-color: #f7fafc !important;
-        border-radius: 7px !important;
-        border: 1px solid #cbdbfc !important;
-        padding: 8px 12px !important;
-        transition: box-shadow 0.18s;
-        font-size: 1rem;
-    }
-    input:focus, textarea:focus {
-        outline: none !important;
-        border-color: #67c3f3 !important;
-        box-shadow: 0 0 0 2px #67c3f342 !important;
-    }
-    /* File Uploader dropzone */
-    div[data-testid="stFileDropzone"] {
-        border: 2px dashed #318af2 !important;
-        background-color: #f0f5fd !important;
-        border-radius: 10px !important;
-    }
-    /* Expander panels */
-    div[data-testid="stExpander"] > div:first-child {
-        background: #f4fafd !important;
-        border-radius: 8px;
-        border: 1px solid #e2eefc;
-    }
-    /* Info/Warning boxes */
-    div[data-testid="stAlertInfo"] {
-        background-color: #e3f0fd !important;
-        color: #153e5c !important;
-    }
-    div[data-testid="stAlertWarning"] {
-        background-color: #fff7df !important;
-        color: #9b5d06 !important;
-    }
-    .st-b5 {
-        font-size: 1.16rem !important;
-    }
-    /* Secondary tweaks as needed */
-    </style>
-    ''', unsafe_allow_html=True)
+
+# --- Fungsi-fungsi Inti ---
+
+# --- Instrumentasi (Span & Metrik) ---
+_LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+_SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576)
+# Atribut span numerik yang juga dijumlahkan sebagai counter (token & ukuran payload)
+_SPAN_COUNTER_ATTRIBUTES = {
+    "prompt_tokens": "docgen_llm_prompt_tokens_total",
+    "response_tokens": "docgen_llm_response_tokens_total",
+}
+
+class MetricsRegistry:
+    """Counter dan histogram in-memory (thread-safe) yang dirender ke format teks Prometheus."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = defaultdict(float)
+        self._histograms = {}
+
+    @staticmethod
+    def _label_key(labels):
+        return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+    def inc(self, name, value=1, **labels):
+        with self._lock:
+            self._counters[(name, self._label_key(labels))] += value
+
+    def observe(self, name, value, buckets=_LATENCY_BUCKETS, **labels):
+        with self._lock:
+            key = (name, self._label_key(labels))
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = {"buckets": buckets, "counts": [0] * len(buckets), "sum": 0.0, "count": 0}
+            for i, upper_bound in enumerate(histogram["buckets"]):
+                if value <= upper_bound:
+                    histogram["counts"][i] += 1
+            histogram["sum"] += value
+            histogram["count"] += 1
+
+    @staticmethod
+    def _format_labels(label_key, extra=()):
+        pairs = list(label_key) + list(extra)
+        if not pairs:
+            return ""
+        escape = lambda value: str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        return "{" + ",".join(f'{key}="{escape(value)}"' for key, value in pairs) + "}"
+
+    def render(self):
+        """Teks exposition Prometheus untuk semua counter dan histogram."""
+        lines = []
+        with self._lock:
+            for name in sorted({name for name, _ in self._counters}):
+                lines.append(f"# TYPE {name} counter")
+                for (counter_name, label_key), value in sorted(self._counters.items()):
+                    if counter_name == name:
+                        lines.append(f"{name}{self._format_labels(label_key)} {value:g}")
+            for name in sorted({name for name, _ in self._histograms}):
+                lines.append(f"# TYPE {name} histogram")
+                for (histogram_name, label_key), histogram in sorted(self._histograms.items()):
+                    if histogram_name != name:
+                        continue
+                    for upper_bound, count in zip(histogram["buckets"], histogram["counts"]):
+                        lines.append(f"{name}_bucket{self._format_labels(label_key, [('le', f'{upper_bound:g}')])} {count}")
+                    lines.append(f"{name}_bucket{self._format_labels(label_key, [('le', '+Inf')])} {histogram['count']}")
+                    lines.append(f"{name}_sum{self._format_labels(label_key)} {histogram['sum']:g}")
+                    lines.append(f"{name}_count{self._format_labels(label_key)} {histogram['count']}")
+        return "\n".join(lines) + "\n"
+
+@st.cache_resource
+def get_metrics_registry():
+    """Satu registry metrik per proses, dipakai bersama oleh semua sesi, job, dan mode batch."""
+    return MetricsRegistry()
+
+metrics = get_metrics_registry()
+
+@st.cache_resource
+def get_span_logger():
+    """Logger baris JSON untuk span (ke METRICS_LOG_PATH atau stderr)."""
+    logger = logging.getLogger("docgen.spans")
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+    handler = logging.FileHandler(METRICS_LOG_PATH, encoding="utf-8") if METRICS_LOG_PATH else logging.StreamHandler(sys.stderr)
+    handler.setFormatter(logging.Formatter("%(message)s"))
+    logger.addHandler(handler)
+    return logger
+
+span_logger = get_span_logger()
+
+@contextmanager
+def timed_span(stage, **attributes):
+    """
+    Mengukur satu tahap pipeline. Atribut tambahan (token, cache hit, ukuran payload, dll.)
+    bisa diisi ke dict yang di-yield. Hasilnya ditulis sebagai satu baris JSON dan dicatat
+    ke histogram docgen_stage_duration_seconds{stage, status}. Tidak memanggil st.*.
+    """
+    span = dict(attributes)
+    started = time.perf_counter()
+    status = "ok"
+    try:
+        yield span
+    except BaseException:
+        status = "error"
+        raise
+    finally:
+        duration = time.perf_counter() - started
+        metrics.observe("docgen_stage_duration_seconds", duration, stage=stage, status=status)
+        for attribute, counter_name in _SPAN_COUNTER_ATTRIBUTES.items():
+            if isinstance(span.get(attribute), (int, float)):
+                metrics.inc(counter_name, span[attribute], stage=stage)
+        if "cache_hit" in span:
+            metrics.inc("docgen_llm_cache_requests_total", stage=stage, result="hit" if span["cache_hit"] else "miss")
+        if isinstance(span.get("payload_bytes"), int):
+            metrics.observe("docgen_payload_bytes", span["payload_bytes"], buckets=_SIZE_BUCKETS, stage=stage)
+        span_logger.info(json.dumps({
+            "ts": round(time.time(), 3), "stage": stage, "status": status,
+            "duration_ms": round(duration * 1000, 1), **span,
+        }, ensure_ascii=False, default=str))
+
+class _MetricsRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = metrics.render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass # Scrape Prometheus tidak perlu dicatat
+
+@st.cache_resource
+def start_metrics_server(port=METRICS_PORT, host=METRICS_HOST):
+    """Menjalankan endpoint /metrics di thread latar belakang (sekali per proses). Mengembalikan server atau None."""
+    if not port:
+        return None
+    try:
+        server = ThreadingHTTPServer((host, port), _MetricsRequestHandler)
+    except OSError as e:
+        span_logger.info(json.dumps({
+            "ts": round(time.time(), 3), "stage": "metrics_server", "status": "error",
+            "address": f"{host}:{port}", "error": f"{type(e).__name__}: {e}",
+        }, ensure_ascii=False))
+        return None
+    threading.Thread(target=server.serve_forever, name="metrics-server", daemon=True).start()
+    return server
+
+# --- Import Malas & Laporan Startup ---
+class StartupReport:
+    """
+    Biaya startup per proses: lama import modul berat (diukur saat pertama kali dipakai) dan
+    lama eksekusi top-level script per run. Run pertama di proses adalah cold start.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.imports = {} # nama modul -> detik
+        self.cold_start_s = None
+        self.last_setup_s = None
+        self.runs = 0
+
+    def record_import(self, module_name, seconds):
+        with self._lock:
+            self.imports[module_name] = seconds
+        metrics.observe("docgen_module_import_seconds", seconds, module=module_name)
+
+    def record_script_setup(self, seconds):
+        """Mencatat lama top-level script (import + singleton) untuk satu run."""
+        with self._lock:
+            cold = self.cold_start_s is None
+            if cold:
+                self.cold_start_s = seconds
+            self.last_setup_s = seconds
+            self.runs += 1
+            imports = dict(self.imports)
+        metrics.observe("docgen_script_setup_seconds", seconds, cold=str(cold).lower())
+        if cold:
+            span_logger.info(json.dumps({
+                "ts": round(time.time(), 3), "stage": "startup", "status": "ok",
+                "duration_ms": round(seconds * 1000, 1),
+                "imports_ms": {name: round(value * 1000, 1) for name, value in imports.items()},
+            }, ensure_ascii=False))
+
+    def stats(self):
+        with self._lock:
+            return {"cold_start_s": self.cold_start_s, "last_setup_s": self.last_setup_s,
+                    "runs": self.runs, "imports": dict(self.imports)}
+
+@st.cache_resource
+def get_startup_report():
+    return StartupReport()
+
+startup_report = get_startup_report()
+
+def lazy_import(module_name):
+    """Import modul berat saat pertama kali dibutuhkan (aman dari thread mana pun); lamanya dicatat ke laporan startup."""
+    if module_name in sys.modules:
+        return importlib.import_module(module_name)
+    started = time.perf_counter()
+    module = importlib.import_module(module_name)
+    startup_report.record_import(module_name, time.perf_counter() - started)
+    return module
 
 # --- Konfigurasi API Key (Hybrid: Server & Lokal) ---
-try:
-    # 1. Coba ambil dari Environment Variable (Ini yang akan bekerja di SERVER / Systemd)
-    # Pastikan nama variabel di sini SAMA PERSIS dengan di file systemd Anda
-    api_key = os.environ.get("GEMINI_API_KEY") 
-
-    # 2. Jika tidak ada di Server, coba ambil dari st.secrets (Ini untuk testing LOKAL)
-    if not api_key:
-        # Gunakan .get() agar tidak error jika tidak ada file secrets
-        # Pastikan key di secrets.toml Anda bernama "GEMINI_API_KEY" atau sesuaikan
-        api_key = st.secrets.get("GEMINI_API_KEY")
-
-    # 3. Validasi dan Konfigurasi
-    if not api_key:
-        st.error("CRITICAL ERROR: API Key tidak ditemukan di Environment Server maupun Secrets Lokal.")
-        st.stop() # Hentikan aplikasi agar tidak crash di bawah
+@st.cache_resource(show_spinner=False)
+def create_model(api_key, model_name):
+    """genai.configure + GenerativeModel sekali per proses untuk setiap API key (bukan setiap rerun)."""
+    genai = lazy_import("google.generativeai")
+    genai.configure(api_key=api_key)
+    return genai.GenerativeModel(model_name)
+
+def configure_model():
+    """
+    Mengonfigurasi model Gemini. Mengembalikan (model, pesan_error, fatal);
+    fatal=True jika API Key tidak ditemukan sama sekali.
+    """
+    try:
+        # 1. Coba ambil dari Environment Variable (Ini yang akan bekerja di SERVER / Systemd)
+        # Pastikan nama variabel di sini SAMA PERSIS dengan di file systemd Anda
+        api_key = os.environ.get("GEMINI_API_KEY") 
+
+        # 2. Jika tidak ada di Server, coba ambil dari st.secrets (Ini untuk testing LOKAL)
+        if not api_key:
+            # Gunakan .get() agar tidak error jika tidak ada file secrets
+            # Pastikan key di secrets.toml Anda bernama "GEMINI_API_KEY" atau sesuaikan
+            api_key = st.secrets.get("GEMINI_API_KEY")
+
+        # 3. Validasi dan Konfigurasi
+        if not api_key:
+            return None, "CRITICAL ERROR: API Key tidak ditemukan di Environment Server maupun Secrets Lokal.", True
+        return create_model(api_key, LLM_MODEL_NAME), None, False
+
+    except Exception as e:
+        return None, f"Terjadi kesalahan konfigurasi model AI: {e}", False
+
+model, model_error, model_error_fatal = configure_model()
+
+class LLMResponseCache:
+    """
+    Cache respons LLM di disk (SQLite), dipakai bersama oleh semua sesi dalam satu proses.
+    Key adalah hash SHA-256 dari nama model, prompt lengkap, dan pengaturan generasi.
+    Entri dihapus berdasarkan umur (max_age_seconds) dan LRU (max_entries).
+    """
+    def __init__(self, path, max_entries, max_age_seconds):
+        self.path = path
+        self.max_entries = max_entries
+        self.max_age_seconds = max_age_seconds
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        cache_dir = os.path.dirname(path)
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        with self._lock, self._conn:
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS llm_cache ("
+                "key TEXT PRIMARY KEY, model TEXT, response TEXT, created_at REAL, last_access REAL)"
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS idx_llm_cache_last_access ON llm_cache (last_access)")
+        self.evict()
+
+    @staticmethod
+    def make_key(model_name, prompt, generation_config=None):
+        key_material = json.dumps(
+            {"model": model_name, "prompt": prompt, "config": generation_config},
+            sort_keys=True, ensure_ascii=False, default=str
+        )
+        return hashlib.sha256(key_material.encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        now = time.time()
+        with self._lock, self._conn:
+            row = self._conn.execute(
+                "SELECT response, created_at FROM llm_cache WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None or now - row[1] > self.max_age_seconds:
+                self.misses += 1
+                return None
+            self._conn.execute("UPDATE llm_cache SET last_access = ? WHERE key = ?", (now, key))
+            self.hits += 1
+            return row[0]
+
+    def set(self, key, model_name, response_text):
+        now = time.time()
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO llm_cache (key, model, response, created_at, last_access) VALUES (?, ?, ?, ?, ?)",
+                (key, model_name, response_text, now, now)
+            )
+        self.evict()
+
+    def evict(self):
+        """Menghapus entri kedaluwarsa, lalu entri yang paling lama tidak diakses jika melebihi batas."""
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM llm_cache WHERE created_at < ?", (time.time() - self.max_age_seconds,))
+            self._conn.execute(
+                "DELETE FROM llm_cache WHERE key NOT IN "
+                "(SELECT key FROM llm_cache ORDER BY last_access DESC LIMIT ?)",
+                (self.max_entries,)
+            )
+
+    def clear(self):
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM llm_cache")
+        self.hits = 0
+        self.misses = 0
+
+    def stats(self):
+        with self._lock:
+            entries = self._conn.execute("SELECT COUNT(*) FROM llm_cache").fetchone()[0]
+        total = self.hits + self.misses
+        return {
+            "entries": entries,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": (self.hits / total) if total else 0.0,
+        }
+
+@st.cache_resource
+def get_llm_cache():
+    """Satu instance cache LLM per proses (tidak dibuat ulang pada setiap rerun)."""
+    return LLMResponseCache(LLM_CACHE_PATH, LLM_CACHE_MAX_ENTRIES, LLM_CACHE_MAX_AGE_DAYS * 86400)
+
+# Diambil di thread utama agar thread pekerja cukup memakai variabel modul ini
+llm_cache = get_llm_cache()
+
+def llm_cache_enabled_for_session():
+    """Cache bisa dimatikan global (LLM_CACHE_DISABLED=1) atau per sesi lewat toggle di sidebar."""
+    return not LLM_CACHE_DISABLED and not st.session_state.get("bypass_llm_cache", False)
+
+class LLMRateLimiter:
+    """
+    Token bucket (permintaan/menit dan token/menit) plus batas konkurensi untuk semua panggilan
+    Gemini di proses ini. Pemanggil menunggu di antrean prioritas (angka kecil dilayani lebih dulu,
+    FIFO untuk prioritas yang sama), sehingga throughput mendekati kuota tanpa badai error 429.
+    """
+
+    def __init__(self, rpm=LLM_RATE_LIMIT_RPM, tpm=LLM_RATE_LIMIT_TPM, max_concurrency=LLM_MAX_CONCURRENCY):
+        self.rpm = rpm
+        self.tpm = tpm
+        self.max_concurrency = max(1, max_concurrency)
+        self._request_tokens = float(rpm)
+        self._llm_tokens = float(tpm)
+        self._updated = time.monotonic()
+        self._blocked_until = 0.0
+        self._active = 0
+        self._waiting = [] # heap (prioritas, urutan)
+        self._sequence = itertools.count()
+        self._condition = threading.Condition()
+        self._calls = 0
+        self._total_wait = 0.0
+        self._max_wait = 0.0
+
+    def _refill(self):
+        now = time.monotonic()
+        elapsed = now - self._updated
+        self._updated = now
+        self._request_tokens = min(self.rpm, self._request_tokens + elapsed * self.rpm / 60)
+        self._llm_tokens = min(self.tpm, self._llm_tokens + elapsed * self.tpm / 60)
+
+    def _seconds_until_capacity(self, tokens):
+        request_delay = max(0.0, 1 - self._request_tokens) * 60 / self.rpm
+        token_delay = max(0.0, tokens - self._llm_tokens) * 60 / self.tpm
+        return max(request_delay, token_delay, self._blocked_until - time.monotonic())
+
+    def acquire(self, estimated_tokens, priority=LLM_PRIORITY_INTERACTIVE):
+        """Menunggu giliran dan kuota; mengembalikan lama menunggu (detik)."""
+        tokens = min(estimated_tokens, self.tpm)
+        ticket = (priority, next(self._sequence))
+        started = time.monotonic()
+        with self._condition:
+            heapq.heappush(self._waiting, ticket)
+            try:
+                while True:
+                    self._refill()
+                    if self._waiting[0] == ticket and self._active < self.max_concurrency:
+                        delay = self._seconds_until_capacity(tokens)
+                        if delay <= 0:
+                            break
+                        self._condition.wait(timeout=delay)
+                    else:
+                        self._condition.wait(timeout=1.0)
+            except BaseException:
+                self._waiting.remove(ticket)
+                heapq.heapify(self._waiting)
+                self._condition.notify_all()
+                raise
+            heapq.heappop(self._waiting)
+            self._request_tokens -= 1
+            self._llm_tokens -= tokens
+            self._active += 1
+            waited = time.monotonic() - started
+            self._calls += 1
+            self._total_wait += waited
+            self._max_wait = max(self._max_wait, waited)
+            self._condition.notify_all()
+        return waited
+
+    def release(self, estimated_tokens, actual_tokens=None):
+        """Mengembalikan slot; selisih token perkiraan vs aktual (usage_metadata) dikoreksi ke bucket."""
+        with self._condition:
+            self._active -= 1
+            if actual_tokens is not None:
+                self._llm_tokens = max(-self.tpm, self._llm_tokens - (actual_tokens - min(estimated_tokens, self.tpm)))
+            self._condition.notify_all()
+
+    def backoff(self, seconds):
+        """Dipanggil saat Gemini menolak karena kuota: semua pemanggil di proses ini ikut menahan diri."""
+        with self._condition:
+            self._blocked_until = max(self._blocked_until, time.monotonic() + seconds)
+            self._request_tokens = min(self._request_tokens, 0.0)
+
+    def stats(self):
+        with self._condition:
+            return {
+                "queue_depth": len(self._waiting),
+                "active": self._active,
+                "calls": self._calls,
+                "avg_wait_s": self._total_wait / self._calls if self._calls else 0.0,
+                "max_wait_s": self._max_wait,
+            }
+
+@st.cache_resource
+def get_llm_rate_limiter():
+    """Satu limiter per proses server, dipakai bersama oleh semua sesi dan job."""
+    return LLMRateLimiter()
+
+llm_rate_limiter = get_llm_rate_limiter()
+
+def response_usage(response):
+    """Jumlah token dari usage_metadata Gemini: {prompt_tokens, response_tokens, total_tokens} (kosong jika tidak ada)."""
+    usage = getattr(response, "usage_metadata", None)
+    if not getattr(usage, "total_token_count", None):
+        return {}
+    return {
+        "prompt_tokens": usage.prompt_token_count,
+        "response_tokens": usage.candidates_token_count,
+        "total_tokens": usage.total_token_count,
+    }
+
+def call_model_rate_limited(request_fn, prompt, priority=LLM_PRIORITY_INTERACTIVE, span=None):
+    """
+    Menjalankan request_fn() — satu panggilan Gemini yang mengembalikan (hasil, usage) —
+    di dalam slot limiter. Error kuota (429) membuat seluruh proses menahan diri lalu dicoba ulang
+    dengan exponential backoff; error lain diteruskan ke pemanggil.
+    Jika span diberikan, waktu tunggu antrean, jumlah percobaan, dan usage token dicatat ke span.
+    """
+    span = span if span is not None else {}
+    estimated_tokens = estimate_tokens(prompt) + LLM_EXPECTED_OUTPUT_TOKENS
+    span["wait_s"] = 0.0
+    for attempt in range(LLM_QUOTA_MAX_RETRIES + 1):
+        span["wait_s"] = round(span["wait_s"] + llm_rate_limiter.acquire(estimated_tokens, priority), 3)
+        span["attempts"] = attempt + 1
+        usage = {}
+        try:
+            result, usage = request_fn()
+            span.update(usage)
+            return result
+        except lazy_import("google.api_core.exceptions").TooManyRequests:
+            metrics.inc("docgen_llm_quota_errors_total")
+            if attempt >= LLM_QUOTA_MAX_RETRIES:
+                raise
+            llm_rate_limiter.backoff(LLM_QUOTA_BACKOFF_S * (2 ** attempt))
+        finally:
+            llm_rate_limiter.release(estimated_tokens, usage.get("total_tokens"))
+
+def generate_text(prompt, generation_config=None, use_cache=True, cache_if=None, priority=LLM_PRIORITY_INTERACTIVE):
+    """
+    Satu-satunya pintu pemanggilan model Gemini. Mengembalikan teks respons (atau None).
+    Respons hanya disimpan ke cache jika cache_if(teks) bernilai True (atau cache_if tidak diberikan),
+    agar respons yang rusak tidak terus-menerus diulang dari cache.
+    Semua panggilan melewati llm_rate_limiter; priority menentukan urutan antrean (UI vs batch).
+    Tidak memanggil st.* sehingga aman dipakai dari thread pekerja.
+    """
+    with timed_span("llm_call", streamed=False, priority=priority, prompt_chars=len(prompt)) as span:
+        cache_key = LLMResponseCache.make_key(model.model_name, prompt, generation_config)
+        span["cache_hit"] = False
+        if use_cache:
+            cached_text = llm_cache.get(cache_key)
+            if cached_text is not None:
+                span["cache_hit"] = True
+                return cached_text
+
+        def request():
+            if generation_config:
+                response = model.generate_content(prompt, generation_config=generation_config)
+            else:
+                response = model.generate_content(prompt)
+            return extract_response_text(response), response_usage(response)
+        response_text = call_model_rate_limited(request, prompt, priority, span=span)
+
+        if use_cache and response_text and (cache_if is None or cache_if(response_text)):
+            llm_cache.set(cache_key, model.model_name, response_text)
+        return response_text
+
+# --- Parser Budget Lokal (Bahasa Indonesia) ---
+_AMOUNT_MULTIPLIERS = {
+    "rb": 1e3, "ribu": 1e3, "k": 1e3,
+    "jt": 1e6, "juta": 1e6,
+    "m": 1e9, "miliar": 1e9, "milyar": 1e9,
+    "t": 1e12, "triliun": 1e12,
+}
+# "M"/"T" hanya dikenali sebagai miliar/triliun jika ditulis huruf besar (hindari "100m kabel")
+_AMOUNT_PATTERN = re.compile(
+    r'(?P<rp>(?i:rp)\.?\s*)?'
+    r'(?P<num>\d+(?:[.,]\d+)*)'
+    r'\s*(?P<suffix>(?i:triliun|miliar|milyar|juta|jt|ribu|rb|k)|M|T)?\b'
+    r'(?P<idr>\s*(?:,-|(?i:idr|rupiah)))?'
+)
+_QUANTITY_AFTER_PATTERN = re.compile(
+    r'^\s*(?:per|/)\s*[a-z]+[\s,]*(?:[a-z]+\s+){0,3}?(?:x|×|kali|sebanyak|butuh|dibutuhkan|jumlah)\s*(?P<qty>\d+)\b'
+    r'|^\s*(?:x|×|kali)\s*(?P<qty2>\d+)\b'
+)
+_QUANTITY_BEFORE_PATTERN = re.compile(r'(?P<qty>\d+)\s*(?:[a-z]+\s*)?(?:x|×|@)\s*$')
+_MULTIPLIER_HINT_PATTERN = re.compile(r'\bper\b|\bx\s*\d|×|@|\bsetiap\b|masing-masing|\b(?:untuk|butuh|sebanyak)\s+\d+')
+_BUDGET_EXCLUDE_PATTERN = re.compile(
+    r'prognosa|rkap|\brka\b|terpakai|kontrak|\bpo\b|\bpr\b|sisa|realisasi|rab\s*(?:&|dan)\s*rks|tahun lalu|sebelumnya'
+)
+_BUDGET_STRONG_PATTERN = re.compile(r'usulan|budget|anggaran|total biaya|nilai pengadaan|estimasi')
+_BUDGET_WEAK_PATTERN = re.compile(r'harga|biaya|total|senilai|sebesar|sekitar')
+
+def parse_indonesian_number(num_str, has_suffix=False):
+    """
+    Mengubah angka bergaya Indonesia menjadi float.
+    Titik = pemisah ribuan, koma = desimal ("26.401.000.000", "17,5"); "17.5 jt" juga diterima.
+    Mengembalikan (nilai, ambigu) — ambigu=True jika format bisa dibaca dua cara.
+    """
+    if "." in num_str and "," in num_str:
+        decimal_sep = "," if num_str.rfind(",") > num_str.rfind(".") else "."
+        thousands_sep = "." if decimal_sep == "," else ","
+        return float(num_str.replace(thousands_sep, "").replace(decimal_sep, ".")), False
+    for sep in (".", ","):
+        if sep in num_str:
+            parts = num_str.split(sep)
+            if len(parts) > 2:
+                return float(num_str.replace(sep, "")), False
+            # Satu pemisah: "500.000" = ribuan, "17,5" / "17.5" = desimal
+            if len(parts[1]) == 3 and not has_suffix:
+                return float(num_str.replace(sep, "")), sep == ","
+            return float(num_str.replace(sep, ".")), False
+    return float(num_str), False
+
+def parse_budget_locally(text_description):
+    """
+    Mendeteksi budget utama dari deskripsi tanpa LLM.
+    Mengenali akhiran rb/ribu/jt/juta/M/miliar, koma desimal, titik ribuan,
+    dan pola sederhana "harga per unit x jumlah".
+    Mengembalikan dict {"amount": float|None, "confidence": 0..1, "source": potongan teks}.
+    """
+    result = {"amount": None, "confidence": 0.0, "source": None}
+    if not text_description:
+        return result
+
+    candidates = [] # (tingkat_kata_kunci, nilai, potongan_teks, ada_petunjuk_perkalian)
+    segments = re.split(r'\n|;|(?<=\w)\.\s+(?=[A-Za-z])', text_description)
+    for segment in segments:
+        segment_lower = segment.lower()
+        previous_end = 0 # Kata kunci dibaca sejak angka uang sebelumnya, bukan sejak awal segmen
+        for match in _AMOUNT_PATTERN.finditer(segment):
+            suffix = (match.group("suffix") or "")
+            multiplier = _AMOUNT_MULTIPLIERS.get(suffix.lower(), 1.0)
+            value, ambiguous = parse_indonesian_number(match.group("num"), has_suffix=bool(suffix))
+            value *= multiplier
+            has_currency_marker = bool(suffix or match.group("rp") or match.group("idr"))
+            # Abaikan angka kecil tanpa penanda uang (tanggal, tahun, jumlah unit, nomor pos)
+            if not has_currency_marker and (value < 10_000 or 1900 <= value <= 2100):
+                continue
+
+            prefix = segment_lower[previous_end:match.start()]
+            previous_end = match.end()
+            if _BUDGET_EXCLUDE_PATTERN.search(prefix):
+                continue
+
+            # Pola "harga per unit x jumlah" atau "jumlah x harga"
+            after = segment_lower[match.end():]
+            quantity_match = _QUANTITY_AFTER_PATTERN.search(after)
+            quantity = quantity_match and (quantity_match.group("qty") or quantity_match.group("qty2"))
+            if not quantity:
+                before_match = _QUANTITY_BEFORE_PATTERN.search(prefix)
+                quantity = before_match.group("qty") if before_match else None
+            has_multiplier_hint = False
+            if quantity:
+                value *= int(quantity)
+            elif _MULTIPLIER_HINT_PATTERN.search(segment_lower):
+                has_multiplier_hint = True
+
+            if _BUDGET_STRONG_PATTERN.search(prefix):
+                tier = 2
+            elif _BUDGET_WEAK_PATTERN.search(prefix):
+                tier = 1
+            else:
+                tier = 0
+            candidates.append((tier, value, segment.strip(), has_multiplier_hint or ambiguous))
+
+    if not candidates:
+        return result
+
+    top_tier = max(candidate[0] for candidate in candidates)
+    top_candidates = [candidate for candidate in candidates if candidate[0] == top_tier]
+    _, amount, source, uncertain = top_candidates[0]
+    distinct_values = {candidate[1] for candidate in top_candidates}
+
+    if len(distinct_values) > 1:
+        confidence = 0.4 # Beberapa angka bersaing di tingkat yang sama
+    elif top_tier == 2:
+        confidence = 0.95
+    elif top_tier == 1 or len(candidates) == 1:
+        confidence = 0.85
     else:
-        genai.configure(api_key=api_key)
-        model = genai.GenerativeModel('gemini-2.5-flash')
-
-except Exception as e:
-    st.error(f"Terjadi kesalahan konfigurasi model AI: {e}")
-    model = None
-
-# Inisialisasi session state
-if 'page' not in st.session_state: st.session_state.page = "initial_input"
-if 'recipe' not in st.session_state: st.session_state.recipe = None
-if 'initial_data' not in st.session_state: st.session_state.initial_data = {"prompt": "", "files": {}}
-if 'ai_extracted_data' not in st.session_state: st.session_state.ai_extracted_data = None
-if 'final_json' not in st.session_state: st.session_state.final_json = None
-if 'gsheet_data' not in st.session_state: st.session_state.gsheet_data = None # To store the DataFrame
-if 'ai_matches' not in st.session_state: st.session_state.ai_matches = None # To store matching titles
-if 'budget' not in st.session_state: st.session_state.budget = None
+        confidence = 0.4
+    if uncertain:
+        confidence = min(confidence, 0.5)
 
-# --- Fungsi-fungsi Inti ---
+    result.update({"amount": amount, "confidence": confidence, "source": source})
+    return result
+
+def detect_budget(text_description, use_cache=True, priority=LLM_PRIORITY_INTERACTIVE):
+    """
+    Menentukan budget: parser lokal lebih dulu (mikrodetik), LLM hanya jika parser ragu.
+    Mengembalikan (budget, sumber) dengan sumber "lokal" atau "AI".
+    """
+    with timed_span("budget_detection") as span:
+        parsed = parse_budget_locally(text_description)
+        if parsed["amount"] is not None and parsed["confidence"] >= BUDGET_PARSE_MIN_CONFIDENCE:
+            span["source"] = "lokal"
+            return parsed["amount"], "lokal"
+        span["source"] = "AI"
+        return analyze_budget_with_llm(text_description, use_cache=use_cache, priority=priority), "AI"
+
+def generate_text_stream(prompt, on_text, generation_config=None, use_cache=True, cache_if=None, priority=LLM_PRIORITY_INTERACTIVE):
+    """
+    Versi streaming dari generate_text: on_text(potongan_teks) dipanggil untuk setiap chunk.
+    Jika respons ada di cache, seluruh teks dikirim sebagai satu chunk.
+    Jika stream terputus, exception diteruskan ke pemanggil; chunk yang sudah dikirim tetap berlaku.
+    """
+    with timed_span("llm_call", streamed=True, priority=priority, prompt_chars=len(prompt)) as span:
+        cache_key = LLMResponseCache.make_key(model.model_name, prompt, generation_config)
+        span["cache_hit"] = False
+        if use_cache:
+            cached_text = llm_cache.get(cache_key)
+            if cached_text is not None:
+                span["cache_hit"] = True
+                on_text(cached_text)
+                return cached_text
+
+        def request():
+            text_parts = []
+            usage = {}
+            started = time.perf_counter()
+            try:
+                chunks = (model.generate_content(prompt, stream=True, generation_config=generation_config) if generation_config
+                          else model.generate_content(prompt, stream=True))
+                for chunk in chunks:
+                    usage = response_usage(chunk) or usage # usage_metadata lengkap ada di chunk terakhir
+                    chunk_text = extract_response_text(chunk)
+                    if chunk_text:
+                        if not text_parts:
+                            span["first_chunk_ms"] = round((time.perf_counter() - started) * 1000, 1)
+                        text_parts.append(chunk_text)
+                        on_text(chunk_text)
+            except lazy_import("google.api_core.exceptions").TooManyRequests as e:
+                if text_parts:
+                    # Chunk sudah dikirim ke on_text; mengulang dari awal akan menduplikasi isi
+                    raise RuntimeError(f"Stream terputus karena kuota: {e}") from e
+                raise
+            return "".join(text_parts), usage
+        response_text = call_model_rate_limited(request, prompt, priority, span=span)
+
+        if use_cache and response_text and (cache_if is None or cache_if(response_text)):
+            llm_cache.set(cache_key, model.model_name, response_text)
+        return response_text
+
+class IncrementalJSONObjectParser:
+    """
+    Parser JSON bertahap untuk satu objek tingkat atas.
+    feed(chunk) mengembalikan pasangan (key, value) tingkat atas yang baru saja lengkap,
+    sehingga field bisa ditampilkan sebelum seluruh respons selesai. Teks di luar objek
+    (misal pagar ```json) diabaikan.
+    """
+    def __init__(self):
+        self.text = ""
+        self.fields = {}
+        self._pos = 0
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+        self._pair_start = None
+
+    def feed(self, chunk):
+        self.text += chunk
+        completed = []
+        text = self.text
+        for i in range(self._pos, len(text)):
+            ch = text[i]
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif ch == "\\":
+                    self._escape = True
+                elif ch == '"':
+                    self._in_string = False
+            elif ch == '"':
+                self._in_string = True
+            elif ch in "{[":
+                self._depth += 1
+                if self._depth == 1:
+                    self._pair_start = i + 1
+            elif ch in "}]":
+                if self._depth == 1:
+                    completed.extend(self._complete_pair(text[self._pair_start:i]))
+                self._depth = max(0, self._depth - 1)
+            elif ch == "," and self._depth == 1:
+                completed.extend(self._complete_pair(text[self._pair_start:i]))
+                self._pair_start = i + 1
+        self._pos = len(text)
+        return completed
+
+    def _complete_pair(self, pair_text):
+        if not pair_text.strip():
+            return []
+        try:
+            pair = json.loads("{" + pair_text + "}")
+        except ValueError:
+            return []
+        self.fields.update(pair)
+        return list(pair.items())
+
+def parse_budget_response(response_text):
+    """
+    Membaca jawaban AI budget: None untuk 'null'/kosong, float untuk angka polos (spasi diabaikan,
+    misal "17 500 000"). Format lain (termasuk titik ribuan "17.500.000") melempar ValueError.
+    """
+    result_text = (response_text or "").strip().lower()
+    if result_text == 'null' or not result_text:
+        return None
+    number_text = re.sub(r'\s', '', result_text)
+    if not re.fullmatch(r'\d+(?:\.\d+)?', number_text):
+        raise ValueError(number_text)
+    return float(number_text)
 
-@st.cache_data
+def is_valid_budget_response(response_text):
+    """Hanya jawaban yang bisa dibaca parse_budget_response (dan tidak kosong) yang disimpan di cache."""
+    try:
+        parse_budget_response(response_text)
+    except ValueError:
+        return False
+    return bool(response_text.strip())
 
-def analyze_budget_with_llm(text_description):
+def analyze_budget_with_llm(text_description, use_cache=True, priority=LLM_PRIORITY_INTERACTIVE):
     """
     Menggunakan LLM (Gemini) untuk menganalisis deskripsi teks,
-    menghitung total estimasi, dan mengembalikan HANYA ANGKA.
+    menghitung total estimasi, dan mengembalikan HANYA ANGKA (None jika AI menjawab 'null').
+    Dijalankan di thread job, jadi kegagalan dilempar sebagai exception (bukan st.error) agar
+    halaman yang mem-poll job bisa menampilkannya.
     """
     if not model or not text_description:
         return None
@@ -198,211 +960,1152 @@ def analyze_budget_with_llm(text_description):
     """
 
     try:
-        response = model.generate_content(prompt)
-        # Ambil teks mentah, hapus spasi, dan jadikan huruf kecil
-        result_text = response.text.strip().lower()
-
-        if result_text == 'null' or not result_text:
-            return None
-        else:
-            # Coba konversi langsung. Jika gagal, berarti AI tidak mengikuti aturan.
-            try:
-                # Hapus spasi ekstra jika ada (misal: "17 500 000" -> "17500000")
-                cleaned_num_str = re.sub(r'\s', '', result_text)
-                return float(cleaned_num_str) # Langsung konversi
-            except ValueError:
-                # AI Gagal mengikuti aturan. Tampilkan error.
-                st.error(f"Terjadi kesalahan saat analisis budget: AI mengembalikan teks yang tidak valid (bukan angka atau 'null'). Respons AI: '{result_text}'")
-                return None
-
+        response_text = generate_text(prompt, use_cache=use_cache, cache_if=is_valid_budget_response, priority=priority)
     except Exception as e:
-        st.error(f"Terjadi kesalahan fatal saat memanggil AI budget: {e}")
-        if 'response' in locals():
-            st.text_area("Teks mentah dari AI (Budget Analysis):", value=response.text)
-        return None
+        raise RuntimeError(f"Terjadi kesalahan fatal saat memanggil AI budget: {e}") from e
 
-def load_recipe(template_path):
-    """Memuat file resep .json berdasarkan path file template .pdf."""
-    # Mengganti ekstensi .pdf (atau .PDF) dengan .json
-    recipe_path = os.path.splitext(template_path)[0] + ".json"
     try:
-        with open(recipe_path, 'r', encoding='utf-8') as f:
-            return json.load(f)
-    except FileNotFoundError:
-        st.error(f"File resep tidak ditemukan di: {recipe_path}")
-        return None
-    except Exception as e:
-        st.error(f"Gagal memuat file resep '{os.path.basename(recipe_path)}': {e}")
-        return None
+        return parse_budget_response(response_text)
+    except ValueError:
+        # AI gagal mengikuti aturan; error dibawa ke job/pemanggil karena fungsi ini tidak menyentuh st.*
+        result_text = response_text.strip()
+        raise ValueError(f"AI mengembalikan teks yang tidak valid (bukan angka atau 'null'). Respons AI: '{result_text[:300]}'") from None
 
-def run_ai_first_pass(initial_prompt, file_uploads, all_placeholders, all_examples):
+class RecipeRegistry:
     """
-    Membangun prompt, memanggil AI, dan mengekstrak data JSON awal,
-    dengan tambahan output debugging.
+    Registry resep untuk seluruh proses: semua resep .json di bawah templates/ dimuat sekali,
+    dan untuk setiap set template disiapkan gabungan placeholder, contoh, dan formula _CALCULATED.
+    Resep dibaca ulang hanya jika mtime file-nya berubah.
     """
-    if not model:
-        st.error("Model AI tidak dikonfigurasi.")
-        return {"error": "MODEL_AI_TIDAK_TERKONFIGURASI"}
-
-    # Pastikan initial_prompt adalah string, meskipun kosong
-    prompt_text = initial_prompt if initial_prompt else ""
-
-    # --- Bagian Konstruksi Prompt (Sama seperti sebelumnya, tapi gunakan prompt_text) ---
-    json_format_string = json.dumps({key: "..." for key in all_placeholders if not key.endswith('_CALCULATED')}, indent=2)
-    context_text = ""
-    for upload_id, uploaded_file in file_uploads.items():
-        if uploaded_file:
-            file_content = get_text_from_file(uploaded_file)
-            if file_content:
-                 context_text += f"\n\n--- KONTEKS DARI DOKUMEN '{upload_id}' ---\n{file_content}"
-            else:
-                 st.warning(f"File '{upload_id}' diunggah tetapi tidak ada teks yang bisa diekstrak.")
-
-    combined_examples_str = json.dumps(all_examples, indent=2)
+    def __init__(self, templates_dir):
+        self.templates_dir = templates_dir
+        self._lock = threading.Lock()
+        self._recipe_files = {} # path tanpa ekstensi (huruf kecil) -> path file .json sebenarnya
+        self._recipes = {} # path file .json -> (mtime, data, error)
+        self._compiled_sets = {} # nama set -> (tanda_tangan_mtime, hasil)
+        self._scan()
+
+    def _scan(self):
+        """Memetakan semua file resep; ekstensi dicocokkan tanpa membedakan huruf besar/kecil (.json/.JSON)."""
+        recipe_files = {}
+        for root, _, files in os.walk(self.templates_dir):
+            for file_name in files:
+                base, ext = os.path.splitext(file_name)
+                if ext.lower() == ".json":
+                    recipe_files[os.path.join(root, base).lower()] = os.path.join(root, file_name)
+        self._recipe_files = recipe_files
+
+    def _recipe_path(self, template_path):
+        key = os.path.splitext(template_path)[0].lower()
+        recipe_path = self._recipe_files.get(key)
+        if recipe_path is None or not os.path.exists(recipe_path):
+            self._scan() # File baru/dipindah sejak pemindaian terakhir
+            recipe_path = self._recipe_files.get(key)
+        return recipe_path
+
+    def _load(self, recipe_path):
+        """Mengembalikan (mtime, data, error) — membaca ulang file hanya jika mtime berubah."""
+        mtime = os.path.getmtime(recipe_path)
+        cached = self._recipes.get(recipe_path)
+        if cached and cached[0] == mtime:
+            return cached
+        try:
+            with open(recipe_path, 'r', encoding='utf-8') as f:
+                entry = (mtime, json.load(f), None)
+        except Exception as e:
+            entry = (mtime, None, f"Gagal memuat file resep '{os.path.basename(recipe_path)}': {e}")
+        self._recipes[recipe_path] = entry
+        return entry
+
+    def get_recipe(self, template_path):
+        """Mengembalikan (data_resep, pesan_error) untuk sebuah path template .pdf."""
+        with self._lock:
+            recipe_path = self._recipe_path(template_path)
+            if recipe_path is None:
+                return None, f"File resep tidak ditemukan untuk: {template_path}"
+            _, data, error = self._load(recipe_path)
+            return data, error
+
+    def get_template_set(self, set_name):
+        """
+        Mengembalikan hasil kompilasi set template:
+        {"recipes": {pdf_path: resep}, "placeholders": {...}, "examples": {...},
+         "calculated": {key_CALCULATED: formula}, "formula_engine": FormulaEngine, "errors": [...]}.
+        Kompilasi diulang hanya jika salah satu resep anggotanya berubah.
+        """
+        with self._lock:
+            template_paths = TEMPLATE_SETS[set_name]
+            recipe_paths = [self._recipe_path(path) for path in template_paths]
+            signature = tuple(
+                (recipe_path, os.path.getmtime(recipe_path)) if recipe_path else (path, None)
+                for path, recipe_path in zip(template_paths, recipe_paths)
+            )
+            cached = self._compiled_sets.get(set_name)
+            if cached and cached[0] == signature:
+                return cached[1]
+
+            compiled = {"recipes": {}, "placeholders": {}, "examples": {}, "calculated": {}, "formula_engine": None, "errors": []}
+            for pdf_path, recipe_path in zip(template_paths, recipe_paths):
+                if recipe_path is None:
+                    compiled["errors"].append(f"File resep tidak ditemukan untuk: {pdf_path}")
+                    continue
+                _, recipe_data, error = self._load(recipe_path)
+                if error:
+                    compiled["errors"].append(error)
+                    continue
+                if not recipe_data or "placeholders" not in recipe_data or "examples" not in recipe_data:
+                    compiled["errors"].append(f"Struktur resep untuk {os.path.basename(pdf_path)} tidak valid.")
+                    continue
+                compiled["recipes"][pdf_path] = recipe_data
+                # Placeholder/contoh pertama yang ditemukan menang (urutan resep dalam set)
+                for key, value in recipe_data["placeholders"].items():
+                    compiled["placeholders"].setdefault(key, value)
+                    if key.endswith("_CALCULATED"):
+                        compiled["calculated"].setdefault(key, value)
+                for key, value in recipe_data["examples"].items():
+                    compiled["examples"].setdefault(key, value)
+            compiled["formula_engine"] = FormulaEngine(compiled["calculated"])
+
+            self._compiled_sets[set_name] = (signature, compiled)
+            return compiled
+
+@st.cache_resource
+def get_recipe_registry():
+    """Satu registry resep per proses."""
+    return RecipeRegistry(TEMPLATES_DIR)
+
+recipe_registry = get_recipe_registry()
+
+# Aturan statis prompt ekstraksi (disusun sekali, tanpa indentasi agar tidak membuang token)
+# Format JSON, tipe angka, dan bentuk tabel Bukti_BA/Pembelian dijamin oleh response_schema (build_response_schema)
+FIRST_PASS_RULES = """ATURAN PENTING:
+1. Fokus untuk mengisi field dalam format JSON ini: {fields}
+2. Jika Anda benar-benar tidak dapat menemukan informasi untuk sebuah field, JANGAN sertakan field tersebut.
+3. Gunakan NAMA FIELD (key) persis seperti yang diminta.
+4. Jangan menggunakan kapital di awal kalimat (kecuali singkatan) dan jangan memberi '.' di akhir kalimat.
+5. Parafrase kalimat agar tidak menyalin konteks, kecuali field yang meminta nomor, nama spesifik, atau Title.
+6. Prompt utama adalah sumber utama; gunakan konteks pendukung hanya jika informasi tidak ada di prompt utama.
+7. '/n' pada contoh berarti line break yang dianjurkan di placeholder tersebut."""
+
+def compact_json(data):
+    return json.dumps(data, ensure_ascii=False, separators=(",", ":"))
+
+def truncate_example(value, max_chars=PROMPT_EXAMPLE_MAX_CHARS, max_items=PROMPT_EXAMPLE_MAX_ITEMS):
+    """Memendekkan contoh: string dipotong ke max_chars, list hanya max_items elemen pertama."""
+    if isinstance(value, str):
+        return value if len(value) <= max_chars else value[:max_chars].rstrip() + "…"
+    if isinstance(value, list):
+        return [truncate_example(item, max_chars, max_items) for item in value[:max_items]]
+    if isinstance(value, dict):
+        return {key: truncate_example(item, max_chars, max_items) for key, item in value.items()}
+    return value
 
-    # --- PERUBAHAN: Pastikan f-string menggunakan variabel prompt_text ---
-    prompt = f"""
-    Anda adalah asisten AI yang sangat teliti, bertugas mengekstrak informasi sebanyak mungkin dari teks untuk mengisi beberapa dokumen resmi terkait.
-
-    TUGAS UTAMA:
-    Berdasarkan konteks utama dan dokumen pendukung, coba isi sebanyak mungkin field dalam format JSON di bawah ini. Field ini adalah gabungan dari beberapa dokumen yang akan dibuat.
-
-    KONTEKS UTAMA DARI PENGGUNA:
-    prompt utama: "{prompt_text}"
-    context pendukung: {context_text}
-
-    CONTOH LENGKAP OUTPUT YANG DIHARAPKAN (Ini adalah gabungan contoh, gunakan sebagai referensi gaya, panjang, dan format):
-    ```json
-    {combined_examples_str}
-    ```
-
-    ATURAN PENTING:
-    1.  Fokus untuk mengisi field dalam format JSON ini: {json_format_string}.
-    2.  Jika Anda benar-benar tidak dapat menemukan informasi untuk sebuah field, JANGAN sertakan field tersebut.
-    3.  Output HARUS berupa objek JSON yang valid.
-    4.  Jangan sertakan penjelasan atau markdown (seperti ```json). HANYA objek JSON.
-    5.  Gunakan NAMA FIELD (key) persis seperti yang diminta.
-    6.  Untuk field numerik, kembalikan ANGKA (integer/float), bukan string.
-    7.  Untuk field "Bukti_BA" dan "Pembelian", HARUS berupa ARRAY (list) dari OBJECTS JSON [{{ "NO": ..., "OBJEK": ..., "JUMLAH": ..., "DETAIL": ... }}].
-    8.  Jangan menggunakan kapital diawal kalimat, kecuali untuk singkatan
-    9.  Jangan memberi '.' diakhir kalimat
-    10. parafrase sebanyak mungkin untuk response kalimat, guna menghindari plagiasi dari konteks yang diberikan, kecuali untuk fileld yang memang meminta nomor, nama spesifik atau Title.
-    11. Prompt utama adalah sumber informasi utama, gunakan konteks pendukung hanya jika informasi tidak ada di prompt utama.
-    12. Apabila contoh ada '/n', maka itu line break yang dianjurkan ada disuatu placeholder.
-    """
-
-    # --- Bagian Debugging & Panggilan AI (Sama seperti sebelumnya) ---
-    with st.expander("👀 Lihat Prompt Lengkap yang Dikirim ke AI"):
-        st.code(prompt, language='markdown')
+def find_provided_fields(prompt_text, placeholders):
+    """
+    Placeholder yang nilainya sudah ditulis pengguna sebagai baris "Key: nilai" di prompt
+    (termasuk data tambahan dari spreadsheet). Contoh untuk field ini tidak perlu dikirim lagi.
+    """
+    normalize = lambda text: re.sub(r"[\s_]+", " ", text).strip().lower()
+    keys_by_name = {normalize(key): key for key in placeholders}
+    provided = set()
+    for match in re.finditer(r"^\s*([\w .()/-]{2,60}?)\s*:\s*\S", prompt_text or "", re.MULTILINE):
+        key = keys_by_name.get(normalize(match.group(1)))
+        if key:
+            provided.add(key)
+    return provided
+
+def build_first_pass_prompt(prompt_text, context_text, placeholders, examples, token_budget=PROMPT_TOKEN_BUDGET):
+    """
+    Menyusun prompt ekstraksi untuk sekumpulan placeholder beserta contoh-contohnya.
+    JSON ditulis tanpa spasi, contoh untuk field yang sudah diberikan pengguna dibuang dan contoh panjang
+    dipotong. Jika perkiraan token masih melebihi token_budget, contoh terpanjang dibuang satu per satu,
+    lalu konteks pendukung dipotong.
+    """
+    fields = [key for key in placeholders if not key.endswith('_CALCULATED')]
+    provided_lower = {key.lower() for key in find_provided_fields(prompt_text, fields)}
+    examples = {key: truncate_example(value) for key, value in examples.items() if key.lower() not in provided_lower}
+    rules = FIRST_PASS_RULES.format(fields=compact_json({key: "..." for key in fields}))
+
+    def render(examples, context_text):
+        examples_section = ""
+        if examples:
+            examples_section = f"\nCONTOH OUTPUT (referensi gaya, panjang, dan format):\n{compact_json(examples)}\n"
+        return (
+            "Anda adalah asisten AI yang sangat teliti, bertugas mengekstrak informasi sebanyak mungkin dari teks "
+            "untuk mengisi beberapa dokumen resmi terkait. Isi sebanyak mungkin field di bawah ini berdasarkan "
+            "konteks utama dan dokumen pendukung.\n\n"
+            f"KONTEKS UTAMA DARI PENGGUNA:\nprompt utama: \"{prompt_text}\"\ncontext pendukung: {context_text}\n"
+            f"{examples_section}\n{rules}"
+        )
 
-    raw_response_text = None
-    try:
-        response = model.generate_content(prompt)
-        if response and response.parts:
-            raw_response_text = response.parts[0].text
-        elif response and hasattr(response, 'text'):
-            raw_response_text = response.text
-        elif response and response.candidates and response.candidates[0].content and response.candidates[0].content.parts:
-            raw_response_text = response.candidates[0].content.parts[0].text
+    prompt = render(examples, context_text)
+    by_size = sorted(examples, key=lambda key: len(compact_json(examples[key])), reverse=True)
+    while estimate_tokens(prompt) > token_budget and by_size:
+        examples = {key: value for key, value in examples.items() if key != by_size[0]}
+        by_size.pop(0)
+        prompt = render(examples, context_text)
+    overflow_chars = (estimate_tokens(prompt) - token_budget) * 4
+    if overflow_chars > 0 and context_text:
+        prompt = render(examples, context_text[:max(0, len(context_text) - overflow_chars)] + "…")
+    return prompt
+
+def collect_upload_refs(uploaded_files):
+    """
+    Mengekstrak teks dokumen pendukung segera setelah form dikirim dan menyimpannya di upload_text_store.
+    Mengembalikan dict {nama_dokumen: ref}; objek UploadedFile (isi file mentah) tidak disimpan di session.
+    """
+    upload_refs = {}
+    for uploaded_file in uploaded_files or []:
+        file_digest, file_content = get_text_from_file(uploaded_file)
+        if file_content:
+            upload_refs[uploaded_file.name] = upload_text_store.put(uploaded_file.name, file_digest, file_content)
         else:
-            raw_response_text = "Respons AI tidak memiliki teks yang dapat dibaca."
+            st.warning(f"File '{uploaded_file.name}' diunggah tetapi tidak ada teks yang bisa diekstrak.")
+    return upload_refs
+
+def collect_upload_texts(upload_refs):
+    """Memuat teks dokumen pendukung dari ref-nya (tanpa st.*). Mengembalikan dict {nama_dokumen: teks}."""
+    upload_texts = {}
+    for upload_id, ref in upload_refs.items():
+        file_content = upload_text_store.get(ref)
+        if file_content:
+            upload_texts[upload_id] = file_content
+    return upload_texts
+
+# --- Retrieval Konteks Dokumen Pendukung ---
+_RETRIEVAL_STOPWORDS = {
+    "yang", "dan", "di", "ke", "dari", "untuk", "dengan", "ini", "itu", "atau", "pada", "dalam", "akan",
+    "the", "of", "in", "to", "and", "a", "an", "is", "for", "be", "if", "then", "else", "will",
+}
+
+def estimate_tokens(text):
+    """Perkiraan kasar jumlah token (sekitar 4 karakter per token)."""
+    return len(text) // 4 + 1
+
+def tokenize_for_retrieval(text):
+    return [token for token in re.findall(r'\w+', text.lower()) if len(token) > 1 and token not in _RETRIEVAL_STOPWORDS]
+
+def split_into_chunks(text, chunk_chars=RETRIEVAL_CHUNK_CHARS, overlap_chars=RETRIEVAL_CHUNK_OVERLAP_CHARS):
+    """Memecah teks menjadi potongan berukuran ~chunk_chars, dipotong di batas baris/spasi, dengan sedikit tumpang tindih."""
+    chunks = []
+    start = 0
+    while start < len(text):
+        end = min(len(text), start + chunk_chars)
+        if end < len(text):
+            cut = text.rfind("\n", start + chunk_chars // 2, end)
+            if cut == -1:
+                cut = text.rfind(" ", start + chunk_chars // 2, end)
+            if cut > start:
+                end = cut
+        chunk = text[start:end].strip()
+        if chunk:
+            chunks.append(chunk)
+        if end >= len(text):
+            break
+        start = max(end - overlap_chars, start + 1)
+    return chunks
+
+class BM25Index:
+    """Indeks BM25 sederhana di memori atas sekumpulan potongan teks."""
+    def __init__(self, texts, k1=1.5, b=0.75):
+        self.k1 = k1
+        self.b = b
+        self.term_freqs = [Counter(tokenize_for_retrieval(text)) for text in texts]
+        self.lengths = [sum(freqs.values()) for freqs in self.term_freqs]
+        self.avg_length = (sum(self.lengths) / len(self.lengths)) if self.lengths else 0.0
+        doc_freqs = Counter(term for freqs in self.term_freqs for term in freqs)
+        n_docs = len(texts)
+        self.idf = {term: math.log(1 + (n_docs - df + 0.5) / (df + 0.5)) for term, df in doc_freqs.items()}
+
+    def search(self, query, top_k):
+        """Mengembalikan indeks potongan dengan skor tertinggi (skor > 0), terurut menurun."""
+        query_terms = set(tokenize_for_retrieval(query))
+        scores = []
+        for i, freqs in enumerate(self.term_freqs):
+            score = 0.0
+            length_norm = self.k1 * (1 - self.b + self.b * self.lengths[i] / (self.avg_length or 1))
+            for term in query_terms:
+                tf = freqs.get(term)
+                if tf:
+                    score += self.idf[term] * tf * (self.k1 + 1) / (tf + length_norm)
+            if score > 0:
+                scores.append((score, i))
+        scores.sort(reverse=True)
+        return [i for _, i in scores[:top_k]]
+
+class UploadRetrievalIndex:
+    """
+    Indeks retrieval per permintaan atas teks dokumen pendukung.
+    Jika seluruh teks muat dalam anggaran token, konteks dikirim utuh seperti sebelumnya;
+    jika tidak, hanya top-k potongan yang relevan untuk setiap placeholder yang dipilih.
+    """
+    def __init__(self, upload_texts, token_budget=RETRIEVAL_CONTEXT_TOKEN_BUDGET):
+        self.upload_texts = upload_texts
+        self.total_tokens = sum(estimate_tokens(text) for text in upload_texts.values())
+        self.chunks = [] # (nama_dokumen, teks_potongan)
+        self._index = None
+        if self.total_tokens > token_budget:
+            for doc_name, text in upload_texts.items():
+                self.chunks.extend((doc_name, chunk) for chunk in split_into_chunks(text))
+            self._index = BM25Index([chunk for _, chunk in self.chunks])
+
+    def context_for(self, placeholders, token_budget=RETRIEVAL_CONTEXT_TOKEN_BUDGET, top_k=RETRIEVAL_TOP_K):
+        """Menyusun teks konteks untuk sekumpulan placeholder dalam batas token_budget."""
+        if self._index is None:
+            return "".join(f"\n\n--- KONTEKS DARI DOKUMEN '{doc_name}' ---\n{text}"
+                           for doc_name, text in self.upload_texts.items())
+
+        ranked_per_placeholder = []
+        for key, value_obj in placeholders.items():
+            if key.endswith("_CALCULATED"):
+                continue
+            query = key.replace("_", " ")
+            if isinstance(value_obj, dict):
+                query += f" {value_obj.get('instruction') or ''} {value_obj.get('description') or ''}"
+            ranked_per_placeholder.append(self._index.search(query, top_k))
+
+        # Pilih bergiliran per peringkat (peringkat 1 semua placeholder dulu, lalu peringkat 2, dst.)
+        # agar anggaran token tidak dihabiskan oleh satu placeholder saja
+        selected = set()
+        used_tokens = 0
+        for rank in range(top_k):
+            for ranked in ranked_per_placeholder:
+                if rank < len(ranked) and ranked[rank] not in selected:
+                    chunk_tokens = estimate_tokens(self.chunks[ranked[rank]][1])
+                    if used_tokens + chunk_tokens <= token_budget:
+                        selected.add(ranked[rank])
+                        used_tokens += chunk_tokens
+
+        context_text = ""
+        current_doc = None
+        for i in sorted(selected): # Urutan asli dokumen dipertahankan
+            doc_name, chunk = self.chunks[i]
+            if doc_name != current_doc:
+                context_text += f"\n\n--- KONTEKS DARI DOKUMEN '{doc_name}' (potongan relevan) ---"
+                current_doc = doc_name
+            context_text += f"\n{chunk}\n[...]"
+        return context_text
+
+def extract_response_text(response):
+    """Mengambil teks dari objek respons Gemini, atau None jika tidak ada teks."""
+    if response and response.parts:
+        return response.parts[0].text
+    elif response and hasattr(response, 'text'):
+        return response.text
+    elif response and response.candidates and response.candidates[0].content and response.candidates[0].content.parts:
+        return response.candidates[0].content.parts[0].text
+    return None
+
+def parse_ai_json_object(raw_response_text):
+    """Mem-parse respons structured output (application/json) sebagai objek JSON."""
+    if not raw_response_text or not raw_response_text.strip():
+        raise ValueError("Respons AI kosong.")
+    parsed_json = json.loads(raw_response_text)
+    if not isinstance(parsed_json, dict):
+        raise ValueError("Respons AI bukan objek JSON.")
+    return parsed_json
+
+def is_valid_json_object_response(response_text):
+    try:
+        parse_ai_json_object(response_text)
+        return True
+    except ValueError: # json.JSONDecodeError adalah turunan ValueError
+        return False
 
-        with st.expander("👀 Lihat Respons Mentah dari AI"):
-             st.text(raw_response_text if raw_response_text else "Tidak ada respons teks.")
+# --- Structured Output (Skema Respons) ---
+# Field tabel (list of dict); kolom diambil dari contoh resep, atau kolom default jika contohnya bukan tabel
+TABLE_FIELDS = ("Bukti_BA", "Pembelian")
+TABLE_DEFAULT_COLUMNS = ("NO", "OBJEK", "JUMLAH", "UNIT", "DETAIL")
 
-        if not raw_response_text or raw_response_text == "Respons AI tidak memiliki teks yang dapat dibaca.":
-             st.error("AI tidak mengembalikan teks respons.")
-             return {"error": "AI tidak mengembalikan teks."}
+def json_generation_config(response_schema):
+    return {"response_mime_type": "application/json", "response_schema": response_schema}
 
-        json_string = raw_response_text.strip().replace("```json", "").replace("```", "").strip()
+def is_numeric_placeholder(value_obj):
+    """Placeholder numerik: instruction None atau angka (aturan yang sama dengan formulir verifikasi)."""
+    instruction = value_obj.get("instruction") if isinstance(value_obj, dict) else value_obj
+    return instruction is None or (isinstance(instruction, (int, float)) and not isinstance(instruction, bool))
 
-        if not json_string:
-             st.error("Setelah dibersihkan, respons AI kosong.")
-             return {"error": "Respons AI kosong setelah dibersihkan."}
+def build_response_schema(placeholders, examples=None):
+    """
+    Skema respons Gemini dari placeholder resep: field numerik bertipe number, Bukti_BA/Pembelian
+    berupa array of object, sisanya string. Tidak ada field wajib, jadi field yang tidak ditemukan boleh dihilangkan.
+    """
+    examples_lower = {key.lower(): value for key, value in (examples or {}).items()}
+    properties = {}
+    for key, value_obj in placeholders.items():
+        if key.endswith("_CALCULATED"):
+            continue
+        if key in TABLE_FIELDS:
+            example = examples_lower.get(key.lower())
+            columns = list(dict.fromkeys(column for row in example for column in row)) if (
+                isinstance(example, list) and example and all(isinstance(row, dict) for row in example)) else TABLE_DEFAULT_COLUMNS
+            properties[key] = {"type": "array", "items": {"type": "object",
+                                                          "properties": {column: {"type": "string"} for column in columns}}}
+        elif is_numeric_placeholder(value_obj):
+            properties[key] = {"type": "number", "nullable": True}
+        else:
+            properties[key] = {"type": "string", "nullable": True}
+    return {"type": "object", "properties": properties}
 
-        parsed_json = json.loads(json_string)
-        return parsed_json
+def coerce_to_schema(data, response_schema):
+    """
+    Mencocokkan data hasil AI dengan skema. Angka yang ditulis sebagai teks dibersihkan dengan clean_currency
+    dan tabel yang ditulis sebagai teks JSON di-parse secara lokal. Nilai null dianggap tidak ditemukan.
+    Mengembalikan (data_valid, field_tidak_valid).
+    """
+    valid, invalid = {}, []
+    for key, value in data.items():
+        field_schema = response_schema["properties"].get(key)
+        if value is None:
+            continue
+        if field_schema is None: # Key di luar skema diteruskan apa adanya (digabung oleh merge_partial_results)
+            valid[key] = value
+        elif field_schema["type"] == "number":
+            number = value if isinstance(value, (int, float)) and not isinstance(value, bool) else clean_currency(value)
+            if number is None:
+                invalid.append(key)
+            else:
+                valid[key] = number
+        elif field_schema["type"] == "array":
+            if isinstance(value, str):
+                try:
+                    value = json.loads(value)
+                except ValueError:
+                    pass
+            if isinstance(value, list) and all(isinstance(row, dict) for row in value):
+                valid[key] = value
+            else:
+                invalid.append(key)
+        elif isinstance(value, (dict, list)):
+            invalid.append(key)
+        else:
+            valid[key] = value if isinstance(value, str) else str(value)
+    return valid, invalid
 
+def repair_invalid_fields(prompt, invalid_fields, response_schema, use_cache=True, priority=LLM_PRIORITY_INTERACTIVE):
+    """
+    Meminta ulang HANYA field yang tidak sesuai skema, dengan skema yang dipersempit ke field tersebut.
+    Mengembalikan (data_valid, field_yang_tetap_tidak_valid).
+    """
+    repair_schema = {"type": "object", "properties": {key: response_schema["properties"][key] for key in invalid_fields}}
+    repair_prompt = (f"{prompt}\n\nPERBAIKAN: respons sebelumnya tidak sesuai format untuk field berikut. "
+                     f"Kembalikan HANYA field ini: {compact_json(list(invalid_fields))}")
+    with timed_span("schema_repair", fields=len(invalid_fields), priority=priority) as span:
+        try:
+            response_text = generate_text(repair_prompt, generation_config=json_generation_config(repair_schema),
+                                          use_cache=use_cache, cache_if=is_valid_json_object_response, priority=priority)
+            data = parse_ai_json_object(response_text)
+        except ValueError:
+            data = {}
+        repaired, still_invalid = coerce_to_schema(
+            {key: value for key, value in data.items() if key in repair_schema["properties"]}, repair_schema)
+        still_invalid += [key for key in invalid_fields if key not in repaired and key not in still_invalid]
+        span["still_invalid"] = len(still_invalid)
+        return repaired, still_invalid
+
+def request_extraction(prompt, use_cache=True, on_field=None, priority=LLM_PRIORITY_INTERACTIVE, generation_config=None):
+    """
+    Satu permintaan ekstraksi ke AI. Mengembalikan (result, terpotong): result berbentuk seperti pada
+    call_ai_extraction; jika JSON-nya terpotong tetapi sebagian field sudah diterima, field itu tetap dipakai.
+    """
+    result = {"raw": None, "data": None, "error": None, "warning": None, "repaired": [], "retried": False}
+    parser = IncrementalJSONObjectParser() if on_field else None
+    try:
+        if parser:
+            def on_text(text):
+                for key, value in parser.feed(text):
+                    on_field(key, value)
+            raw_response_text = generate_text_stream(prompt, on_text, generation_config=generation_config, use_cache=use_cache,
+                                                     cache_if=is_valid_json_object_response, priority=priority)
+        else:
+            raw_response_text = generate_text(prompt, generation_config=generation_config, use_cache=use_cache,
+                                              cache_if=is_valid_json_object_response, priority=priority)
+        result["raw"] = raw_response_text
+        if not raw_response_text:
+            result["error"] = "AI tidak mengembalikan teks."
+        else:
+            result["data"] = parse_ai_json_object(raw_response_text)
     except json.JSONDecodeError as json_err:
-        error_message = f"Gagal mem-parse JSON dari AI: {json_err}. Respons mentah ada di atas."
-        st.error(error_message)
-        return {"error": error_message}
+        result["error"] = f"Gagal mem-parse JSON dari AI: {json_err}."
+    except ValueError as value_err:
+        result["error"] = str(value_err)
     except Exception as e:
-        error_message = f"Terjadi kesalahan saat memanggil atau memproses respons AI: {e}"
-        st.error(error_message)
-        return {"error": error_message}
+        result["error"] = f"Terjadi kesalahan saat memanggil atau memproses respons AI: {e}"
+
+    truncated = result["data"] is None
+    if truncated and not parser and result["raw"]:
+        parser = IncrementalJSONObjectParser()
+        parser.feed(result["raw"])
+    if truncated and parser and parser.fields:
+        result["raw"] = result["raw"] or parser.text
+        result["data"] = dict(parser.fields)
+        result["warning"] = (f"Respons AI terpotong ({result['error']}); "
+                             f"{len(parser.fields)} field yang sudah diterima tetap dipakai.")
+        result["error"] = None
+    return result, truncated
+
+def call_ai_extraction(prompt, use_cache=True, on_field=None, priority=LLM_PRIORITY_INTERACTIVE, response_schema=None):
+    """
+    Memanggil AI untuk satu prompt ekstraksi dan mem-parse JSON hasilnya.
+    Tidak memanggil st.* sama sekali agar aman dijalankan dari thread pekerja;
+    mengembalikan dict {"raw": ..., "data": ..., "error": ..., "warning": ..., "repaired": [...], "retried": bool}.
+    Jika on_field diberikan, respons di-stream dan on_field(key, value) dipanggil untuk setiap
+    field yang sudah lengkap. Bila respons terpotong, field yang sudah diterima tetap dipakai.
+    Dengan response_schema, respons diminta dalam mode structured output. Jika sebagian field diterima,
+    field yang tidak sesuai skema (atau belum diterima karena respons terpotong) diminta ulang lewat
+    repair_invalid_fields; jika tidak ada satu field pun, permintaan yang sama diulang sekali saja.
+    """
+    generation_config = json_generation_config(response_schema) if response_schema else None
+    result, truncated = request_extraction(prompt, use_cache, on_field, priority, generation_config)
+    if not response_schema:
+        return result
+    if result["data"] is None:
+        result, truncated = request_extraction(prompt, use_cache, on_field, priority, generation_config)
+        result["retried"] = True
+        if result["data"] is None:
+            return result
+
+    data, invalid = coerce_to_schema(result["data"], response_schema)
+    if truncated:
+        invalid += [key for key in response_schema["properties"] if key not in data and key not in invalid]
+    if invalid:
+        repaired, still_invalid = repair_invalid_fields(prompt, invalid, response_schema, use_cache, priority)
+        data.update(repaired)
+        result["repaired"] = sorted(repaired)
+        if on_field:
+            for key, value in repaired.items():
+                on_field(key, value)
+        if still_invalid and not truncated:
+            result["warning"] = f"Field tidak sesuai format dan gagal diperbaiki AI: {', '.join(still_invalid)}"
+    result["data"] = data
+    return result
+
+def placeholder_label(key, value_obj):
+    """Label field pada formulir verifikasi; field yang diisi AI diberi awalan "(AI)"."""
+    label = f"{key.replace('_', ' ').title()}:"
+    instruction_or_default = value_obj.get("instruction") if isinstance(value_obj, dict) else value_obj
+    if isinstance(instruction_or_default, str) and instruction_or_default.startswith("{"):
+        label = f"(AI) {label}"
+    return label
+
+def verification_widget_value(value_obj, value):
+    """
+    Nilai AI dalam bentuk yang diterima widget formulir verifikasi: teks untuk field teks/AI,
+    angka (atau None) untuk number_input. Dipakai untuk nilai awal maupun hasil regenerasi field.
+    """
+    instruction_or_default = value_obj.get("instruction") if isinstance(value_obj, dict) else value_obj
+    if isinstance(instruction_or_default, str):
+        return str(value) if value is not None else ""
+    if value is None or (isinstance(value, (int, float)) and not isinstance(value, bool)):
+        return value
+    # [ORIGINAL] Pembersihan regex untuk angka
+    try:
+        cleaned_val_str = re.sub(r'(IDR|\s|,-?$)', '', str(value))
+        if cleaned_val_str:
+            return float(cleaned_val_str) if '.' in cleaned_val_str else int(cleaned_val_str)
+    except ValueError:
+        pass
+    return None
+
+def create_live_field_slots(placeholders):
+    """Menyiapkan satu slot st.empty per placeholder (urutan sama dengan formulir verifikasi)."""
+    live_container = st.container(border=True)
+    live_container.markdown("**Data yang sudah diterima dari AI:**")
+    field_slots = {}
+    for key, value_obj in placeholders.items():
+        if not key.endswith("_CALCULATED"):
+            field_slots[key] = (live_container.empty(), placeholder_label(key, value_obj))
+            field_slots[key][0].caption(f"⏳ {field_slots[key][1]} menunggu...")
+    return field_slots
+
+def show_live_fields(placeholders, progress):
+    """Menampilkan semua field yang sudah diterima (progress: daftar (key, value) dari job ekstraksi)."""
+    field_slots = create_live_field_slots(placeholders)
+    for key, value in progress:
+        show_live_field(field_slots, key, value)
+
+def show_live_field(field_slots, key, value):
+    if key not in field_slots:
+        return
+    slot, label = field_slots[key]
+    value_text = value if isinstance(value, str) else json.dumps(value, ensure_ascii=False)
+    if len(value_text) > 300:
+        value_text = value_text[:300] + "..."
+    slot.markdown(f"✅ **{label}** {value_text}")
+
+def run_extraction_prompts(prompts, use_cache=True, on_field=None, field_owner=None, priority=LLM_PRIORITY_INTERACTIVE,
+                           response_schemas=None):
+    """
+    Menjalankan beberapa prompt ekstraksi bersamaan di thread pool (response_schemas: satu skema per prompt).
+    Jika on_field diberikan (mode streaming), on_field(key, value) dipanggil dari thread pekerja
+    untuk setiap field yang sudah lengkap. field_owner (key -> indeks prompt) memastikan field
+    hanya dilaporkan oleh prompt yang memiliki key tersebut.
+    """
+    def make_on_field(prompt_index):
+        if on_field is None:
+            return None
+        def report_field(key, value):
+            if field_owner is None or field_owner.get(key, prompt_index) == prompt_index:
+                on_field(key, value)
+        return report_field
+
+    max_workers = max(1, min(AI_EXTRACTION_MAX_WORKERS, len(prompts)))
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(call_ai_extraction, prompt, use_cache, make_on_field(i), priority,
+                                   response_schemas[i] if response_schemas else None)
+                   for i, prompt in enumerate(prompts)]
+        return [future.result() for future in futures]
+
+def split_placeholders_by_recipe(recipes):
+    """
+    Membagi placeholder menjadi satu grup per resep untuk ekstraksi paralel.
+    Placeholder yang dipakai beberapa resep hanya diminta sekali, yaitu pada resep
+    pertama yang mendefinisikannya (urutan yang sama dengan penggabungan all_placeholders).
+    Mengembalikan list of (nama_dokumen, placeholders, examples).
+    """
+    groups = []
+    assigned_keys = set()
+    for pdf_path, recipe_data in recipes.items():
+        own_placeholders = {
+            key: value for key, value in recipe_data.get("placeholders", {}).items()
+            if not key.endswith("_CALCULATED") and key not in assigned_keys
+        }
+        if not own_placeholders:
+            continue
+        assigned_keys.update(own_placeholders)
+        # Contoh dicocokkan tanpa membedakan huruf besar/kecil (misal: Pembelian_Summary vs Pembelian_summary)
+        own_keys_lower = {key.lower() for key in own_placeholders}
+        own_examples = {
+            key: value for key, value in recipe_data.get("examples", {}).items()
+            if key.lower() in own_keys_lower
+        }
+        groups.append((os.path.basename(pdf_path), own_placeholders, own_examples))
+    return groups
+
+def merge_partial_results(groups, results):
+    """
+    Menggabungkan hasil JSON parsial dari setiap grup menjadi satu dict.
+    Aturan konflik:
+    1. Nilai sebuah key diambil dari grup yang "memiliki" key tersebut.
+    2. Key tambahan yang dikembalikan grup lain hanya dipakai jika key itu belum terisi,
+       mengikuti urutan resep (resep pertama menang).
+    3. Nilai kosong (None atau string kosong) tidak pernah menimpa nilai yang sudah ada.
+    """
+    def is_empty(value):
+        return value is None or (isinstance(value, str) and not value.strip())
+
+    merged = {}
+    for (_, placeholders, _), result in zip(groups, results):
+        data = result.get("data") or {}
+        for key in placeholders:
+            if key in data and not is_empty(data[key]):
+                merged[key] = data[key]
+    for result in results:
+        data = result.get("data") or {}
+        for key, value in data.items():
+            if key not in merged and not is_empty(value):
+                merged[key] = value
+    return merged
+
+def extract_initial_data(prompt_text, upload_texts, recipes, all_placeholders, all_examples,
+                         mode="parallel", use_cache=True, on_field=None, priority=LLM_PRIORITY_INTERACTIVE,
+                         known_data=None):
+    """
+    Ekstraksi awal tanpa st.* (aman dijalankan sebagai job latar belakang).
+    Mode "parallel": satu prompt kecil per resep, dikirim bersamaan lalu digabung dengan
+    merge_partial_results. Mode "single": satu prompt untuk semua placeholder.
+    Field di known_data (misal dari riwayat proyek) tidak dikirim ke AI dan menjadi dasar hasil;
+    jika semua field sudah diketahui, AI tidak dipanggil sama sekali.
+    Mengembalikan {"data", "error", "warnings", "debug"}; debug berisi (nama_dokumen, prompt, respons_mentah).
+    """
+    known_data = known_data or {}
+    with timed_span("first_pass_extraction", mode=mode, priority=priority) as span:
+        report = {"data": {}, "error": None, "warnings": [], "debug": []}
+        if not model:
+            report["error"] = "Model AI tidak dikonfigurasi."
+            return report
+
+        # Setiap grup mendapat potongan konteks yang relevan dengan placeholder miliknya sendiri
+        retrieval_index = UploadRetrievalIndex(upload_texts)
+        if mode == "single":
+            groups = [("Semua dokumen", all_placeholders, all_examples)]
+        else:
+            groups = split_placeholders_by_recipe(recipes)
+        if not groups:
+            report["error"] = "Tidak ada placeholder yang perlu diekstrak dari resep yang dipilih."
+            return report
+        if known_data:
+            known_lower = {key.lower() for key in known_data}
+            groups = [(doc_name, {key: value for key, value in placeholders.items() if key not in known_data},
+                       {key: value for key, value in examples.items() if key.lower() not in known_lower})
+                      for doc_name, placeholders, examples in groups]
+            groups = [group for group in groups if any(not key.endswith("_CALCULATED") for key in group[1])]
+            span["known_fields"] = len(known_data)
+            for key, value in known_data.items():
+                if on_field:
+                    on_field(key, value)
+            if not groups:
+                report["data"] = dict(known_data)
+                return report
+
+        prompts = [build_first_pass_prompt(prompt_text or "", retrieval_index.context_for(placeholders), placeholders, examples)
+                   for _, placeholders, examples in groups]
+        response_schemas = [build_response_schema(placeholders, examples) for _, placeholders, examples in groups]
+        field_owner = {key: i for i, (_, placeholders, _) in enumerate(groups) for key in placeholders}
+        span.update(groups=len(groups), prompt_chars=sum(len(prompt) for prompt in prompts),
+                    prompt_tokens=sum(estimate_tokens(prompt) for prompt in prompts))
+        results = run_extraction_prompts(prompts, use_cache=use_cache, on_field=on_field, field_owner=field_owner, priority=priority,
+                                         response_schemas=response_schemas)
+        span["repaired_fields"] = sum(len(result["repaired"]) for result in results)
+        span["retried_prompts"] = sum(result["retried"] for result in results)
+        report["debug"] = [(doc_name, prompt, result["raw"]) for (doc_name, _, _), prompt, result in zip(groups, prompts, results)]
+
+        errors = [f"{doc_name}: {result['error']}" for (doc_name, _, _), result in zip(groups, results) if result["error"]]
+        if len(errors) == len(groups):
+            report["error"] = "Ekstraksi AI gagal untuk semua dokumen. " + " | ".join(errors)
+            return report
+        report["warnings"] = [f"Ekstraksi AI sebagian gagal ({error}). Field dari dokumen ini perlu diisi manual." for error in errors]
+        report["warnings"].extend(f"{doc_name}: {result['warning']}" for (doc_name, _, _), result in zip(groups, results) if result["warning"])
+        report["data"] = {**known_data, **merge_partial_results(groups, results)}
+        return report
+
+def build_field_regeneration_prompt(key, value_obj, example, prompt_text, context_text, current_value=None):
+    """Prompt kecil untuk satu placeholder: instruction, description, contoh, dan konteks yang relevan saja."""
+    instruction = value_obj.get("instruction") if isinstance(value_obj, dict) else value_obj
+    description = value_obj.get("description") if isinstance(value_obj, dict) else None
+    lines = [f"Anda mengisi ulang SATU field \"{key}\" untuk dokumen resmi pengadaan berdasarkan konteks berikut."]
+    if isinstance(instruction, str) and instruction:
+        lines.append(f"Instruksi field: {instruction}")
+    if description:
+        lines.append(f"Deskripsi field: {description}")
+    if example is not None:
+        lines.append(f"Contoh (referensi gaya, panjang, dan format): {compact_json(truncate_example(example))}")
+    if current_value not in (None, ""):
+        lines.append(f"Nilai saat ini (buat versi yang lebih baik, jangan disalin): {compact_json(current_value)}")
+    lines.append(f"\nKONTEKS UTAMA DARI PENGGUNA:\nprompt utama: \"{prompt_text}\"\ncontext pendukung: {context_text}\n")
+    lines.append(FIRST_PASS_RULES.format(fields=compact_json({key: "..."})))
+    return "\n".join(lines)
+
+def regenerate_fields(field_keys, prompt_text, upload_texts, placeholders, examples, current_values=None,
+                      use_cache=False, priority=LLM_PRIORITY_INTERACTIVE):
+    """
+    Regenerasi beberapa field tanpa mengulang ekstraksi penuh: satu prompt kecil (structured output) per field,
+    dikirim bersamaan. Cache dilewati secara default karena pengguna meminta jawaban baru.
+    Tanpa st.* (dijalankan sebagai job). Mengembalikan {"data": {key: nilai}, "errors": [...]}.
+    """
+    current_values = current_values or {}
+    with timed_span("field_regeneration", fields=len(field_keys), priority=priority) as span:
+        retrieval_index = UploadRetrievalIndex(upload_texts, token_budget=FIELD_REGEN_CONTEXT_TOKENS)
+        examples_lower = {key.lower(): value for key, value in examples.items()}
+        prompts = [
+            build_field_regeneration_prompt(
+                key, placeholders[key], examples_lower.get(key.lower()), prompt_text or "",
+                retrieval_index.context_for({key: placeholders[key]}, token_budget=FIELD_REGEN_CONTEXT_TOKENS),
+                current_values.get(key))
+            for key in field_keys
+        ]
+        span["prompt_tokens"] = sum(estimate_tokens(prompt) for prompt in prompts)
+        results = run_extraction_prompts(prompts, use_cache=use_cache, priority=priority,
+                                         response_schemas=[build_response_schema({key: placeholders[key]}, examples)
+                                                           for key in field_keys])
+        regenerated, errors = {}, []
+        for key, result in zip(field_keys, results):
+            value = (result["data"] or {}).get(key)
+            if value is None or (isinstance(value, str) and not value.strip()):
+                errors.append(f"{key}: {result['error'] or 'AI tidak mengembalikan nilai'}")
+            else:
+                regenerated[key] = value
+        span["failed"] = len(errors)
+        return {"data": regenerated, "errors": errors}
+
+def show_first_pass_report(report):
+    """Menampilkan prompt, respons mentah, error, dan peringatan dari extract_initial_data (thread utama)."""
+    with st.expander("👀 Lihat Prompt Lengkap yang Dikirim ke AI"):
+        for doc_name, prompt, _ in report["debug"]:
+            st.markdown(f"**{doc_name}**")
+            st.code(prompt, language='markdown')
+    with st.expander("👀 Lihat Respons Mentah dari AI"):
+        for doc_name, _, raw in report["debug"]:
+            st.markdown(f"**{doc_name}**")
+            st.text(raw if raw else "Tidak ada respons teks.")
+    if report["error"]:
+        st.error(report["error"])
+    for warning in report["warnings"]:
+        st.warning(warning)
+
+@st.cache_resource
+def get_pdf_process_pool():
+    """Process pool bersama untuk ekstraksi PDF besar (dibuat sekali per proses)."""
+    # "spawn" karena proses Streamlit sudah memiliki banyak thread (fork tidak aman)
+    return ProcessPoolExecutor(max_workers=PDF_EXTRACTION_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+
+class ExtractionTimeout(Exception):
+    """Ekstraksi dihentikan oleh batas waktu; membawa teks parsial dan catatannya."""
+
+    def __init__(self, text, notes):
+        super().__init__(notes[-1])
+        self.text = text
+        self.notes = notes
+
+def extract_pdf_text(file_stream, file_buffer=None):
+    """
+    Mengekstrak teks PDF dengan batas jumlah halaman dan waktu.
+    PDF besar dibagi per rentang halaman dan diekstrak paralel di process pool;
+    file_buffer (isi file) hanya disalin untuk jalur paralel tersebut.
+    Mengembalikan (teks, catatan) — catatan berisi pesan jika batas halaman tercapai.
+    Jika batas waktu tercapai, ExtractionTimeout dilempar dengan teks yang sempat terbaca.
+    """
+    with timed_span("pdf_extraction") as span:
+        notes = []
+        deadline = time.time() + PDF_EXTRACTION_TIMEOUT_S
+        reader = lazy_import("pypdf").PdfReader(file_stream)
+        total_pages = len(reader.pages)
+        pages_to_read = min(total_pages, PDF_MAX_PAGES)
+        span.update(pages=pages_to_read, total_pages=total_pages)
+        if pages_to_read < total_pages:
+            notes.append(f"Hanya {pages_to_read} dari {total_pages} halaman yang dibaca (batas PDF_MAX_PAGES).")
+
+        if file_buffer is not None and pages_to_read >= PDF_PARALLEL_MIN_PAGES and PDF_EXTRACTION_WORKERS > 1:
+            file_bytes = bytes(file_buffer)
+            pages_per_task = -(-pages_to_read // PDF_EXTRACTION_WORKERS) # Pembulatan ke atas
+            page_ranges = [(start, min(start + pages_per_task, pages_to_read))
+                           for start in range(0, pages_to_read, pages_per_task)]
+            pool = get_pdf_process_pool()
+            futures = [pool.submit(extract_pdf_page_range, file_bytes, start, end, deadline) for start, end in page_ranges]
+            done, not_done = wait(futures, timeout=max(0.0, deadline - time.time()) + 5)
+            page_texts = []
+            timed_out = bool(not_done)
+            for future in futures: # Urutan halaman dipertahankan
+                if future in done:
+                    range_texts, finished = future.result()
+                    page_texts.extend(range_texts)
+                    timed_out = timed_out or not finished
+                else:
+                    future.cancel()
+        else:
+            page_texts = list(iter_pdf_page_texts(reader, 0, pages_to_read, deadline))
+            timed_out = time.time() > deadline
+
+        span.update(parallel=file_buffer is not None and pages_to_read >= PDF_PARALLEL_MIN_PAGES and PDF_EXTRACTION_WORKERS > 1,
+                    timed_out=timed_out)
+        if timed_out:
+            notes.append(f"Ekstraksi dihentikan setelah {PDF_EXTRACTION_TIMEOUT_S:g} detik; teks yang terbaca sebagian saja.")
+            raise ExtractionTimeout("\n".join(page_texts), notes)
+        return "\n".join(page_texts), notes
+
+@st.cache_data(max_entries=64, show_spinner=False)
+def extract_text_cached(file_digest, mime_type, _file_stream, _file_buffer):
+    """
+    Ekstraksi teks yang di-cache berdasarkan SHA-256 isi file (file_digest), bukan isi file itu sendiri,
+    sehingga file yang sama tidak diekstrak ulang pada rerun atau pengiriman ulang. Hasil yang terpotong
+    batas halaman tetap di-cache; ExtractionTimeout diteruskan sehingga hasil parsialnya tidak di-cache.
+    """
+    if mime_type == "application/pdf":
+        _file_stream.seek(0)
+        return extract_pdf_text(_file_stream, _file_buffer)
+    if mime_type == "text/plain":
+        return str(_file_buffer, "utf-8"), []
+    return "", []
+
+def extract_text(file_digest, mime_type, file_stream, file_buffer):
+    """
+    Seperti extract_text_cached, tetapi ekstraksi yang terhenti karena batas waktu mengembalikan teks
+    parsialnya tanpa di-cache, sehingga file yang sama dicoba lagi pada permintaan berikutnya.
+    """
+    try:
+        return extract_text_cached(file_digest, mime_type, file_stream, file_buffer)
+    except ExtractionTimeout as timeout:
+        return timeout.text, timeout.notes
 
 def get_text_from_file(uploaded_file):
+    """Mengembalikan (sha256_isi_file, teks); teks kosong jika file dilewati atau gagal dibaca."""
     if uploaded_file is None:
-        return ""
-    full_text = ""
+        return None, ""
+    file_digest, full_text = None, ""
     try:
-        file_bytes = uploaded_file.getvalue()
-        if uploaded_file.type == "application/pdf":
-            reader = PdfReader(io.BytesIO(file_bytes))
-            for page in reader.pages:
-                if page.extract_text():
-                    full_text += page.extract_text() + "\n"
-        elif uploaded_file.type == "text/plain":
-            full_text = file_bytes.decode("utf-8")
+        # getbuffer() memberi memoryview tanpa menyalin isi upload
+        file_buffer = uploaded_file.getbuffer()
+        if file_buffer.nbytes > UPLOAD_MAX_FILE_MB * 1024 * 1024:
+            st.warning(f"File {uploaded_file.name} melebihi batas {UPLOAD_MAX_FILE_MB:.0f} MB dan dilewati.")
+            return None, ""
+        file_digest = hashlib.sha256(file_buffer).hexdigest()
+        full_text, notes = extract_text(file_digest, uploaded_file.type, uploaded_file, file_buffer)
+        for note in notes:
+            st.warning(f"{uploaded_file.name}: {note}")
     except Exception as e:
         st.warning(f"Gagal membaca file {uploaded_file.name}: {e}")
-    return full_text.strip()
+    return file_digest, full_text.strip()
 
-def perform_calculations(recipe_placeholders, final_data):
+class UploadTextStore:
     """
-    Melakukan perhitungan matematis, membersihkan format mata uang,
-    memberikan pesan error yang jelas, dan menangani dependensi antar kalkulasi.
+    Teks hasil ekstraksi dokumen unggahan, dialamatkan dengan SHA-256 isi file.
+    Teks pendek ikut disimpan di ref (session_state); teks panjang ditulis sekali ke file sementara
+    dan dipakai bersama oleh semua sesi yang mengunggah file yang sama.
+    File yang tidak dibaca atau diperpanjang (keep_alive) lebih lama dari retention_s dihapus;
+    sesi yang masih aktif memperpanjang file yang dirujuknya di setiap run.
     """
-    def clean_currency(value):
-        """Membersihkan string (termasuk format IDR,-) menjadi float, atau mengembalikan float/int asli."""
-        if isinstance(value, (int, float)):
-            return float(value)
-        if isinstance(value, str):
-            cleaned_value = re.sub(r'(IDR|\s|,-?$)', '', value)
-            if cleaned_value.isdigit():
-                return float(cleaned_value)
-        st.warning(f"Nilai '{value}' tidak dapat dibersihkan menjadi angka.")
-        return None
 
-    # Iterasi melalui placeholder di resep
-    for key, value in recipe_placeholders.items():
-        if key.endswith("_CALCULATED"):
-            base_key = key.replace("_CALCULATED", "") # Nama key hasil (misal: Sisa_anggaran_proyek)
-            formula_string = value # value adalah string formula (misal: "Budget_2025 - Terpakai")
-            local_vars = {} # Variabel lokal untuk eval()
-            variables_needed = re.findall(r'\b([A-Za-z_][A-Za-z0-9_]*)\b', formula_string)
-            valid_formula = True
-            missing_vars_details = []
-
-            # Periksa ketersediaan dan validitas setiap variabel yang dibutuhkan
-            for var_name in variables_needed:
-                # PENTING: Cek di final_data (yang diupdate terus menerus)
-                if var_name in final_data:
-                    numeric_value = clean_currency(final_data[var_name])
-                    if numeric_value is not None:
-                        local_vars[var_name] = numeric_value
+    def __init__(self, directory, spill_chars, retention_s):
+        self.directory = directory
+        self.spill_chars = spill_chars
+        self.retention_s = retention_s
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, digest):
+        return os.path.join(self.directory, f"{digest}.txt")
+
+    def put(self, name, digest, text):
+        ref = {"name": name, "digest": digest, "chars": len(text), "text": text}
+        if len(text) <= self.spill_chars:
+            return ref
+        path = self._path(digest)
+        with self._lock:
+            if not os.path.exists(path):
+                temp_path = f"{path}.{uuid.uuid4().hex[:8]}.tmp"
+                with open(temp_path, "w", encoding="utf-8") as f:
+                    f.write(text)
+                os.replace(temp_path, path)
+            else:
+                os.utime(path)
+            self._sweep()
+        ref["text"] = None
+        return ref
+
+    def get(self, ref):
+        """Teks untuk ref; LookupError jika file-nya sudah dihapus (teks kosong diam-diam akan merusak konteks AI)."""
+        if ref.get("text") is not None:
+            return ref["text"]
+        path = self._path(ref["digest"])
+        try:
+            with open(path, encoding="utf-8") as f:
+                text = f.read()
+            os.utime(path)
+            return text
+        except FileNotFoundError:
+            raise LookupError(f"Teks dokumen pendukung '{ref.get('name')}' sudah kedaluwarsa; unggah ulang dokumen tersebut.") from None
+
+    def keep_alive(self, refs):
+        """Memperpanjang umur file milik refs. Mengembalikan nama dokumen yang file-nya sudah tidak ada."""
+        missing = []
+        for ref in refs:
+            if ref.get("text") is None:
+                try:
+                    os.utime(self._path(ref["digest"]))
+                except FileNotFoundError:
+                    missing.append(ref.get("name"))
+        return missing
+
+    def _sweep(self):
+        cutoff = time.time() - self.retention_s
+        for entry in os.scandir(self.directory):
+            try:
+                if entry.stat().st_mtime < cutoff:
+                    os.remove(entry.path)
+            except OSError:
+                pass
+
+    def stats(self):
+        files = [entry.stat().st_size for entry in os.scandir(self.directory) if entry.name.endswith(".txt")]
+        return {"files": len(files), "bytes": sum(files)}
+
+@st.cache_resource
+def get_upload_text_store():
+    """Satu UploadTextStore per proses server."""
+    return UploadTextStore(UPLOAD_TEXT_STORE_DIR, UPLOAD_TEXT_SPILL_CHARS, max(SESSION_IDLE_TIMEOUT_S, JOB_RETENTION_S))
+
+upload_text_store = get_upload_text_store()
+
+# --- Mesin Formula _CALCULATED ---
+_ALLOWED_FORMULA_NODES = (
+    ast.Expression, ast.BinOp, ast.UnaryOp, ast.Name, ast.Load, ast.Constant,
+    ast.Add, ast.Sub, ast.Mult, ast.Div, ast.FloorDiv, ast.Mod, ast.Pow, ast.USub, ast.UAdd,
+)
+_CURRENCY_NOISE_PATTERN = r'(?i:rp\.?|idr)|\s|,-$'
+
+def clean_currency(value):
+    """
+    Membersihkan nilai (termasuk format "IDR 1.000.000,-" atau "17,5") menjadi float.
+    Mengembalikan None jika nilai tidak dapat dibaca sebagai angka.
+    """
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, (int, float)):
+        return float(value)
+    if isinstance(value, str):
+        cleaned_value = re.sub(_CURRENCY_NOISE_PATTERN, '', value)
+        negative = cleaned_value.startswith('-')
+        cleaned_value = cleaned_value.lstrip('-')
+        if re.fullmatch(r'\d+(?:[.,]\d+)*', cleaned_value):
+            number, _ = parse_indonesian_number(cleaned_value)
+            return -number if negative else number
+    return None
+
+def clean_currency_series(series):
+    """
+    Versi kolom dari clean_currency untuk satu kolom pandas (nilai tidak valid menjadi NaN).
+    Kolom teks dibaca per nilai dengan clean_currency, sehingga aturan parsing-nya sama persis dengan field skalar.
+    """
+    pd = lazy_import("pandas")
+    if pd.api.types.is_numeric_dtype(series) and not pd.api.types.is_bool_dtype(series):
+        return series.astype(float)
+    return pd.to_numeric(series.map(clean_currency), errors='coerce').astype(float)
+
+class CompiledFormula:
+    """Satu formula *_CALCULATED yang di-parse sekali menjadi AST aman lalu dikompilasi."""
+    def __init__(self, key, expression):
+        self.key = key
+        self.target = key[:-len("_CALCULATED")]
+        self.expression = expression
+        self.error = None
+        self.variables = []
+        self.code = None
+        try:
+            tree = ast.parse(str(expression), mode="eval")
+            for node in ast.walk(tree):
+                if not isinstance(node, _ALLOWED_FORMULA_NODES):
+                    raise ValueError(f"elemen '{type(node).__name__}' tidak diizinkan dalam formula")
+            # Urutan kemunculan variabel dalam formula dipertahankan untuk pesan error
+            name_nodes = sorted((node for node in ast.walk(tree) if isinstance(node, ast.Name)), key=lambda node: node.col_offset)
+            self.variables = list(dict.fromkeys(node.id for node in name_nodes))
+            self.code = compile(tree, f"<formula {key}>", "eval")
+        except (SyntaxError, ValueError) as e:
+            self.error = str(e)
+
+    def evaluate(self, values):
+        # AST sudah divalidasi (hanya aritmetika dan nama variabel), tanpa builtins
+        return eval(self.code, {"__builtins__": {}}, values)
+
+class FormulaEngine:
+    """
+    Kumpulan formula _CALCULATED dari semua resep dalam satu set template.
+    Formula dievaluasi dalam urutan topologis (formula yang memakai hasil formula lain
+    selalu dihitung setelahnya), dan setiap input dibersihkan dari format mata uang sekali saja.
+    Formula yang variabelnya adalah kolom baris (misal HARGA * JUMLAH pada item Pembelian)
+    dievaluasi sekaligus untuk semua baris secara vektor dengan pandas.
+    """
+    def __init__(self, calculated):
+        self.formulas = {}
+        for key, expression in calculated.items():
+            formula = CompiledFormula(key, expression)
+            self.formulas[formula.target] = formula
+        self.cycle_targets = set()
+        dependency_graph = {
+            target: [var for var in formula.variables if var in self.formulas and var != target]
+            for target, formula in self.formulas.items()
+        }
+        while True:
+            try:
+                self.order = list(graphlib.TopologicalSorter(dependency_graph).static_order())
+                break
+            except graphlib.CycleError as e:
+                # Formula dalam siklus ditandai error; sisanya tetap diurutkan secara topologis
+                cycle = set(e.args[1])
+                self.cycle_targets |= cycle
+                dependency_graph = {target: [var for var in deps if var not in cycle]
+                                    for target, deps in dependency_graph.items() if target not in cycle}
+
+    def evaluate(self, final_data):
+        """
+        Menghitung semua formula dan menyimpan hasilnya langsung di final_data (dengan nama base key).
+        Mengembalikan list pesan (level, teks) untuk ditampilkan oleh pemanggil.
+        """
+        with timed_span("calculations", formulas=len(self.formulas)):
+            messages = []
+            numeric_values = {} # Cache hasil pembersihan: nama variabel -> float/None
+
+            def numeric(var_name):
+                if var_name not in numeric_values:
+                    numeric_values[var_name] = clean_currency(final_data[var_name])
+                    upstream_error = isinstance(final_data[var_name], str) and final_data[var_name].startswith("ERROR_")
+                    if numeric_values[var_name] is None and not upstream_error:
+                        messages.append(("warning", f"Nilai '{final_data[var_name]}' tidak dapat dibersihkan menjadi angka."))
+                return numeric_values[var_name]
+
+            for target in self.cycle_targets:
+                final_data[target] = f"ERROR_CALCULATION: dependensi melingkar pada formula '{self.formulas[target].expression}'"
+                messages.append(("error", f"Gagal melakukan kalkulasi untuk '{target}': dependensi melingkar"))
+
+            for target in self.order:
+                formula = self.formulas[target]
+                if formula.error:
+                    final_data[target] = f"ERROR_CALCULATION: {formula.error}"
+                    messages.append(("error", f"Gagal melakukan kalkulasi untuk '{target}': {formula.error}"))
+                    continue
+
+                scalar_values = {}
+                row_variables = []
+                missing_vars_details = []
+                for var_name in formula.variables:
+                    if var_name in final_data:
+                        value = numeric(var_name)
+                        if value is not None:
+                            scalar_values[var_name] = value
+                        else:
+                            missing_vars_details.append(f"'{var_name}' (nilai '{final_data[var_name]}' tidak valid)")
                     else:
-                        missing_vars_details.append(f"'{var_name}' (nilai '{final_data[var_name]}' tidak valid)")
-                        valid_formula = False; break # Hentikan jika nilai tidak valid
-                else:
-                    missing_vars_details.append(f"'{var_name}' (tidak ditemukan)")
-                    valid_formula = False; break # Hentikan jika variabel tidak ditemukan
+                        row_variables.append(var_name)
+
+                rows_field = self._find_rows_field(final_data, row_variables) if row_variables else None
+                if row_variables and rows_field is None:
+                    missing_vars_details.extend(f"'{var_name}' (tidak ditemukan)" for var_name in row_variables)
+                if missing_vars_details:
+                    final_data[target] = f"ERROR_MISSING_VARS: {', '.join(missing_vars_details)}"
+                    continue
 
-            # Lakukan perhitungan hanya jika semua variabel valid
-            if valid_formula:
                 try:
-                    result = eval(formula_string, {"__builtins__": None}, local_vars)
-                    # --- PERUBAHAN KRUSIAL: Update final_data DI DALAM LOOP ---
-                    final_data[base_key] = result # Simpan hasil langsung ke data utama
+                    if rows_field is None:
+                        final_data[target] = formula.evaluate(scalar_values)
+                    else:
+                        self._evaluate_rows(formula, final_data, rows_field, row_variables, scalar_values)
+                    numeric_values.pop(target, None) # Hasil baru menggantikan nilai lama jika ada
                 except Exception as e:
-                    st.error(f"Gagal melakukan kalkulasi untuk '{base_key}': {e}")
-                    final_data[base_key] = f"ERROR_CALCULATION: {e}" # Simpan error ke data utama
-            else:
-                 # Simpan error missing vars ke data utama
-                final_data[base_key] = f"ERROR_MISSING_VARS: {', '.join(missing_vars_details)}"
+                    messages.append(("error", f"Gagal melakukan kalkulasi untuk '{target}': {e}"))
+                    final_data[target] = f"ERROR_CALCULATION: {e}"
+            return messages
+
+    @staticmethod
+    def _find_rows_field(final_data, row_variables):
+        """Mencari field list-of-dict (misal Pembelian) yang baris-barisnya memiliki semua variabel baris."""
+        for field_name, value in final_data.items():
+            if (isinstance(value, list) and value and all(isinstance(row, dict) for row in value)
+                    and all(var_name in value[0] for var_name in row_variables)):
+                return field_name
+        return None
 
-    # Fungsi sekarang langsung memodifikasi dan mengembalikan final_data
+    @staticmethod
+    def _evaluate_rows(formula, final_data, rows_field, row_variables, scalar_values):
+        """Evaluasi vektor untuk semua baris: hasil per baris disimpan di baris, totalnya di final_data."""
+        pd = lazy_import("pandas")
+        rows = final_data[rows_field]
+        frame = pd.DataFrame(rows, columns=row_variables)
+        columns = {var_name: clean_currency_series(frame[var_name]) for var_name in row_variables}
+        invalid_rows = [i + 1 for i in range(len(rows)) if any(pd.isna(columns[var][i]) for var in row_variables)]
+        if invalid_rows:
+            final_data[formula.target] = (f"ERROR_MISSING_VARS: {', '.join(repr(v) for v in row_variables)} "
+                                          f"tidak valid pada baris {rows_field} nomor {invalid_rows}")
+            return
+        row_results = formula.evaluate({**scalar_values, **columns})
+        if not isinstance(row_results, pd.Series): # Formula tidak memakai kolom sama sekali
+            row_results = pd.Series([row_results] * len(rows))
+        for row, row_result in zip(rows, row_results.tolist()):
+            row[formula.target] = row_result
+        final_data[formula.target] = float(row_results.sum())
+
+def perform_calculations(recipe_placeholders, final_data, formula_engine=None):
+    """
+    Melakukan perhitungan matematis, membersihkan format mata uang,
+    memberikan pesan error yang jelas, dan menangani dependensi antar kalkulasi.
+    formula_engine yang sudah dikompilasi (dari registry resep) dipakai jika diberikan.
+    """
+    if formula_engine is None:
+        formula_engine = FormulaEngine({key: value for key, value in recipe_placeholders.items() if key.endswith("_CALCULATED")})
+    for level, message in formula_engine.evaluate(final_data):
+        if level == "error":
+            st.error(message)
+        else:
+            st.warning(message)
+    # Fungsi langsung memodifikasi dan mengembalikan final_data
     return final_data
 
 def format_for_gdocs(value):
@@ -421,31 +2124,519 @@ def format_for_gdocs(value):
     # Kembalikan nilai asli jika bukan int or float (misal: string, list, dll)
     return value
 
-@st.cache_data(ttl=600) # Cache data for 10 minutes
-def load_gsheet_data(sheet_url):
-    """Membaca data dari Google Sheet menggunakan st.connection."""
+def build_document_data(recipe_data, final_data):
+    """Data gabungan yang relevan untuk satu dokumen (placeholder resepnya), diformat dengan format_for_gdocs."""
+    placeholders_for_this_doc = recipe_data.get("placeholders", {}).keys()
+    # Filter data gabungan, hanya ambil yang relevan untuk dokumen ini
+    data_for_this_doc = {
+        key: format_for_gdocs(final_data.get(key))
+        for key in placeholders_for_this_doc
+        if not key.endswith("_CALCULATED") # Jangan kirim key kalkulasi
+        and final_data.get(key) is not None # Hanya kirim jika ada nilainya
+    }
+    # Tambahkan hasil kalkulasi (jika ada) dengan nama base key
+    for key in placeholders_for_this_doc:
+        if key.endswith("_CALCULATED"):
+            base_key = key.replace("_CALCULATED", "")
+            if base_key in final_data:
+                data_for_this_doc[base_key] = format_for_gdocs(final_data[base_key])
+    return data_for_this_doc
+
+def build_batch_payload(recipes, final_data):
+    """
+    Membangun payload batch untuk Apps Script: satu entri per resep dengan google_doc_id valid,
+    berisi data yang relevan untuk dokumen tersebut. Mengembalikan (payload, daftar_error).
+    """
+    batch_payload = {"documents": []}
+    errors = []
+    for pdf_path, recipe_data in recipes.items():
+        google_doc_id = recipe_data.get("google_doc_id")
+
+        # Validasi ketat: google_doc_id harus ada, tidak None, tidak kosong, dan bertipe string
+        if not google_doc_id or not isinstance(google_doc_id, str) or not google_doc_id.strip():
+            errors.append(f"ID Google Doc tidak valid untuk {os.path.basename(pdf_path)}. Nilai: {repr(google_doc_id)}")
+            continue # Lanjut ke dokumen berikutnya jika ID tidak valid
+
+        batch_payload["documents"].append({
+            "google_doc_id": google_doc_id.strip(),
+            "data_to_fill": build_document_data(recipe_data, final_data)
+        })
+    return batch_payload, errors
+
+def find_docx_template(pdf_path):
+    """Template DOCX lokal untuk sebuah resep (nama sama dengan file PDF/JSON-nya), atau None."""
+    base_path = os.path.splitext(pdf_path)[0]
+    for extension in (".docx", ".DOCX"):
+        if os.path.exists(base_path + extension):
+            return base_path + extension
+    return None
+
+def build_local_render_jobs(recipes, final_data):
+    """
+    Padanan build_batch_payload untuk render lokal: satu entri per resep yang punya template DOCX,
+    dengan data yang sama persis seperti yang dikirim ke Apps Script. Mengembalikan (dokumen, daftar_error).
+    """
+    documents = []
+    errors = []
+    for pdf_path, recipe_data in recipes.items():
+        template_path = find_docx_template(pdf_path)
+        if not template_path:
+            errors.append(f"Template DOCX lokal tidak ditemukan untuk {os.path.basename(pdf_path)}.")
+            continue
+        documents.append({
+            "name": os.path.splitext(os.path.basename(pdf_path))[0],
+            "template_path": template_path,
+            "data_to_fill": build_document_data(recipe_data, final_data),
+        })
+    return documents, errors
+
+@st.cache_resource
+def get_render_process_pool():
+    """Process pool bersama untuk render dokumen lokal (dibuat sekali per proses)."""
+    return ProcessPoolExecutor(max_workers=LOCAL_RENDER_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+
+def render_documents_locally(documents, output_format=LOCAL_RENDER_FORMAT, on_result=None):
+    """
+    Merender dokumen secara paralel di process pool tanpa jaringan. Setiap hasil dilaporkan lewat
+    on_result begitu selesai: {"status", "fileName", "content" (bytes), "mime"} atau pesan error.
+    Tidak memanggil st.* sehingga aman dijalankan sebagai job.
+    """
+    mime = {"pdf": "application/pdf"}.get(output_format, "application/vnd.openxmlformats-officedocument.wordprocessingml.document")
+    with timed_span("local_render", documents=len(documents), format=output_format) as span:
+        pool = get_render_process_pool()
+        futures = {
+            pool.submit(render_docx_template, document["template_path"], document["data_to_fill"],
+                        LOCAL_RENDER_PLACEHOLDER, output_format == "pdf"): document
+            for document in documents
+        }
+        results = []
+        for future in as_completed(futures):
+            document = futures[future]
+            file_name = f"{document['name']}.{output_format}"
+            try:
+                result = {"status": "success", "fileName": file_name, "content": future.result(), "mime": mime}
+            except Exception as e:
+                result = {"status": "error", "fileName": file_name, "message": str(e)}
+            results.append(result)
+            if on_result:
+                on_result(result)
+        span["failed"] = sum(1 for result in results if result["status"] != "success")
+        return {"status": "completed", "results": results}
+
+class DocumentResultCache:
+    """
+    Hasil pembuatan dokumen yang berhasil (docUrl, fileName) di SQLite, dengan key hash dari
+    google_doc_id + data_to_fill dokumen tersebut. Dokumen yang sedang dikirim dicatat sebagai
+    "in-flight" sehingga kiriman ganda (misal klik dua kali) menunggu hasil yang sama, bukan membuat salinan baru.
+    """
+    def __init__(self, path, max_age_seconds):
+        self.path = path
+        self.max_age_seconds = max_age_seconds
+        self.hits = 0
+        self.deduplicated = 0
+        self._lock = threading.Lock()
+        self._inflight = {} # key -> Future berisi hasil dokumen
+        cache_dir = os.path.dirname(path)
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        with self._lock, self._conn:
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS document_results (key TEXT PRIMARY KEY, google_doc_id TEXT, result TEXT, created_at REAL)"
+            )
+            self._conn.execute("DELETE FROM document_results WHERE created_at < ?", (time.time() - max_age_seconds,))
+
+    @staticmethod
+    def make_key(document):
+        key_material = json.dumps({"template": document.get("google_doc_id"), "data": document.get("data_to_fill")},
+                                  sort_keys=True, ensure_ascii=False, default=str)
+        return hashlib.sha256(key_material.encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        with self._lock:
+            row = self._conn.execute("SELECT result, created_at FROM document_results WHERE key = ?", (key,)).fetchone()
+            if row is None or time.time() - row[1] > self.max_age_seconds:
+                return None
+            self.hits += 1
+            return json.loads(row[0])
+
+    def claim(self, key):
+        """Mengembalikan (future, pemilik). Pemilik=False berarti dokumen yang sama sedang dikirim oleh pemanggil lain."""
+        with self._lock:
+            if key in self._inflight:
+                self.deduplicated += 1
+                return self._inflight[key], False
+            future = Future()
+            self._inflight[key] = future
+            return future, True
+
+    def release(self, key, google_doc_id, result):
+        """Menyelesaikan dokumen in-flight; hasil yang berhasil disimpan untuk kiriman berikutnya."""
+        if result.get("status") == "success":
+            with self._lock, self._conn:
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO document_results (key, google_doc_id, result, created_at) VALUES (?, ?, ?, ?)",
+                    (key, google_doc_id, json.dumps(result, ensure_ascii=False), time.time())
+                )
+        with self._lock:
+            future = self._inflight.pop(key, None)
+        if future is not None:
+            future.set_result(result)
+
+    def stats(self):
+        with self._lock:
+            entries = self._conn.execute("SELECT COUNT(*) FROM document_results").fetchone()[0]
+            return {"entries": entries, "hits": self.hits, "deduplicated": self.deduplicated, "inflight": len(self._inflight)}
+
+@st.cache_resource
+def get_document_result_cache():
+    """Satu DocumentResultCache per proses server."""
+    return DocumentResultCache(DOC_RESULT_CACHE_PATH, DOC_RESULT_CACHE_MAX_AGE_DAYS * 86400)
+
+class AppsScriptDispatcher:
+    """
+    Mengirim payload batch ke Apps Script secara paralel per chunk dokumen, memakai satu
+    requests.Session (koneksi di-pool), dengan timeout dan retry exponential backoff untuk
+    error sementara (koneksi, timeout, HTTP 429/5xx). Tidak memanggil st.*.
+    """
+    RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+    def __init__(self, url, chunk_size=APPS_SCRIPT_CHUNK_SIZE, max_workers=APPS_SCRIPT_MAX_WORKERS,
+                 timeout=APPS_SCRIPT_TIMEOUT_S, max_retries=APPS_SCRIPT_MAX_RETRIES, backoff_s=APPS_SCRIPT_BACKOFF_S,
+                 result_cache=None):
+        self.url = url
+        self.result_cache = result_cache
+        self.chunk_size = max(1, chunk_size)
+        self.max_workers = max(1, max_workers)
+        self.timeout = timeout
+        self.max_retries = max(0, max_retries)
+        self.backoff_s = backoff_s
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=self.max_workers)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.session.headers.update({'Content-Type': 'application/json'})
+
+    def _backoff_delay(self, attempt, response=None):
+        retry_after = response.headers.get("Retry-After") if response is not None else None
+        if retry_after and retry_after.isdigit():
+            return float(retry_after)
+        # Exponential backoff dengan jitter agar retry dari beberapa chunk tidak serentak
+        return self.backoff_s * (2 ** attempt) * (0.5 + random.random() / 2)
+
+    def _post_chunk(self, documents):
+        """Mengirim satu chunk dengan retry. Mengembalikan list hasil per dokumen (format Apps Script)."""
+        with timed_span("apps_script_chunk", documents=len(documents)) as span:
+            last_error = None
+            for attempt in range(self.max_retries + 1):
+                span["attempts"] = attempt + 1
+                response = None
+                try:
+                    response = self.session.post(self.url, json={"documents": documents}, timeout=self.timeout)
+                    span["http_status"] = response.status_code
+                    if response.status_code not in self.RETRY_STATUS_CODES:
+                        response.raise_for_status()
+                        result = response.json()
+                        if result.get("status") == "completed":
+                            return result.get("results", [])
+                        message = result.get("message") if result.get("status") == "error" else f"Respons tidak dikenali: {result}"
+                        return [self._error_result(doc, f"Error di Apps Script: {message}") for doc in documents]
+                    last_error = f"HTTP {response.status_code}"
+                except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                    last_error = str(e)
+                except requests.exceptions.RequestException as e:
+                    # HTTP 4xx, respons bukan JSON, dll: tidak akan berhasil jika diulang
+                    return [self._error_result(doc, f"Gagal mengirim ke Apps Script: {e}") for doc in documents]
+                if attempt < self.max_retries:
+                    time.sleep(self._backoff_delay(attempt, response))
+            return [self._error_result(doc, f"Gagal setelah {self.max_retries + 1} percobaan: {last_error}") for doc in documents]
+
+    @staticmethod
+    def _error_result(document, message):
+        return {"status": "error", "templateId": document.get("google_doc_id", "N/A"), "message": message}
+
+    def dispatch(self, batch_payload, on_result=None, use_cache=True):
+        """
+        Mengirim semua dokumen dan mengembalikan {"status": "completed", "results": [...]}
+        dengan urutan hasil sama dengan urutan dokumen di payload. on_result(hasil_dokumen)
+        dipanggil di thread pemanggil begitu sebuah chunk selesai.
+        Dengan result_cache, dokumen yang template & datanya tidak berubah memakai docUrl lama
+        ("cached": True) dan dokumen yang sedang dikirim pemanggil lain ditunggu ("deduplicated": True);
+        hanya sisanya yang dikirim ke Apps Script. use_cache=False memaksa semua dokumen dibuat ulang.
+        """
+        with timed_span("apps_script_dispatch") as span:
+            documents = batch_payload.get("documents", [])
+            results = [None] * len(documents)
+            keys = {} # indeks dokumen -> key cache yang diklaim dispatch ini
+            waiting = [] # (indeks dokumen, future milik pengirim lain)
+            to_send = []
+            for i, document in enumerate(documents):
+                if self.result_cache is None:
+                    to_send.append(i)
+                    continue
+                key = self.result_cache.make_key(document)
+                cached = self.result_cache.get(key) if use_cache else None
+                if cached is not None:
+                    results[i] = {**cached, "cached": True}
+                    if on_result is not None:
+                        on_result(results[i])
+                    continue
+                future, owner = self.result_cache.claim(key) if use_cache else (None, True)
+                if not owner:
+                    waiting.append((i, future))
+                    continue
+                keys[i] = key
+                to_send.append(i)
+
+            chunks = [to_send[i:i + self.chunk_size] for i in range(0, len(to_send), self.chunk_size)]
+            span.update(documents=len(documents), chunks=len(chunks), cached=sum(1 for result in results if result),
+                        deduplicated=len(waiting),
+                        payload_bytes=len(json.dumps(batch_payload, ensure_ascii=False, default=str).encode("utf-8")))
+            try:
+                with ThreadPoolExecutor(max_workers=min(self.max_workers, max(1, len(chunks)))) as executor:
+                    future_to_chunk = {executor.submit(self._post_chunk, [documents[i] for i in chunk]): chunk for chunk in chunks}
+                    for future in as_completed(future_to_chunk):
+                        for i, doc_result in zip(future_to_chunk[future], future.result()):
+                            results[i] = doc_result
+                            if i in keys:
+                                self.result_cache.release(keys.pop(i), documents[i].get("google_doc_id"), doc_result)
+                            if on_result is not None:
+                                on_result(doc_result)
+            finally:
+                # Dokumen yang tidak mendapat hasil (respons terpotong/exception) tetap dilepas agar penunggu tidak macet
+                for i, key in keys.items():
+                    if results[i] is None:
+                        results[i] = self._error_result(documents[i], "Tidak ada hasil dari Apps Script untuk dokumen ini.")
+                    self.result_cache.release(key, documents[i].get("google_doc_id"), results[i])
+
+            for i, future in waiting:
+                results[i] = {**future.result(), "deduplicated": True}
+                if on_result is not None:
+                    on_result(results[i])
+            results = [result or self._error_result(document, "Tidak ada hasil dari Apps Script untuk dokumen ini.")
+                       for result, document in zip(results, documents)]
+            span["failed"] = sum(1 for doc_result in results if doc_result.get("status") != "success")
+            return {"status": "completed", "results": results}
+
+@st.cache_resource
+def get_apps_script_dispatcher(apps_script_url):
+    """Dispatcher (dan pool koneksinya) dibuat sekali per proses untuk setiap URL."""
+    result_cache = None if DOC_RESULT_CACHE_DISABLED else get_document_result_cache()
+    return AppsScriptDispatcher(apps_script_url, result_cache=result_cache)
+
+def send_batch_payload(batch_payload, apps_script_url=None, on_result=None, use_cache=True):
+    """
+    Mengirim payload batch ke Apps Script melalui dispatcher bersama; error dilaporkan per dokumen.
+    Dokumen yang tidak berubah sejak kiriman sebelumnya tidak dibuat ulang kecuali use_cache=False.
+    """
+    dispatcher = get_apps_script_dispatcher(apps_script_url or APPS_SCRIPT_WEB_APP_URL)
+    return dispatcher.dispatch(batch_payload, on_result=on_result, use_cache=use_cache)
+
+@st.cache_resource
+def get_gsheets_connection():
+    """Koneksi Google Sheet dibuat saat pertama kali dibutuhkan, bukan saat script di-import."""
+    return st.connection("gsheets", type=lazy_import("streamlit_gsheets").GSheetsConnection)
+
+def get_gsheet_url():
+    """URL Google Sheet dari environment (server) atau secrets (lokal); None jika tidak dikonfigurasi."""
     try:
-        # PENTING: Pastikan Anda sudah menginisialisasi conn di awal script:
-        # conn = st.connection("gsheets", type=GSheetsConnection)
-        st.info(f"Mencoba membuka Google Sheet via st.connection: {sheet_url}")
-        df = conn.read(
-            spreadsheet=sheet_url,  # URL sheet Anda dari secrets
-            worksheet=0,            # Mengambil sheet pertama
-            ttl=600                 # Cache
-        )
-        if df.empty:
-            st.warning("Google Sheet berhasil dimuat, tetapi tidak ada data.")
-        else:
-            st.success(f"Berhasil memuat {len(df)} baris data dari Google Sheet.")
-        return df
-    except Exception as e:
-        st.error(f"Gagal memuat data dari Google Sheet via st.connection: {e}")
-        # Periksa konfigurasi secrets.toml [connections.gsheets]
-        st.error("Pastikan konfigurasi `[connections.gsheets]` di secrets.toml sudah benar "
-                 "dan Service Account memiliki akses ke Sheet.")
+        return os.environ.get("GSHEET_URL") or st.secrets.get("GSHEET_URL")
+    except Exception:
+        return None
+
+def normalize_column_name(name):
+    """Nama kolom untuk dicocokkan: huruf kecil, spasi/underscore/strip dianggap sama ("Usulan Anggaran" = "Usulan_anggaran")."""
+    return re.sub(r'[\s_\-]+', '_', str(name).strip().lower())
+
+def sqlite_cell_value(value):
+    """Nilai sel DataFrame sebagai tipe SQLite asli (NULL/INTEGER/REAL/TEXT), bukan JSON."""
+    if value is None or lazy_import("pandas").isna(value):
+        return None
+    if hasattr(value, "item"): # Skalar numpy -> int/float/bool Python
+        value = value.item()
+    if isinstance(value, bool):
+        return int(value)
+    if isinstance(value, (int, float, str)):
+        return value
+    return str(value)
+
+class SheetMirror:
+    """
+    Salinan lokal baris Google Sheet di SQLite dengan Title sebagai primary key, dipakai bersama
+    oleh semua sesi. Hanya kolom yang dipakai halaman konfirmasi dan prefill yang disimpan, masing-masing
+    sebagai kolom tabel dengan tipe nilainya sendiri. Penyegaran berjalan di thread latar belakang:
+    hanya baris yang berubah (hash isi berbeda) yang di-upsert dan baris yang hilang dihapus, dalam satu
+    transaksi. Mode WAL membuat pembaca tetap melihat versi lama sampai transaksi selesai, sehingga
+    pencarian baris tidak pernah menunggu penyegaran.
+    """
+    def __init__(self, path, sheet_url, columns, refresh_interval_s):
+        self.path = path
+        self.sheet_url = sheet_url
+        self.columns = list(columns) # Kosong = semua kolom
+        self.refresh_interval_s = refresh_interval_s
+        self.table = "sheet_rows_" + hashlib.sha256(sheet_url.encode("utf-8")).hexdigest()[:16]
+        self.last_refresh = 0.0
+        self.last_error = None
+        self.last_changes = 0
+        self._refreshing = False
+        self._state_lock = threading.Lock()
+        self._read_lock = threading.Lock()
+        cache_dir = os.path.dirname(path)
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+        self._read_conn = sqlite3.connect(path, check_same_thread=False)
+        with self._read_lock, self._read_conn:
+            self._read_conn.execute("PRAGMA journal_mode=WAL")
+            self._read_conn.execute("CREATE TABLE IF NOT EXISTS sheet_meta (sheet TEXT PRIMARY KEY, refreshed_at REAL)")
+            row = self._read_conn.execute("SELECT refreshed_at FROM sheet_meta WHERE sheet = ?", (sheet_url,)).fetchone()
+        self.last_refresh = row[0] if row else 0.0
+        self._titles = self._load_titles()
+
+    @staticmethod
+    def _quote(name):
+        return '"' + str(name).replace('"', '""') + '"'
+
+    def _table_columns(self, conn):
+        """Kolom data tabel sheet ini (urutan sheet), atau None jika tabel belum ada."""
+        info = conn.execute(f"PRAGMA table_info({self._quote(self.table)})").fetchall()
+        return [row[1] for row in info if not row[1].startswith("_")] if info else None
+
+    def _load_titles(self):
+        with self._read_lock:
+            if self._table_columns(self._read_conn) is None:
+                return ()
+            rows = self._read_conn.execute(f'SELECT "Title" FROM {self._quote(self.table)} ORDER BY _position').fetchall()
+        return tuple(row[0] for row in rows)
+
+    @property
+    def titles(self):
+        """Tuple judul dari versi terakhir yang sudah selesai disegarkan."""
+        return self._titles
+
+    def get_row(self, title):
+        """Baris untuk judul tertentu sebagai pd.Series (lookup primary key), atau None."""
+        with self._read_lock:
+            columns = self._table_columns(self._read_conn)
+            if columns is None:
+                return None
+            row = self._read_conn.execute(
+                f"SELECT {', '.join(map(self._quote, columns))} FROM {self._quote(self.table)} WHERE \"Title\" = ?", (title,)
+            ).fetchone()
+        return lazy_import("pandas").Series(dict(zip(columns, row))) if row else None
+
+    def maybe_refresh_async(self, connection):
+        """Memulai penyegaran di thread latar belakang jika data sudah kedaluwarsa. Tidak pernah menunggu."""
+        with self._state_lock:
+            if self._refreshing or time.time() - self.last_refresh < self.refresh_interval_s:
+                return False
+            self._refreshing = True
+        threading.Thread(target=self._refresh, args=(connection,), name="gsheet-refresh", daemon=True).start()
+        return True
+
+    def _fetch(self, connection):
+        # Kolom dipilih setelah dibaca (bukan usecols): nama kolom sheet dicocokkan tanpa membedakan
+        # huruf besar/spasi, dan kolom yang tidak ada di sheet tidak membuat pembacaan gagal
+        df = connection.read(spreadsheet=self.sheet_url, worksheet=0, ttl=0)
+        if "Title" not in df.columns:
+            raise ValueError("Kolom 'Title' tidak ditemukan di Google Sheet.")
+        wanted = {normalize_column_name(column) for column in self.columns}
+        seen = set() # Nama kolom SQLite tidak membedakan huruf besar/kecil
+        keep = []
+        for column in df.columns:
+            name = str(column)
+            if name.startswith("_") or name.lower() in seen:
+                continue
+            if name == "Title" or not wanted or normalize_column_name(name) in wanted:
+                seen.add(name.lower())
+                keep.append(column)
+        df = df[keep].dropna(subset=["Title"])
+        df["Title"] = df["Title"].astype(str).str.strip()
+        # Judul duplikat: baris pertama yang dipakai (sama seperti pencarian .iloc[0] sebelumnya)
+        return df[df["Title"] != ""].drop_duplicates(subset="Title", keep="first")
+
+    def _refresh(self, connection):
+        with timed_span("gsheet_refresh") as span:
+            try:
+                df = self._fetch(connection)
+                columns = [str(column) for column in df.columns]
+                fresh = {}
+                for position, values in enumerate(df.itertuples(index=False, name=None)):
+                    values = tuple(sqlite_cell_value(value) for value in values)
+                    row_hash = hashlib.sha256(json.dumps(values, ensure_ascii=False).encode("utf-8")).hexdigest()
+                    fresh[values[columns.index("Title")]] = (position, row_hash, values)
+                table = self._quote(self.table)
+                # Koneksi tulis terpisah milik thread ini; pembaca tidak ikut terkunci
+                conn = sqlite3.connect(self.path)
+                try:
+                    with conn:
+                        if self._table_columns(conn) != columns:
+                            # Kolom sheet berubah: tabel dibuat ulang dan semua baris ditulis ulang
+                            conn.execute(f"DROP TABLE IF EXISTS {table}")
+                            conn.execute(f"CREATE TABLE {table} (_position INTEGER, _row_hash TEXT, "
+                                         + ", ".join(self._quote(column) + (" TEXT PRIMARY KEY" if column == "Title" else "")
+                                                     for column in columns) + ")")
+                        existing = dict(conn.execute(f'SELECT "Title", _row_hash || \':\' || _position FROM {table}').fetchall())
+                        changed = [(position, row_hash) + values
+                                   for title, (position, row_hash, values) in fresh.items()
+                                   if existing.get(title) != f"{row_hash}:{position}"]
+                        removed = [(title,) for title in existing if title not in fresh]
+                        conn.executemany(f"INSERT OR REPLACE INTO {table} (_position, _row_hash, {', '.join(map(self._quote, columns))}) "
+                                         f"VALUES ({', '.join('?' * (len(columns) + 2))})", changed)
+                        conn.executemany(f'DELETE FROM {table} WHERE "Title" = ?', removed)
+                        conn.execute("INSERT OR REPLACE INTO sheet_meta (sheet, refreshed_at) VALUES (?, ?)",
+                                     (self.sheet_url, time.time()))
+                finally:
+                    conn.close()
+                self._titles = self._load_titles()
+                self.last_changes = len(changed) + len(removed)
+                self.last_error = None
+                span.update(rows=len(fresh), columns=len(columns), changed=len(changed), removed=len(removed))
+            except Exception as e:
+                self.last_error = str(e)
+                span["error"] = str(e)[:200]
+                logging.getLogger(__name__).warning("Penyegaran Google Sheet gagal: %s", e)
+            finally:
+                with self._state_lock:
+                    # Kegagalan juga menunda percobaan berikutnya satu interval agar sheet tidak dibanjiri
+                    self.last_refresh = time.time()
+                    self._refreshing = False
+
+    def stats(self):
+        return {"rows": len(self._titles), "last_refresh": self.last_refresh, "refreshing": self._refreshing,
+                "last_changes": self.last_changes, "error": self.last_error}
+
+def gsheet_mirror_columns():
+    """Kolom sheet yang disalin: GSHEET_COLUMNS jika diset ("*" = semua), selain itu semua field resep."""
+    if GSHEET_COLUMNS:
+        return [] if GSHEET_COLUMNS == ["*"] else GSHEET_COLUMNS
+    fields = {}
+    for set_name in TEMPLATE_SETS:
+        for key in recipe_registry.get_template_set(set_name)["placeholders"]:
+            if not key.endswith("_CALCULATED"):
+                fields.setdefault(key)
+    return ["Title"] + [key for key in fields if key != "Title"]
+
+@st.cache_resource
+def get_sheet_mirror(sheet_url):
+    """Satu SheetMirror per URL sheet per proses server."""
+    return SheetMirror(GSHEET_MIRROR_PATH, sheet_url, gsheet_mirror_columns(), GSHEET_REFRESH_INTERVAL_S)
+
+def get_active_sheet_mirror():
+    """
+    SheetMirror jika fitur Google Sheet diaktifkan di sesi ini dan URL-nya dikonfigurasi, sekaligus
+    memicu penyegaran latar belakang bila datanya kedaluwarsa. Dipanggil dari thread utama.
+    """
+    sheet_url = get_gsheet_url()
+    if not st.session_state.get("use_gsheet_toggle", False) or not sheet_url:
         return None
+    sheet_mirror = get_sheet_mirror(sheet_url)
+    try:
+        sheet_mirror.maybe_refresh_async(get_gsheets_connection())
+    except Exception as e:
+        sheet_mirror.last_error = str(e)
+    return sheet_mirror
 
-def find_prompt_matches_with_llm(user_prompt, gsheet_titles):
+def find_prompt_matches_with_llm(user_prompt, gsheet_titles, use_cache=True):
     """Menggunakan LLM untuk mencocokkan prompt pengguna dengan judul dari GSheet."""
     if not model or not user_prompt or not gsheet_titles:
         return {"matches": []}
@@ -461,18 +2652,17 @@ def find_prompt_matches_with_llm(user_prompt, gsheet_titles):
     {titles_list_str}
 
     ATURAN RESPON:
-    1. Respon HANYA dengan objek JSON yang valid.
-    2. Objek JSON harus memiliki satu key: "matches".
-    3. Nilai dari "matches" harus berupa LIST (array) berisi string judul proyek yang cocok PERSIS seperti yang ada di daftar.
-    4. Jika tidak ada kecocokan yang kuat, kembalikan list kosong: {{"matches": []}}.
-    5. Jika ada beberapa kecocokan yang kuat, sertakan SEMUA judul yang cocok dalam list.
-    6. Jangan sertakan penjelasan atau teks lain di luar objek JSON.
+    1. "matches" berisi judul proyek yang cocok PERSIS seperti yang ada di daftar.
+    2. Jika tidak ada kecocokan yang kuat, kembalikan list kosong.
+    3. Jika ada beberapa kecocokan yang kuat, sertakan SEMUA judul yang cocok dalam list.
     """
+    # Structured output: judul dibatasi ke daftar kandidat lewat enum
+    response_schema = {"type": "object", "required": ["matches"], "properties": {
+        "matches": {"type": "array", "items": {"type": "string", "format": "enum", "enum": list(gsheet_titles)}}}}
     try:
-        # ... (kode panggilan AI dan parsing JSON seperti di versi sebelumnya) ...
-        response = model.generate_content(prompt)
-        json_string = response.text.strip().replace("```json", "").replace("```", "")
-        parsed_json = json.loads(json_string)
+        response_text = generate_text(prompt, generation_config=json_generation_config(response_schema),
+                                      use_cache=use_cache, cache_if=is_valid_json_object_response)
+        parsed_json = parse_ai_json_object(response_text or "")
         if isinstance(parsed_json, dict) and "matches" in parsed_json and isinstance(parsed_json["matches"], list):
              valid_matches = [match for match in parsed_json["matches"] if match in gsheet_titles]
              return {"matches": valid_matches}
@@ -483,289 +2673,655 @@ def find_prompt_matches_with_llm(user_prompt, gsheet_titles):
         st.error(f"Error saat mencocokkan prompt dengan AI: {e}")
         return {"matches": []}
 
+def _trigrams(token):
+    padded = f" {token} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+class TitleIndex:
+    """
+    Indeks kandidat lokal atas judul proyek di Google Sheet.
+    Skor sebuah judul = bobot IDF token judul yang ditemukan di prompt / total bobot IDF token judul.
+    Token prompt yang salah ketik tetap dicocokkan lewat kemiripan trigram (Jaccard).
+    """
+    def __init__(self, titles, fuzzy_threshold=0.6):
+        self.titles = list(titles)
+        self.fuzzy_threshold = fuzzy_threshold
+        self.title_tokens = [set(tokenize_for_retrieval(title)) for title in self.titles]
+        doc_freqs = Counter(token for tokens in self.title_tokens for token in tokens)
+        n_titles = len(self.titles)
+        self.idf = {token: math.log(1 + n_titles / df) for token, df in doc_freqs.items()}
+        self.postings = defaultdict(list)
+        for i, tokens in enumerate(self.title_tokens):
+            for token in tokens:
+                self.postings[token].append(i)
+        self.vocab_trigrams = {token: _trigrams(token) for token in self.idf}
+        self.trigram_postings = defaultdict(set)
+        for token, trigrams in self.vocab_trigrams.items():
+            for trigram in trigrams:
+                self.trigram_postings[trigram].add(token)
+
+    def _match_weights(self, query_tokens):
+        """Memetakan token kosakata judul -> bobot kecocokan (1.0 persis, <1.0 fuzzy)."""
+        weights = {}
+        for token in query_tokens:
+            if token in self.idf:
+                weights[token] = 1.0
+                continue
+            query_trigrams = _trigrams(token)
+            neighbours = set().union(*(self.trigram_postings.get(t, ()) for t in query_trigrams))
+            for vocab_token in neighbours:
+                vocab_trigrams = self.vocab_trigrams[vocab_token]
+                similarity = len(query_trigrams & vocab_trigrams) / len(query_trigrams | vocab_trigrams)
+                if similarity >= self.fuzzy_threshold and similarity > weights.get(vocab_token, 0.0):
+                    weights[vocab_token] = similarity
+        return weights
+
+    def search(self, query, top_n):
+        """Mengembalikan list (judul, skor) terurut menurun, maksimal top_n."""
+        weights = self._match_weights(set(tokenize_for_retrieval(query)))
+        matched_weight = defaultdict(float)
+        for token, weight in weights.items():
+            for i in self.postings[token]:
+                matched_weight[i] += self.idf[token] * weight
+        scored = []
+        for i, weight in matched_weight.items():
+            total_weight = sum(self.idf[token] for token in self.title_tokens[i])
+            scored.append((weight / total_weight, self.titles[i]))
+        scored.sort(key=lambda item: (-item[0], item[1]))
+        return [(title, score) for score, title in scored[:top_n]]
+
+@st.cache_resource(max_entries=4, show_spinner=False)
+def get_title_index(titles):
+    """Indeks judul dibangun sekali untuk setiap versi data sheet (titles berupa tuple)."""
+    return TitleIndex(titles)
+
+def find_prompt_matches(user_prompt, gsheet_titles, use_cache=True):
+    """
+    Mencari judul proyek yang cocok: indeks lokal memilih top-N kandidat dalam milidetik.
+    LLM dilewati jika tidak ada kandidat yang layak atau jika satu kandidat jelas paling cocok;
+    selain itu LLM hanya diminta memilih di antara kandidat tersebut.
+    Mengembalikan {"matches": [...], "source": "lokal" | "AI"}.
+    """
+    with timed_span("sheet_matching", titles=len(gsheet_titles or ())) as span:
+        if not user_prompt or not gsheet_titles:
+            return {"matches": [], "source": "lokal"}
+        candidates = get_title_index(tuple(gsheet_titles)).search(user_prompt, GSHEET_MATCH_TOP_N)
+        candidates = [(title, score) for title, score in candidates if score >= GSHEET_MATCH_MIN_SCORE]
+        span["candidates"] = len(candidates)
+        if not candidates:
+            return {"matches": [], "source": "lokal"}
+        top_score = candidates[0][1]
+        runner_up_score = candidates[1][1] if len(candidates) > 1 else 0.0
+        if top_score >= GSHEET_MATCH_CLEAR_SCORE and top_score - runner_up_score >= GSHEET_MATCH_CLEAR_MARGIN:
+            return {"matches": [candidates[0][0]], "source": "lokal"}
+        span["source"] = "AI"
+        ai_response = find_prompt_matches_with_llm(user_prompt, [title for title, _ in candidates], use_cache=use_cache)
+        return {"matches": ai_response.get("matches", []), "source": "AI"}
+
+def select_template_set(budget, prompt_text):
+    """Memilih nama set template (key TEMPLATE_SETS) berdasarkan budget dan kata kunci di prompt."""
+    prompt_text = prompt_text.lower()
+    if budget >= 300_000_000:
+        if "lisensi" in prompt_text:
+            return "LISENSI_MORE_300"
+        return "PENGADAAN_MORE_300" # "pengadaan" atau tanpa kata kunci (default jika >= 300jt)
+    if "lisensi" in prompt_text:
+        return "LISENSI_LESS_300"
+    return "PENGADAAN_LESS_300" # "pengadaan" atau tanpa kata kunci (default jika < 300jt)
+
 def augment_prompt_with_gsheet_data(original_prompt, selected_row_data):
     """Menambahkan data dari baris GSheet ke prompt asli."""
+    pd = lazy_import("pandas")
     augmented_prompt = original_prompt + "\n\n--- Data Tambahan dari Spreadsheet ---"
     for col, value in selected_row_data.items():
         if pd.notna(value) and value != '' and col.lower() != 'title':
             augmented_prompt += f"\n{col}: {value}"
     return augmented_prompt
 
-# --- Tampilan & Logika Aplikasi (State Machine) ---
-st.title("AI Document Generator")
-
-# --- LANGKAH 1: INPUT AWAL & INTEGRASI GSHEET ---
-if st.session_state.page == "initial_input":
-    st.header("Langkah 1: Jelaskan Kebutuhan Anda")
-
-    # Tombol untuk memuat data GSheet (di luar form)
-    # st.info("Anda dapat memuat data proyek dari Google Sheet untuk membantu AI.")
-    # use_gsheet = st.toggle("Aktifkan Pencarian Data Proyek di Google Sheet", value=True, key="use_gsheet_toggle")
-
-    # if use_gsheet:
-    #     # Tampilkan tombol load hanya jika GSheet belum dimuat atau ingin di-refresh
-    #     if 'gsheet_data' not in st.session_state or st.session_state.gsheet_data is None:
-    #     #     if st.button(" Muat/Refresh Data Proyek dari Google Sheet"):
-    #     #         gsheet_url = st.secrets.get("GSHEET_URL")
-    #     #         if not gsheet_url:
-    #     #             st.error("URL Google Sheet (GSHEET_URL) tidak ditemukan di Streamlit Secrets.")
-    #     #         else:
-    #     #             with st.spinner("Mengambil data dari Google Sheet..."):
-    #     #                 df = load_gsheet_data(gsheet_url)
-    #     #                 st.session_state.gsheet_data = df # Simpan DataFrame ke session state
-    #     #                 if df is not None:
-    #     #                     st.success("Data Google Sheet berhasil dimuat.")
-    #     # else: error sudah ditampilkan oleh load_gsheet_data
-
-    #     # Tampilkan status data GSheet jika sudah dimuat
-    #     elif st.session_state.gsheet_data is not None:
-    #     #     st.success(f"Data Google Sheet ({len(st.session_state.gsheet_data)} baris) sudah dimuat.")
-    #     #     if st.button("Refresh Data"): # Tombol refresh jika data sudah ada
-    #     #         # Clear cache dan muat ulang
-    #     #         load_gsheet_data.clear()
-    #     #         gsheet_url = st.secrets.get("GSHEET_URL")
-    #     #         if gsheet_url:
-    #     #             with st.spinner("Memuat ulang data dari Google Sheet..."):
-    #     #                 st.session_state.gsheet_data = load_gsheet_data(gsheet_url)
-
-    # Form untuk input pengguna
-    with st.form("initial_input_form", clear_on_submit=False): # Keep clear_on_submit=False
-        st.info("Masukkan deskripsi kebutuhan Anda, termasuk estimasi budget.")
-        # Berikan key unik ke text_area DAN simpan widget ke variabel
-        initial_prompt_input = st.text_area( # <-- Simpan widget ke variabel ini
-            "Deskripsi Kebutuhan:",
-            height=350, # Membuatkan text area dapat di-scroll
-            max_chars=10000, # Membuatkan text area dapat menampung input yang sangat besar
-            placeholder="Contoh: pengadaan fasilitas perangkat laptop penunjang kinerja personil TI \nPrognosa 2025 100jt.\nTerpakai 0.\nUsulan anggaran 17,5jt.\nAnggaran kalimat tujuh belas koma lima juta.\nPos Anggaran VI. 3 (Biaya Perbaikan Aplikasi Infrastruktur).\nTanggal 10 Oktober 2025. Rkap 2025 26.401.000.000.\nNilai Kontrak po 2025 20.850.959.696.\npr 1.165.000.000.\nbudget pembuatan rab & rks 1.628.894.000.\nharga pembelian 22 jt.\npembatalan garansi dilakukan apabila terjadi kelalaian pegawai yang akan ditanggung oleh PT TPS.\nContract execution 1 bulan",
-            key="prompt_input_key" # Key tetap ada, berguna nanti
-        )
-        uploaded_files_list = st.file_uploader(
-            "Unggah Dokumen Pendukung Apapun (Opsional, .pdf atau .txt)",
-            type=['pdf', 'txt'], accept_multiple_files=True, key="initial_uploader"
-        )
-        submitted = st.form_submit_button("Analisis & Lanjut ke Pemrosesan Dokumen")
+# --- Riwayat Proyek ---
+class ProjectHistory:
+    """
+    Data final setiap permintaan yang selesai diverifikasi, disimpan di SQLite dengan key (set template, Title).
+    Pencarian kemiripan memakai TitleIndex atas judul-judul dalam set template yang sama; indeks
+    dibangun ulang hanya jika riwayat set tersebut berubah.
+    """
+    def __init__(self, path, max_entries):
+        self.path = path
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._indexes = {} # template_set -> (versi, TitleIndex)
+        self._versions = Counter()
+        cache_dir = os.path.dirname(path)
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        with self._lock, self._conn:
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS project_history (template_set TEXT, title TEXT, prompt TEXT, "
+                "final_data TEXT, updated_at REAL, PRIMARY KEY (template_set, title))"
+            )
 
-        if submitted:
-            prompt_value_from_input = initial_prompt_input
+    def record(self, template_set, title, prompt, final_data):
+        if not title or not str(title).strip():
+            return
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO project_history (template_set, title, prompt, final_data, updated_at) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (template_set, str(title).strip(), prompt, json.dumps(final_data, ensure_ascii=False, default=str), time.time())
+            )
+            self._conn.execute(
+                "DELETE FROM project_history WHERE rowid NOT IN "
+                "(SELECT rowid FROM project_history ORDER BY updated_at DESC LIMIT ?)", (self.max_entries,)
+            )
+            self._versions[template_set] += 1
+
+    def _index_for(self, template_set):
+        with self._lock:
+            version = self._versions[template_set]
+            cached = self._indexes.get(template_set)
+            if cached and cached[0] == version:
+                return cached[1]
+            titles = [row[0] for row in self._conn.execute(
+                "SELECT title FROM project_history WHERE template_set = ?", (template_set,)
+            )]
+        index = TitleIndex(titles) if titles else None
+        with self._lock:
+            self._indexes[template_set] = (version, index)
+        return index
+
+    def find_similar(self, template_set, prompt_text, min_score):
+        """Entri riwayat dengan judul paling mirip prompt: {"title", "score", "prompt", "final_data"} atau None."""
+        index = self._index_for(template_set)
+        if index is None or not prompt_text:
+            return None
+        candidates = index.search(prompt_text, 1)
+        if not candidates or candidates[0][1] < min_score:
+            return None
+        title, score = candidates[0]
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT prompt, final_data FROM project_history WHERE template_set = ? AND title = ?", (template_set, title)
+            ).fetchone()
+        if row is None:
+            return None
+        return {"title": title, "score": score, "prompt": row[0], "final_data": json.loads(row[1])}
 
-            if not prompt_value_from_input: # Periksa nilai yang didapat dari widget
-                st.warning("Harap isi deskripsi kebutuhan.")
-            else:
-                # Lakukan analisis budget dengan LLM menggunakan nilai yang benar
-                with st.spinner("Menganalisis budget dengan AI..."):
-                    budget = analyze_budget_with_llm(prompt_value_from_input) # Gunakan nilai dari widget
-                st.session_state.budget = budget
-
-                # Simpan data input awal (gunakan nilai yang sudah dibaca)
-                uploaded_files_dict = {f.name: f for f in uploaded_files_list} if uploaded_files_list else {}
-                st.session_state.initial_data = {
-                    "prompt": prompt_value_from_input, # Simpan nilai yang benar
-                    "files": uploaded_files_dict
-                }
+@st.cache_resource
+def get_project_history():
+    """Satu ProjectHistory per proses server."""
+    return ProjectHistory(HISTORY_PATH, HISTORY_MAX_ENTRIES)
 
-                # --- LOGIKA PENCOCOKAN GSHEET ---
-                gsheet_enabled = st.session_state.get("use_gsheet_toggle", False)
-                gsheet_df = st.session_state.get("gsheet_data")
-
-                if gsheet_enabled and gsheet_df is not None and not gsheet_df.empty and 'Title' in gsheet_df.columns:
-                    st.info("Fitur Google Sheet aktif, mencoba mencocokkan...") # Info tambahan
-                    with st.spinner("AI sedang mencocokkan permintaan Anda dengan data proyek..."):
-                        gsheet_titles = gsheet_df['Title'].dropna().astype(str).tolist()
-                        
-                        ai_match_response = find_prompt_matches_with_llm(prompt_value_from_input, gsheet_titles)
-                    matches = ai_match_response.get("matches", [])
-                    st.session_state.ai_matches = matches # Simpan hasil pencocokan
-
-                    if matches:
-                        st.session_state.page = "disambiguation" # Pindah ke halaman konfirmasi
-                    else:
-                        st.info("Tidak ditemukan data proyek yang cocok di Google Sheet.")
-                        st.session_state.page = "load_recipes_and_process" # Lanjut tanpa konfirmasi
-                else: # Lanjut tanpa pencocokan
-                    if gsheet_enabled and (gsheet_df is None or gsheet_df.empty or 'Title' not in gsheet_df.columns):
-                         st.warning("Pencarian Google Sheet diaktifkan, tetapi data belum dimuat/kosong/tidak valid.")
-                    ## st.info("Melanjutkan tanpa menggunakan data dari Google Sheet.")
-                    st.session_state.page = "load_recipes_and_process"
-
-elif st.session_state.page == "disambiguation":
-    st.header("Konfirmasi Proyek Terkait")
-    st.info("AI menemukan kemungkinan proyek terkait di Google Sheet berdasarkan permintaan Anda.")
-    
-    matches = st.session_state.get("ai_matches", [])
-    gsheet_df = st.session_state.get("gsheet_data")
-    
-    if not matches or gsheet_df is None:
-        st.error("Data pencocokan tidak ditemukan. Kembali ke awal.")
-        if st.button("Kembali"): st.session_state.page = "initial_input"; st.rerun()
-        st.stop()
+project_history = get_project_history()
 
-    # Tambahkan opsi "Bukan salah satu di atas"
-    options = matches + ["Bukan salah satu di atas / Permintaan Baru"]
-    
-    # Gunakan radio button jika sedikit pilihan, selectbox jika banyak
-    if len(options) <= 5:
-        selected_title = st.radio("Manakah proyek yang Anda maksud?", options, index=0, key="match_selector")
-    else:
-        selected_title = st.selectbox("Manakah proyek yang Anda maksud?", options, index=0, key="match_selector")
-
-    if st.button("Konfirmasi Pilihan & Lanjutkan"):
-        augmented_prompt = st.session_state.initial_data["prompt"] # Mulai dengan prompt asli
-
-        if selected_title != "Bukan salah satu di atas / Permintaan Baru":
-            # Cari baris data yang sesuai di DataFrame
-            selected_row = gsheet_df[gsheet_df['Title'] == selected_title].iloc[0]
-            # Augmentasi prompt
-            augmented_prompt = augment_prompt_with_gsheet_data(augmented_prompt, selected_row)
-            st.success(f"Data dari proyek '{selected_title}' akan ditambahkan ke konteks.")
-            # Tampilkan data yang ditambahkan (opsional)
-            with st.expander("Lihat Data yang Ditambahkan"):
-                 st.dataframe(selected_row.to_frame().T) # Tampilkan sebagai tabel kecil
-        else:
-            st.info("Melanjutkan hanya dengan deskripsi awal Anda.")
+_YEAR_PATTERN = re.compile(r"\b(19|20)\d{2}\b")
 
-        # Update prompt di initial_data sebelum lanjut
-        st.session_state.initial_data["prompt"] = augmented_prompt
-        # Lanjut ke tahap pemuatan resep
-        st.session_state.page = "load_recipes_and_process"
-        st.rerun()
+def history_known_data(template_set_name, prompt_text, placeholders):
+    """
+    Mencari riwayat proyek yang mirip dan mengembalikan (data_diketahui, entri_riwayat).
+    Dari data final tahun lalu hanya diambil field yang kemungkinan tidak berubah: field kosong, numerik,
+    bertanggal/bertahun, dan field yang ditulis ulang pengguna ("Key: nilai") tetap dikirim ke AI.
+    """
+    if HISTORY_DISABLED:
+        return {}, None
+    entry = project_history.find_similar(template_set_name, prompt_text, HISTORY_MATCH_MIN_SCORE)
+    if entry is None:
+        return {}, None
+    provided = find_provided_fields(prompt_text, placeholders)
+    known = {}
+    for key in placeholders:
+        value = entry["final_data"].get(key)
+        if key.endswith("_CALCULATED") or key in provided or value is None or value == "":
+            continue
+        if isinstance(value, (int, float)) or (isinstance(value, str) and _YEAR_PATTERN.search(value)):
+            continue
+        known[key] = value
+    return known, entry
+
+def record_produced_project(template_set_name, prompt_text, final_data, job_result):
+    """
+    Menyimpan data final ke riwayat proyek setelah minimal satu dokumen benar-benar dibuat (kirim ke
+    Apps Script atau render lokal), sehingga draf yang ditinggalkan tidak menjadi acuan perpanjangan.
+    Mengembalikan job_result apa adanya; aman dipanggil dari thread job.
+    """
+    if any(result.get("status") == "success" for result in job_result.get("results", [])):
+        project_history.record(template_set_name, final_data.get("Title"), prompt_text, final_data)
+    return job_result
+
+# --- Memori Sesi ---
+# Payload per permintaan; disimpan di session_registry (per proses, key session_id), bukan di session_state,
+# dan ukurannya dihitung terhadap SESSION_MAX_PAYLOAD_MB
+SESSION_PAYLOAD_KEYS = ("initial_data", "ai_extracted_data", "final_combined_data", "first_pass_report",
+                        "final_json", "ai_matches")
+# Pengaturan pengguna yang tetap dipertahankan saat payload sesi yang tidak aktif dibuang
+SESSION_PRESERVED_KEYS = ("bypass_llm_cache", "use_gsheet_toggle")
+# Satu-satunya yang disimpan session_state untuk payload: handle (session_id) ke entri di session_registry
+SESSION_PAYLOAD_HANDLE_KEY = "session_payload_handle"
+
+def estimate_payload_bytes(value):
+    """Perkiraan ukuran sebuah nilai session (DataFrame lewat memory_usage, lainnya lewat panjang JSON)."""
+    # DataFrame hanya mungkin ada jika pandas sudah di-import; pengecekan ini tidak memicu import pandas
+    if "pandas" in sys.modules and isinstance(value, sys.modules["pandas"].DataFrame):
+        return int(value.memory_usage(deep=True).sum())
+    try:
+        return len(json.dumps(value, ensure_ascii=False, default=str))
+    except (TypeError, ValueError):
+        return 0
 
-    st.write("---")
-    if st.button("Batalkan & Kembali ke Input Awal"):
-        st.session_state.page = "initial_input"
-        # Reset state yang relevan
-        st.session_state.ai_matches = None
-        st.rerun()
+def enforce_session_payload_cap(payload, max_bytes, page=None):
+    """
+    Menjaga total payload sebuah sesi di bawah max_bytes dengan membuang data yang hanya bersifat
+    diagnostik atau bisa dibentuk ulang, berurutan: prompt & respons mentah AI, lalu judul-judul hasil
+    pencocokan Google Sheet setelah halaman konfirmasi lewat, lalu hasil mentah AI setelah data final terbentuk.
+    Jika masih melebihi batas, seluruh payload permintaan ditolak (dibuang), sehingga total tidak pernah
+    melebihi max_bytes. Mengembalikan (total_byte, list_key_yang_dipangkas).
+    """
+    sizes = {key: estimate_payload_bytes(payload[key]) for key in SESSION_PAYLOAD_KEYS
+             if key in payload and payload[key] is not None}
+    trimmed = []
+    if sum(sizes.values()) > max_bytes and sizes.get("first_pass_report") and payload["first_pass_report"].get("debug"):
+        payload["first_pass_report"] = {**payload["first_pass_report"], "debug": []}
+        sizes["first_pass_report"] = estimate_payload_bytes(payload["first_pass_report"])
+        trimmed.append("first_pass_report")
+    if sum(sizes.values()) > max_bytes and sizes.get("ai_matches") and page != "disambiguation":
+        payload["ai_matches"] = None
+        sizes.pop("ai_matches")
+        trimmed.append("ai_matches")
+    if sum(sizes.values()) > max_bytes and sizes.get("ai_extracted_data") and sizes.get("final_combined_data"):
+        payload["ai_extracted_data"] = {}
+        sizes.pop("ai_extracted_data")
+        trimmed.append("ai_extracted_data")
+    if sum(sizes.values()) > max_bytes:
+        for key in sizes:
+            del payload[key]
+            if key not in trimmed:
+                trimmed.append(key)
+        sizes.clear()
+    return sum(sizes.values()), trimmed
+
+def clear_session_state(state):
+    """Membuang semua state sesi kecuali pengaturan pengguna dan handle payload (dipanggil dari thread script sesi itu)."""
+    for key in list(state.keys()):
+        if key not in SESSION_PRESERVED_KEYS and key != SESSION_PAYLOAD_HANDLE_KEY:
+            del state[key]
+
+class SessionActivityRegistry:
+    """
+    Penyimpanan payload permintaan semua sesi browser di proses ini; session_state setiap sesi hanya
+    memegang handle acak ke entrinya. Setiap touch() membuang entri sesi yang menganggur lebih lama dari
+    idle_timeout_s, sehingga memori tab yang ditutup atau ditinggal dibebaskan tanpa menunggu sesi itu kembali.
+    Registry tidak pernah menyentuh session_state sesi lain; sesi yang kembali setelah payload-nya dibuang
+    mengetahuinya dari handle yang tidak lagi terdaftar.
+    """
 
-# --- LANGKAH 1.8 (DIMODIFIKASI): Tentukan & Muat Resep yang Relevan ---
-elif st.session_state.page == "load_recipes_and_process":
-    
-    # Ambil data yang dibutuhkan untuk membuat keputusan
-    budget = st.session_state.get('budget')
-    # Ambil prompt yang mungkin sudah di-augmentasi oleh GSheet
-    prompt_text = st.session_state.initial_data.get("prompt", "").lower()
+    def __init__(self, idle_timeout_s):
+        self.idle_timeout_s = idle_timeout_s
+        self._sessions = {} # handle -> [terakhir_aktif, payload]
+        self._lock = threading.Lock()
+        self.evicted = 0
+
+    def _sweep(self, now):
+        cutoff = now - self.idle_timeout_s
+        idle = [handle for handle, (last_seen, _) in self._sessions.items() if last_seen < cutoff]
+        for handle in idle:
+            del self._sessions[handle]
+        self.evicted += len(idle)
+
+    def touch(self, state):
+        """
+        Dipanggil di awal setiap run penuh dengan session_state milik sesi itu. Mengembalikan (payload, dibuang):
+        dibuang bernilai True jika payload sesi ini sudah dibuang karena menganggur; state sesi lalu
+        dibersihkan (pengaturan pengguna dipertahankan) dan payload baru yang kosong dipakai.
+        """
+        now = time.time()
+        handle = state.get(SESSION_PAYLOAD_HANDLE_KEY)
+        with self._lock:
+            self._sweep(now)
+            entry = self._sessions.get(handle)
+            evicted = entry is None and handle is not None
+            if entry is None:
+                handle = uuid.uuid4().hex
+                entry = self._sessions[handle] = [now, {}]
+            entry[0] = now
+        if evicted:
+            clear_session_state(state)
+        state[SESSION_PAYLOAD_HANDLE_KEY] = handle
+        return entry[1], evicted
+
+    def payload(self, handle):
+        """Payload sesi (juga menandai sesi aktif, untuk rerun fragment), atau None jika sudah dibuang."""
+        now = time.time()
+        with self._lock:
+            entry = self._sessions.get(handle)
+            if entry is None:
+                return None
+            entry[0] = now
+            return entry[1]
 
-    target_templates_to_load = [] # List kosong untuk diisi
-    
-    st.info(f"Menganalisis kondisi...")
-    st.caption(f"Budget terdeteksi: {budget}")
-    st.caption(f"Prompt (awal): {prompt_text[:70]}...")
+    def stats(self):
+        with self._lock:
+            return {"sessions": len(self._sessions), "evicted": self.evicted}
 
-    # --- Logika Pemilihan Template Dinamis ---
-    if budget is None:
-        st.error("Budget tidak dapat terdeteksi dari deskripsi Anda. Tidak dapat melanjutkan.")
-        if st.button("Kembali ke Input Awal"):
-            st.session_state.page = "initial_input"; st.rerun()
-        st.stop()
-    
-    elif budget >= 300_000_000:
-        if "lisensi" in prompt_text:
-            print("Kondisi terdeteksi: Budget >= 300jt, Tipe 'Lisensi'.")
-            target_templates_to_load = TARGET_PDF_TEMPLATES_LISENSI_MORE_300
-        elif "pengadaan" in prompt_text:
-            print("Kondisi terdeteksi: Budget >= 300jt, Tipe 'Pengadaan'.")
-            target_templates_to_load = TARGET_PDF_TEMPLATES_PENGADAAN_MORE_300
-        else:
-            print(f"Budget >= 300jt, tapi kata kunci 'lisensi'/'pengadaan' tidak ditemukan. Menggunakan default 'Pengadaan >= 300jt'.")
-            target_templates_to_load = TARGET_PDF_TEMPLATES_PENGADAAN_MORE_300 # Default jika > 300jt
-    
-    else: # Budget < 300,000,000
-        if "lisensi" in prompt_text:
-            print("Kondisi terdeteksi: Budget < 300jt, Tipe 'Lisensi'. Menggunakan default 'Pengadaan < 300jt' (sebelum ada aturan spesifik).")
-            # Default ke pengadaan < 300jt jika tidak ada aturan untuk lisensi < 300jt
-            target_templates_to_load = TARGET_PDF_TEMPLATES_LISENSI_LESS_300
-        elif "pengadaan" in prompt_text:
-            print("Kondisi terdeteksi: Budget < 300jt, Tipe 'Pengadaan'.")
-            target_templates_to_load = TARGET_PDF_TEMPLATES_PENGADAAN_LESS_300
-        else:
-            print("Budget < 300jt, tapi kata kunci tidak ditemukan. Menggunakan default 'Pengadaan < 300jt'.")
-            target_templates_to_load = TARGET_PDF_TEMPLATES_PENGADAAN_LESS_300 # Default jika < 300jt
-
-    if not target_templates_to_load:
-         st.error("Tidak ada set template yang cocok dengan kondisi Anda. Proses dihentikan.")
-         if st.button("Kembali"): st.session_state.page = "initial_input"; st.rerun()
-         st.stop()
-
-    # --- Loop Pemuatan Resep (Sekarang menggunakan list dinamis) ---
-    loaded_recipes = {}
-    all_recipes_valid = True
-    with st.spinner(f"Memuat {len(target_templates_to_load)} resep dokumen yang dipilih..."):
-        for pdf_path in target_templates_to_load: # Menggunakan variabel dinamis
-            recipe_data = load_recipe(pdf_path)
-            if recipe_data:
-                loaded_recipes[pdf_path] = recipe_data
-            else:
-                st.error(f"Gagal memuat resep untuk {os.path.basename(pdf_path)}. Proses dihentikan.")
-                all_recipes_valid = False
-                break
+@st.cache_resource
+def get_session_registry():
+    """Satu SessionActivityRegistry per proses server."""
+    return SessionActivityRegistry(SESSION_IDLE_TIMEOUT_S)
 
-    if all_recipes_valid:
-        st.session_state.recipes_to_process = loaded_recipes
-        st.session_state.page = "processing" # Lanjut ke pemrosesan AI
-        # Reset state AI/JSON sebelumnya
-        st.session_state.ai_extracted_data = None
-        st.session_state.final_combined_data = None
-        st.rerun()
-    else:
-        # Jika resep gagal dimuat, beri opsi kembali
-        if st.button("Kembali ke Input Awal"):
-             st.session_state.page = "initial_input"; st.rerun()
-        st.stop()
-        
-# --- LANGKAH 2: PEMROSESAN AI & VERIFIKASI GABUNGAN ---
-elif st.session_state.page == "processing":
-    # [ORIGINAL] Header dan validasi awal
-    st.header("Langkah 2: Verifikasi & Lengkapi Data Gabungan")
-
-    if not st.session_state.get('recipes_to_process'):
-        st.error("Resep dokumen tidak ditemukan. Kembali ke langkah awal.")
-        if st.button("Kembali"): st.session_state.page = "initial_input"; st.rerun()
-        st.stop()
-
-    # [ORIGINAL] Gabungkan Placeholders & Examples dari semua resep
-    all_placeholders = {}
-    all_examples = {}
-    valid_recipes = True
-    for pdf_path, recipe_data in st.session_state.recipes_to_process.items():
-        if not recipe_data or "placeholders" not in recipe_data or "examples" not in recipe_data:
-             st.error(f"Struktur resep untuk {os.path.basename(pdf_path)} tidak valid saat diakses kembali.")
-             valid_recipes = False; break
-        for key, value in recipe_data["placeholders"].items():
-            if key not in all_placeholders:
-                all_placeholders[key] = value
-        for key, value in recipe_data["examples"].items():
-            if key not in all_examples:
-                 all_examples[key] = value
-
-    if not valid_recipes:
-        if st.button("Kembali"): st.session_state.page = "initial_input"; st.rerun()
-        st.stop()
-
-    # [ORIGINAL] Tahap AI First Pass (jika belum dijalankan) - DIPERTAHANKAN
-    if 'ai_pass_done' not in st.session_state or not st.session_state.ai_pass_done:
-        with st.spinner("AI sedang menganalisis input Anda untuk ekstraksi awal..."):
-            initial_data = st.session_state.initial_data
-            ai_result = run_ai_first_pass(
-                initial_prompt=initial_data["prompt"],
-                file_uploads=initial_data["files"],
-                all_placeholders=all_placeholders,
-                all_examples=all_examples
-            )
-            st.session_state.ai_extracted_data = ai_result if ai_result else {}
-            st.session_state.ai_pass_done = True
-        st.rerun()
+session_registry = get_session_registry()
+
+def session_payload():
+    """
+    Payload permintaan sesi ini (dict biasa, hanya diubah dari thread script sesi ini). Jika sudah dibuang
+    karena sesi menganggur, seluruh halaman dijalankan ulang agar main() mereset sesi.
+    """
+    payload = session_registry.payload(st.session_state.get(SESSION_PAYLOAD_HANDLE_KEY))
+    if payload is None:
+        st.rerun(scope="app")
+    upload_text_store.keep_alive((payload.get("initial_data") or {}).get("files", {}).values())
+    return payload
+
+# --- Job Latar Belakang ---
+class Job:
+    """
+    Satu pekerjaan latar belakang: status, hasil/error, progres parsial, dan konteks session untuk dipulihkan.
+    token adalah rahasia acak yang hanya dikenal browser pengirim (disimpan di URL di samping ID job);
+    konteks hanya boleh dipulihkan oleh pemegang token tersebut.
+    """
 
-    # [MODIFIED] Tampilkan Hasil AI & Formulir Verifikasi dengan visual indicator
-    ai_data = st.session_state.ai_extracted_data
+    def __init__(self, kind, context=None):
+        self.id = uuid.uuid4().hex[:12]
+        self.token = secrets.token_urlsafe(16)
+        self.kind = kind
+        self.context = dict(context or {})
+        self.status = "queued" # queued -> running -> done | error
+        self.result = None
+        self.error = None
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self._progress = []
+        self._lock = threading.Lock()
+
+    @property
+    def done(self):
+        return self.status in ("done", "error")
+
+    def add_progress(self, item):
+        """Dipanggil dari thread pekerja untuk melaporkan hasil parsial."""
+        with self._lock:
+            self._progress.append(item)
+
+    def progress(self):
+        with self._lock:
+            return list(self._progress)
+
+    def elapsed(self):
+        return (self.finished_at or time.time()) - (self.started_at or self.created_at)
+
+class JobManager:
+    """
+    Worker pool lokal-proses dengan ID job. Halaman mengirim pekerjaan lalu mem-poll statusnya,
+    sehingga rerun/refresh tidak membuang pekerjaan dan satu proses bisa melayani banyak pengguna.
+    """
 
-    st.info("AI telah mencoba mengekstrak informasi berikut untuk semua dokumen. Silakan periksa, perbaiki, dan lengkapi data manual di bawah ini.")
-    with st.expander("Lihat Hasil Mentah Ekstraksi AI"):
-        if isinstance(ai_data, dict) and "error" in ai_data:
-             st.error(f"Ekstraksi AI gagal: {ai_data['error']}")
-        elif not ai_data:
-             st.warning("Tidak ada data yang berhasil diekstrak oleh AI.")
+    def __init__(self, max_workers=JOB_MAX_WORKERS, retention_s=JOB_RETENTION_S):
+        self.retention_s = retention_s
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="job")
+        self._jobs = {}
+        self._lock = threading.Lock()
+
+    def submit(self, kind, fn, context=None):
+        """fn(job) dijalankan di worker pool; nilai kembaliannya menjadi job.result."""
+        self._prune()
+        job = Job(kind, context)
+        with self._lock:
+            self._jobs[job.id] = job
+        self._executor.submit(self._run, job, fn)
+        return job
+
+    def _run(self, job, fn):
+        job.status = "running"
+        job.started_at = time.time()
+        try:
+            job.result = fn(job)
+            job.finished_at = time.time()
+            job.status = "done"
+        except Exception as e:
+            job.error = f"{type(e).__name__}: {e}"
+            job.finished_at = time.time()
+            job.status = "error"
+
+    def get(self, job_id):
+        """Mengambil job berdasarkan ID (untuk sesi yang mencatat ID tersebut di session_state)."""
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def get_with_token(self, job_id, token):
+        """Mengambil job untuk dipulihkan dari URL; job dianggap tidak ada jika token tidak cocok."""
+        job = self.get(job_id)
+        if job is None or not hmac.compare_digest(job.token.encode(), str(token or "").encode()):
+            return None
+        return job
+
+    def _prune(self):
+        cutoff = time.time() - self.retention_s
+        with self._lock:
+            for job_id in [job_id for job_id, job in self._jobs.items() if job.done and job.finished_at < cutoff]:
+                del self._jobs[job_id]
+
+    def stats(self):
+        with self._lock:
+            statuses = Counter(job.status for job in self._jobs.values())
+        return {"queued": statuses["queued"], "running": statuses["running"],
+                "finished": statuses["done"] + statuses["error"]}
+
+@st.cache_resource
+def get_job_manager():
+    """Satu JobManager per proses server, dipakai bersama oleh semua sesi."""
+    return JobManager()
+
+job_manager = get_job_manager()
+
+def start_job(kind, fn, session_key, context=None):
+    """
+    Mengirim job dan mencatat ID-nya di session_state[session_key] serta di URL (?job=&token=),
+    sehingga browser yang sama bisa menyambung ke job tersebut setelah refresh (session_id baru).
+    ID job saja tidak cukup untuk memulihkan data permintaan; token rahasianya juga harus cocok. Dipanggil dari thread utama.
+    """
+    job = job_manager.submit(kind, fn, context=context)
+    job.context[session_key] = job.id
+    st.session_state[session_key] = job.id
+    st.query_params["job"] = job.id
+    st.query_params["token"] = job.token
+    return job
+
+def restore_job_context(context, payload):
+    """Memulihkan konteks job ke sesi ini: payload permintaan ke session_registry, sisanya ke session_state."""
+    for key, value in context.items():
+        if key in SESSION_PAYLOAD_KEYS:
+            payload[key] = value
         else:
-             st.json(ai_data)
+            st.session_state[key] = value
 
+@st.fragment(run_every=JOB_POLL_INTERVAL_S)
+def poll_job(job, message, show_progress=None):
+    """
+    Menampilkan status job yang belum selesai (menggantikan st.spinner yang memblokir). Sebagai fragment
+    dengan run_every, hanya status ini yang dijalankan ulang setiap JOB_POLL_INTERVAL_S tanpa menahan
+    thread script; setelah job selesai, halaman dijalankan ulang sekali untuk menampilkan hasilnya.
+    show_progress(job), jika diberikan, menampilkan hasil parsial pada setiap putaran.
+    """
+    if job.done:
+        st.rerun(scope="app")
+    queue_depth = llm_rate_limiter.stats()["queue_depth"]
+    st.info(f"⏳ {message} ({job.elapsed():.0f} dtk)" + (f" — {queue_depth} panggilan AI sedang antre" if queue_depth else ""))
+    if show_progress is not None:
+        show_progress(job)
+
+# --- Mode Batch (tanpa UI) ---
+def read_attachment_text(path):
+    """
+    Membaca teks lampiran dari path lokal (.pdf atau .txt) dengan batas dan cache ekstraksi
+    yang sama dengan upload di UI. Mengembalikan (teks, catatan).
+    """
+    mime_type = "application/pdf" if path.lower().endswith(".pdf") else "text/plain"
+    with open(path, "rb") as f:
+        file_bytes = f.read()
+    if len(file_bytes) > UPLOAD_MAX_FILE_MB * 1024 * 1024:
+        return "", [f"File melebihi batas {UPLOAD_MAX_FILE_MB:.0f} MB dan dilewati."]
+    file_digest = hashlib.sha256(file_bytes).hexdigest()
+    text, notes = extract_text(file_digest, mime_type, io.BytesIO(file_bytes), memoryview(file_bytes))
+    return text.strip(), notes
+
+def process_request_headless(description, budget=None, attachment_paths=(), use_cache=True, priority=LLM_PRIORITY_BATCH):
+    """
+    Menjalankan alur initial_input → processing → results tanpa UI untuk satu permintaan:
+    deteksi budget, pemilihan set template, ekstraksi AI paralel per resep, kalkulasi _CALCULATED,
+    dan pembangunan payload Apps Script. Tidak memanggil st.* sehingga aman dari thread pekerja.
+    Panggilan AI memakai prioritas batch secara default agar tidak menyerobot antrean pengguna UI.
+    Mengembalikan dict berisi budget, template_set, final_data, payload, messages, dan error.
+    """
+    result = {
+        "budget": budget, "budget_source": "input" if budget is not None else None,
+        "template_set": None, "final_data": {}, "payload": None, "messages": [], "error": None,
+    }
+    if not model:
+        result["error"] = "MODEL_AI_TIDAK_TERKONFIGURASI"
+        return result
+
+    if budget is None:
+        try:
+            result["budget"], result["budget_source"] = detect_budget(description, use_cache=use_cache, priority=priority)
+        except (RuntimeError, ValueError) as e:
+            result["error"] = f"Budget tidak dapat terdeteksi dari deskripsi: {e}"
+            return result
+    if result["budget"] is None:
+        result["error"] = "Budget tidak dapat terdeteksi dari deskripsi."
+        return result
+
+    template_set_name = select_template_set(result["budget"], description)
+    result["template_set"] = template_set_name
+    template_set = recipe_registry.get_template_set(template_set_name)
+    if template_set["errors"]:
+        result["error"] = " | ".join(template_set["errors"])
+        return result
+    recipes = template_set["recipes"]
+
+    upload_texts = {}
+    for path in attachment_paths:
+        name = os.path.basename(path)
+        try:
+            upload_texts[name], notes = read_attachment_text(path)
+        except OSError as e:
+            result["messages"].append(f"Gagal membaca lampiran {name}: {e}")
+            continue
+        result["messages"].extend(f"{name}: {note}" for note in notes)
+
+    known_data, history_entry = history_known_data(template_set_name, description, template_set["placeholders"])
+    if history_entry:
+        result["messages"].append(f"{len(known_data)} field diisi dari riwayat proyek '{history_entry['title']}'.")
+    extraction = extract_initial_data(description, upload_texts, recipes, template_set["placeholders"],
+                                      template_set["examples"], mode=AI_EXTRACTION_MODE, use_cache=use_cache,
+                                      priority=priority, known_data=known_data)
+    if extraction["error"]:
+        result["error"] = extraction["error"]
+        return result
+    result["messages"].extend(extraction["warnings"])
+
+    # Setara dengan perform_calculations, tetapi pesan dikumpulkan alih-alih ditampilkan
+    final_data = extraction["data"]
+    result["messages"].extend(message for _, message in template_set["formula_engine"].evaluate(final_data))
+    result["final_data"] = final_data
+
+    result["payload"], payload_errors = build_batch_payload(recipes, final_data)
+    result["messages"].extend(payload_errors)
+    return result
+
+# --- Fragment Halaman ---
+@st.fragment
+def show_json_preview(label, data, key):
+    """Expander JSON yang isinya baru dirender saat dibuka; membuka/menutupnya hanya menjalankan ulang fragment ini."""
+    expander = st.expander(label, key=key, on_change="rerun")
+    if expander.open:
+        with expander:
+            st.json(data)
+
+def start_field_regeneration(template_set):
+    """Callback tombol regenerasi: menjalankan job regenerasi untuk field yang dipilih (sebelum fragment dijalankan ulang)."""
+    field_keys = list(st.session_state.get("regen_fields") or [])
+    running_job = job_manager.get(st.session_state.get("regen_job_id"))
+    # st.rerun tidak berlaku di callback; payload yang sudah dibuang direset oleh main() pada run berikutnya
+    payload = session_registry.payload(st.session_state.get(SESSION_PAYLOAD_HANDLE_KEY))
+    if not field_keys or payload is None or (running_job is not None and not running_job.done):
+        return
+    initial_data = payload["initial_data"]
+    placeholders, examples = template_set["placeholders"], template_set["examples"]
+    current_values = {key: st.session_state.get(f"input_{key}") for key in field_keys}
+    start_job(
+        "regenerasi_field",
+        lambda job: regenerate_fields(field_keys, initial_data["prompt"], collect_upload_texts(initial_data["files"]),
+                                      placeholders, examples, current_values),
+        "regen_job_id",
+        context={
+            "page": "processing",
+            "ai_pass_done": True,
+            "regen_fields": field_keys,
+            "initial_data": initial_data,
+            "budget": st.session_state.get("budget"),
+            "budget_source": st.session_state.get("budget_source"),
+            "template_set_name": st.session_state.get("template_set_name"),
+            "recipes_to_process": st.session_state.get("recipes_to_process"),
+            "ai_extracted_data": payload.get("ai_extracted_data"),
+        }
+    )
+
+@st.fragment
+def field_regeneration_panel(template_set):
+    """
+    Regenerasi field tertentu dengan AI tanpa mengulang ekstraksi penuh. Selama job berjalan hanya panel ini
+    yang dijalankan ulang; setelah selesai, nilai baru ditulis ke state widget formulir lalu halaman dirender ulang.
+    """
+    all_placeholders = template_set["placeholders"]
+    regen_job = job_manager.get(st.session_state.get("regen_job_id"))
+    if regen_job is not None and regen_job.done:
+        del st.session_state["regen_job_id"]
+        if regen_job.status == "done":
+            regenerated = regen_job.result["data"]
+            # Widget formulir belum dibuat pada run ini, jadi state-nya boleh diganti langsung
+            for key, value in regenerated.items():
+                st.session_state[f"input_{key}"] = verification_widget_value(all_placeholders[key], value)
+            payload = session_payload()
+            if isinstance(payload.get("ai_extracted_data"), dict):
+                payload["ai_extracted_data"] = {**payload["ai_extracted_data"], **regenerated}
+            st.session_state.regen_report = {"fields": sorted(regenerated), "errors": regen_job.result["errors"]}
+        else:
+            st.session_state.regen_report = {"fields": [], "errors": [f"semua field: {regen_job.error}"]}
+        st.rerun() # Seluruh halaman, agar formulir verifikasi menampilkan nilai baru
+
+    running = regen_job is not None
+    options = [key for key in all_placeholders if not key.endswith("_CALCULATED")]
+    with st.container(border=True):
+        st.multiselect("Regenerasi field tertentu dengan AI (satu panggilan kecil per field, dijalankan bersamaan):",
+                       options, format_func=lambda key: placeholder_label(key, all_placeholders[key]).rstrip(":"),
+                       key="regen_fields", disabled=running)
+        st.button("🔄 Regenerasi Field Terpilih", on_click=start_field_regeneration, args=(template_set,),
+                  disabled=running or not st.session_state.get("regen_fields"))
+        regen_report = st.session_state.pop("regen_report", None)
+        if regen_report:
+            if regen_report["fields"]:
+                st.success(f"Field diperbarui: {', '.join(regen_report['fields'])}. Periksa kembali sebelum verifikasi.")
+            for error in regen_report["errors"]:
+                st.warning(f"Regenerasi gagal untuk {error}")
+        if running:
+            poll_job(regen_job, f"Meregenerasi {len(st.session_state.get('regen_fields') or [])} field...")
+
+@st.fragment
+def verification_form(template_set, ai_data):
+    """
+    Form verifikasi sebagai fragment: interaksi lain di halaman pemrosesan tidak membangun ulang
+    widget semua placeholder, dan submit hanya menjalankan fragment ini sampai pindah ke halaman hasil.
+    """
+    all_placeholders = template_set["placeholders"]
     with st.form("verification_form_combined"):
         st.markdown("**Data Gabungan untuk Dokumen (Silakan Edit/Lengkapi):**")
         widget_keys = {}
@@ -775,38 +3331,31 @@ elif st.session_state.page == "processing":
         # [MERGED] Loop dengan pendeteksi tipe dari MODIFIED tapi logika input dari ORIGINAL
         for key, value_obj in all_placeholders.items():
             if not key.endswith("_CALCULATED"):
-                label = f"{key.replace('_', ' ').title()}:"
+                label = placeholder_label(key, value_obj)
                 ai_extracted_value = ai_data.get(key) if isinstance(ai_data, dict) else None
                 instruction_or_default = value_obj.get("instruction") if isinstance(value_obj, dict) else value_obj
                 widget_key = f"input_{key}"
                 widget_keys[key] = widget_key
+                # Nilai awal lewat session_state (bukan value=) agar regenerasi field bisa mengganti isi widget
+                if widget_key not in st.session_state:
+                    st.session_state[widget_key] = verification_widget_value(value_obj, ai_extracted_value)
 
                 # [NEW] Deteksi field AI dan tambahkan visual indicator
                 is_ai_task = isinstance(instruction_or_default, str) and instruction_or_default.startswith("{")
                 if is_ai_task:
-                    ai_task_keys.add(key)
-                    label = f"(AI) {label}"  # Visual indicator dari MODIFIED
-                    default_value = str(ai_extracted_value) if ai_extracted_value is not None else ""
+                    ai_task_keys.add(key) # Label sudah diberi awalan "(AI)" oleh placeholder_label
                     # [MODIFIED] Gunakan text_area untuk AI field agar bisa diedit
-                    st.text_area(label, value=default_value, key=widget_key, height=100)
+                    st.text_area(label, key=widget_key, height=100)
                 else:
                     # [ORIGINAL] Gunakan logika asli untuk field non-AI
                     if isinstance(instruction_or_default, str):
-                        default_value_txt = str(ai_extracted_value) if ai_extracted_value is not None else ""
                         # [ORIGINAL] Heuristik untuk textarea
-                        if key in ["Isi_BA", "Bukti_BA", "Alasan", "Alasan_detail"] or len(default_value_txt) > 80:
-                            st.text_area(label, value=default_value_txt, key=widget_key, height=100)
+                        if key in ["Isi_BA", "Bukti_BA", "Alasan", "Alasan_detail"] or len(st.session_state[widget_key]) > 80:
+                            st.text_area(label, key=widget_key, height=100)
                         else:
-                            st.text_input(label, value=default_value_txt, key=widget_key)
+                            st.text_input(label, key=widget_key)
                     elif instruction_or_default is None or isinstance(instruction_or_default, (int, float)):
-                        default_value_num = None
-                        if ai_extracted_value is not None:
-                            # [ORIGINAL] Pembersihan regex untuk angka
-                            try:
-                                cleaned_val_str = re.sub(r'(IDR|\s|,-?$)', '', str(ai_extracted_value))
-                                if cleaned_val_str: default_value_num = float(cleaned_val_str) if '.' in cleaned_val_str else int(cleaned_val_str)
-                            except: default_value_num = None
-                        st.number_input(label, value=default_value_num, format=None, key=widget_key)
+                        st.number_input(label, value=None, format=None, key=widget_key)
 
         # [MODIFIED] Tombol dengan teks baru
         verification_submitted = st.form_submit_button("Verifikasi Selesai, Jalankan AI & Kalkulasi")
@@ -818,17 +3367,16 @@ elif st.session_state.page == "processing":
             # [NEW] Jalankan AI sequential & kalkulasi dengan status message
             with st.spinner("Menjalankan tugas AI & kalkulasi..."):
                 final_data = user_verified_data.copy()
-                
+
                 # [MODIFIED] Proses AI task secara berurutan untuk dependensi
                 for key in ai_task_keys:
                     user_value = final_data.get(key, "")
-                    instruction = all_placeholders[key].get("instruction", "") if isinstance(all_placeholders[key], dict) else ""
-                    
+
                     # [MODIFIED] Lewati jika field dikosongkan oleh user
                     if not user_value.strip():
                         st.write(f"⏭️ Melewatkan tugas AI untuk `{key}` (dihapus oleh pengguna).")
                         continue
-                    
+
                     # [MODIFIED] Gunakan nilai yang diedit user
                     final_data[key] = user_value
 
@@ -849,7 +3397,7 @@ elif st.session_state.page == "processing":
                         st.error(f"Error tak terduga saat parsing Bukti_BA: {e}")
                 else:
                     st.write("DEBUG: Bukti_BA adalah string tapi tidak terlihat seperti list, tidak di-parse.")
-            
+
             # [ORIGINAL] Parsing spesial untuk Pembelian dengan semua error handling
             if "Pembelian" in final_data and isinstance(final_data["Pembelian"], str):
                 pembelian_str = final_data["Pembelian"].strip()
@@ -870,150 +3418,585 @@ elif st.session_state.page == "processing":
 
             # [MODIFIED] Status message untuk kalkulasi
             st.write("🧮 Melakukan kalkulasi otomatis...")
-            st.session_state.final_combined_data = perform_calculations(all_placeholders, final_data)
-            
+            payload = session_payload()
+            payload["final_combined_data"] = perform_calculations(all_placeholders, final_data, template_set["formula_engine"])
+
             # [MODIFIED] Cache hasil AI untuk run berikutnya
-            st.session_state.ai_extracted_data = final_data.copy()
+            payload["ai_extracted_data"] = final_data.copy()
 
             # [ORIGINAL] Transisi ke halaman hasil
             st.session_state.page = "results"
             if 'ai_pass_done' in st.session_state: del st.session_state['ai_pass_done']
             st.rerun()
 
-# --- LANGKAH 3: HASIL AKHIR & PENGIRIMAN BATCH ---
-elif st.session_state.page == "results":
-    st.header("Hasil Akhir & Pengiriman ke Google Docs")
+@st.fragment
+def document_dispatch_section(final_combined_data, recipes_to_process):
+    """Pengiriman batch ke Apps Script beserta hasil per dokumen."""
+    st.write("---")
+    st.subheader("Siapkan & Kirim Data Batch ke Google Docs")
 
-    # Ambil data gabungan yang sudah final dan daftar resep
-    final_combined_data = st.session_state.get('final_combined_data')
-    recipes_to_process = st.session_state.get('recipes_to_process')
+    # URL Web App dari environment (APPS_SCRIPT_URL) atau fallback hardcoded
+    apps_script_url = APPS_SCRIPT_WEB_APP_URL
 
-    if final_combined_data and recipes_to_process:
-        st.success("Proses pengumpulan dan kalkulasi data selesai.")
-        with st.expander("Lihat Data Final Gabungan (JSON)"):
-            st.json(final_combined_data)
+    if not apps_script_url:
+        st.error("Error Konfigurasi: URL Web App Google Apps Script tidak ditemukan.")
+    else:
+        recreate_documents = st.checkbox("Buat ulang dokumen yang datanya tidak berubah", value=False,
+                                         disabled=DOC_RESULT_CACHE_DISABLED, key="recreate_documents")
+        running_dispatch = job_manager.get(st.session_state.get("dispatch_job_id"))
+        if st.button("Kirim Data & Buat Semua Dokumen di Google Docs"):
+            batch_payload, payload_errors = build_batch_payload(recipes_to_process, final_combined_data)
+            for payload_error in payload_errors:
+                st.error(payload_error)
+
+            if running_dispatch is not None and not running_dispatch.done:
+                st.info("Pengiriman sebelumnya masih berjalan; klik ganda diabaikan.")
+            elif not batch_payload["documents"]:
+                 st.warning("Tidak ada dokumen valid yang bisa dikirim.")
+            else:
+                # Pengiriman berjalan sebagai job; hasil per dokumen masuk ke progres job begitu chunk-nya selesai.
+                # Data yang menghasilkan dokumen menjadi riwayat untuk permintaan serupa berikutnya
+                history_args = (st.session_state.get("template_set_name"), session_payload()["initial_data"]["prompt"],
+                                final_combined_data)
+                start_job(
+                    "kirim_dokumen",
+                    lambda job: record_produced_project(*history_args, send_batch_payload(
+                        batch_payload, apps_script_url, on_result=job.add_progress, use_cache=not recreate_documents)),
+                    "dispatch_job_id",
+                    context={
+                        "page": "results",
+                        "final_combined_data": final_combined_data,
+                        "recipes_to_process": recipes_to_process,
+                        "template_set_name": st.session_state.get("template_set_name"),
+                    }
+                )
+
+        dispatch_job = job_manager.get(st.session_state.get("dispatch_job_id"))
+        if dispatch_job is not None:
+            # --- Tampilkan hasil batch (per dokumen) ---
+            st.subheader("Hasil Pembuatan Dokumen:")
+            for doc_result in dispatch_job.progress():
+                if doc_result.get("status") == "success" and (doc_result.get("cached") or doc_result.get("deduplicated")):
+                    st.success(f"♻️ Dokumen '{doc_result.get('fileName', 'N/A')}' tidak berubah; memakai dokumen yang sudah dibuat.")
+                    st.markdown(f"   [🔗 Buka Dokumen]({doc_result.get('docUrl')})")
+                elif doc_result.get("status") == "success":
+                    st.success(f"✅ Dokumen '{doc_result.get('fileName', 'N/A')}' berhasil dibuat.")
+                    st.markdown(f"   [🔗 Buka Dokumen]({doc_result.get('docUrl')})")
+                else:
+                    st.error(f"❌ Gagal membuat dokumen dari template ID ...{doc_result.get('templateId', 'N/A')[-12:]}: {doc_result.get('message')}")
+            if dispatch_job.status == "error":
+                st.error(f"Terjadi kesalahan tak terduga saat mengirim/memproses: {dispatch_job.error}")
+            elif not dispatch_job.done:
+                poll_job(dispatch_job, "Mengirim data batch ke Google Apps Script...")
+
+@st.fragment
+def local_render_section(final_combined_data, recipes_to_process):
+    """Render dokumen dari template DOCX lokal beserta tombol unduhnya."""
+    # --- Alternatif: render lokal dari template DOCX (tanpa jaringan), hasil langsung diunduh ---
+    local_documents, _ = build_local_render_jobs(recipes_to_process, final_combined_data)
+    if local_documents:
+        st.write("---")
+        st.subheader("Atau Render Dokumen Secara Lokal")
+        st.caption(f"{len(local_documents)} dari {len(recipes_to_process)} resep memiliki template DOCX lokal.")
+        if st.button(f"Render {len(local_documents)} Dokumen Lokal ({LOCAL_RENDER_FORMAT.upper()})"):
+            history_args = (st.session_state.get("template_set_name"), session_payload()["initial_data"]["prompt"],
+                            final_combined_data)
+            start_job(
+                "render_lokal",
+                lambda job: record_produced_project(*history_args, render_documents_locally(
+                    local_documents, on_result=job.add_progress)),
+                "render_job_id",
+                context={
+                    "page": "results",
+                    "final_combined_data": final_combined_data,
+                    "recipes_to_process": recipes_to_process,
+                    "template_set_name": st.session_state.get("template_set_name"),
+                }
+            )
+
+        render_job = job_manager.get(st.session_state.get("render_job_id"))
+        if render_job is not None:
+            for i, render_result in enumerate(render_job.progress()):
+                if render_result["status"] == "success":
+                    st.download_button(f"⬇️ {render_result['fileName']}", data=render_result["content"],
+                                       file_name=render_result["fileName"], mime=render_result["mime"],
+                                       key=f"download_local_{i}")
+                else:
+                    st.error(f"❌ Gagal merender {render_result['fileName']}: {render_result['message']}")
+            if render_job.status == "error":
+                st.error(f"Terjadi kesalahan tak terduga saat merender dokumen: {render_job.error}")
+            elif not render_job.done:
+                poll_job(render_job, "Merender dokumen secara lokal...")
+
+# --- Tampilan & Logika Aplikasi (State Machine) ---
+# --- Custom Modern Styling (visual only, no functional changes) ---
+# Dirakit sekali saat import; Streamlit membuang elemen yang tidak dirender ulang, jadi tetap dikirim setiap run
+APP_CSS = '''
+<style>
+/* Background and container card */
+.stApp {
+    background: linear-gradient(120deg, #f9fafc 0%, #f1f6fa 100%);
+    color: #222;
+}
+section[data-testid="stSidebar"] {
+    background-color: #f6fbff !important;
+}
+/* Card effect for forms and main panels */
+div[class*="stForm"] {
+    background: #fff !important;
+    border-radius: 18px;
+    padding: 2rem 2.2rem;
+    box-shadow: 0 6px 32px #19537515;
+    border: 1.5px solid #ecf3fc;
+    margin-bottom: 24px;
+}
+/* Headings */
+h1, h2, h3, h4 {
+    color: #195375;
+    letter-spacing: 0.5px;
+}
+/* Buttons */
+button[kind="primary"] {
+    background: linear-gradient(90deg, #318af2 0%, #56c7ff 100%) !important;
+    color: #fff !important;
+    border-radius: 8px !important;
+    box-shadow: 0 2px 12px #318af236;
+    border: none !important;
+    font-weight: 600;
+}
+button[kind="secondary"] {
+    background: #fff !important;
+    border: 1.2px solid #56c7ff !important;
+    border-radius: 8px !important;
+    color: #318af2 !important;
+}
+/* Text Input and Text Area */
+input, textarea {
+    background-color: #f7fafc !important;
+    border-radius: 7px !important;
+    border: 1px solid #cbdbfc !important;
+    padding: 8px 12px !important;
+    transition: box-shadow 0.18s;
+    font-size: 1rem;
+}
+input:focus, textarea:focus {
+    outline: none !important;
+    border-color: #67c3f3 !important;
+    box-shadow: 0 0 0 2px #67c3f342 !important;
+}
+/* File Uploader dropzone */
+div[data-testid="stFileDropzone"] {
+    border: 2px dashed #318af2 !important;
+    background-color: #f0f5fd !important;
+    border-radius: 10px !important;
+}
+/* Expander panels */
+div[data-testid="stExpander"] > div:first-child {
+    background: #f4fafd !important;
+    border-radius: 8px;
+    border: 1px solid #e2eefc;
+}
+/* Info/Warning boxes */
+div[data-testid="stAlertInfo"] {
+    background-color: #e3f0fd !important;
+    color: #153e5c !important;
+}
+div[data-testid="stAlertWarning"] {
+    background-color: #fff7df !important;
+    color: #9b5d06 !important;
+}
+.st-b5 {
+    font-size: 1.16rem !important;
+}
+/* Secondary tweaks as needed */
+</style>
+'''
+
+def main():
+    # --- Konfigurasi & Inisialisasi ---
+    st.set_page_config(page_title="Generator Dokumen Cerdas", page_icon="📝", layout="wide")
+    start_metrics_server() # Endpoint /metrics dijalankan sekali per proses
+
+    st.markdown(APP_CSS, unsafe_allow_html=True)
+
+    # Konfigurasi model AI dilakukan saat import; error ditampilkan di sini
+    if model_error:
+        st.error(model_error)
+        if model_error_fatal:
+            st.stop() # Hentikan aplikasi agar tidak crash di bawah
+
+    # Catat aktivitas sesi ini (sekaligus membuang payload sesi lain yang menganggur); payload permintaan
+    # sesi ini ada di session_registry, session_state hanya memegang handle-nya
+    payload, evicted = session_registry.touch(st.session_state)
+    if evicted:
+        st.query_params.clear()
+        st.warning("Sesi ini tidak aktif terlalu lama sehingga datanya dibersihkan. Silakan mulai permintaan baru.")
+
+    # Inisialisasi session state
+    if 'page' not in st.session_state: st.session_state.page = "initial_input"
+    if 'recipe' not in st.session_state: st.session_state.recipe = None
+    if 'initial_data' not in payload: payload["initial_data"] = {"prompt": "", "files": {}}
+    if 'ai_extracted_data' not in payload: payload["ai_extracted_data"] = None
+    if 'final_json' not in payload: payload["final_json"] = None
+    if 'ai_matches' not in payload: payload["ai_matches"] = None # To store matching titles
+    if 'budget' not in st.session_state: st.session_state.budget = None
+
+    # Browser yang di-refresh (session_id baru) menyambung ke job di URL jika token rahasianya cocok
+    job_param = st.query_params.get("job")
+    if job_param and st.session_state.page == "initial_input" and not payload["initial_data"]["prompt"]:
+        restored_job = job_manager.get_with_token(job_param, st.query_params.get("token"))
+        if restored_job is not None:
+            restore_job_context(restored_job.context, payload)
+        else:
+            st.query_params.clear()
+
+    session_payload_bytes, trimmed_keys = enforce_session_payload_cap(
+        payload, SESSION_MAX_PAYLOAD_MB * 1024 * 1024, st.session_state.page)
+    if "initial_data" in trimmed_keys:
+        # Data inti permintaan sendiri melebihi batas: permintaan ditolak, bukan disimpan melebihi batas
+        clear_session_state(st.session_state)
+        st.session_state.page = "initial_input"
+        payload["initial_data"] = {"prompt": "", "files": {}}
+        st.query_params.clear()
+        st.error(f"Data permintaan ini melebihi batas memori sesi ({SESSION_MAX_PAYLOAD_MB:g} MB) sehingga dibuang. "
+                 "Persingkat deskripsi atau kurangi dokumen pendukung, lalu mulai lagi.")
+    # Teks dokumen pendukung diperpanjang selama sesi yang merujuknya masih aktif
+    expired_uploads = upload_text_store.keep_alive(payload["initial_data"].get("files", {}).values())
+    if expired_uploads:
+        st.error(f"Teks dokumen pendukung sudah kedaluwarsa: {', '.join(expired_uploads)}. "
+                 "Mulai permintaan baru dan unggah ulang dokumen tersebut.")
+
+    st.title("AI Document Generator")
+
+    # --- Sidebar: Status Cache AI ---
+    with st.sidebar:
+        st.subheader("Cache AI")
+        if LLM_CACHE_DISABLED:
+            st.caption("Cache dimatikan melalui LLM_CACHE_DISABLED=1.")
+        else:
+            st.toggle("Abaikan cache (paksa panggil AI)", value=False, key="bypass_llm_cache")
+        cache_stats = llm_cache.stats()
+        st.caption(f"Entri: {cache_stats['entries']} | Hit: {cache_stats['hits']} | Miss: {cache_stats['misses']} "
+                   f"| Hit rate: {cache_stats['hit_rate']:.0%}")
+        if st.button("Kosongkan Cache AI"):
+            llm_cache.clear()
+            st.rerun()
+        job_stats = job_manager.stats()
+        st.caption(f"Job: {job_stats['running']} berjalan | {job_stats['queued']} antre | {job_stats['finished']} selesai")
+        limiter_stats = llm_rate_limiter.stats()
+        st.caption(f"Antrean AI: {limiter_stats['queue_depth']} menunggu | {limiter_stats['active']} aktif "
+                   f"| Tunggu rata-rata: {limiter_stats['avg_wait_s']:.1f} dtk (maks {limiter_stats['max_wait_s']:.1f})")
+        st.caption(f"Memori sesi: {session_payload_bytes / 1024:.0f} KB (batas {SESSION_MAX_PAYLOAD_MB:g} MB) "
+                   f"| Sesi aktif: {session_registry.stats()['sessions']}")
+        if trimmed_keys:
+            st.caption(f"Data dipangkas agar sesi tetap di bawah batas: {', '.join(trimmed_keys)}")
+        startup_stats = startup_report.stats()
+        if startup_stats["cold_start_s"] is not None:
+            import_summary = ", ".join(f"{name} {seconds:.2f}"
+                                       for name, seconds in sorted(startup_stats["imports"].items(), key=lambda item: -item[1]))
+            st.caption(f"Startup: cold start {startup_stats['cold_start_s']:.2f} dtk | setup run ini "
+                       f"{startup_stats['last_setup_s'] * 1000:.0f} ms" + (f" | Import: {import_summary}" if import_summary else ""))
+
+    # --- LANGKAH 1: INPUT AWAL & INTEGRASI GSHEET ---
+    if st.session_state.page == "initial_input":
+        st.header("Langkah 1: Jelaskan Kebutuhan Anda")
+        get_active_sheet_mirror() # Salinan lokal sheet disegarkan di latar belakang selagi pengguna mengetik
+
+        # Form untuk input pengguna
+        with st.form("initial_input_form", clear_on_submit=False): # Keep clear_on_submit=False
+            st.info("Masukkan deskripsi kebutuhan Anda, termasuk estimasi budget.")
+            # Berikan key unik ke text_area DAN simpan widget ke variabel
+            initial_prompt_input = st.text_area( # <-- Simpan widget ke variabel ini
+                "Deskripsi Kebutuhan:",
+                height=350, # Membuatkan text area dapat di-scroll
+                max_chars=10000, # Membuatkan text area dapat menampung input yang sangat besar
+                placeholder="Contoh: pengadaan fasilitas perangkat laptop penunjang kinerja personil TI \nPrognosa 2025 100jt.\nTerpakai 0.\nUsulan anggaran 17,5jt.\nAnggaran kalimat tujuh belas koma lima juta.\nPos Anggaran VI. 3 (Biaya Perbaikan Aplikasi Infrastruktur).\nTanggal 10 Oktober 2025. Rkap 2025 26.401.000.000.\nNilai Kontrak po 2025 20.850.959.696.\npr 1.165.000.000.\nbudget pembuatan rab & rks 1.628.894.000.\nharga pembelian 22 jt.\npembatalan garansi dilakukan apabila terjadi kelalaian pegawai yang akan ditanggung oleh PT TPS.\nContract execution 1 bulan",
+                key="prompt_input_key" # Key tetap ada, berguna nanti
+            )
+            uploaded_files_list = st.file_uploader(
+                "Unggah Dokumen Pendukung Apapun (Opsional, .pdf atau .txt)",
+                type=['pdf', 'txt'], accept_multiple_files=True, key="initial_uploader"
+            )
+            submitted = st.form_submit_button("Analisis & Lanjut ke Pemrosesan Dokumen")
+
+            if submitted:
+                prompt_value_from_input = initial_prompt_input
+
+                if not prompt_value_from_input: # Periksa nilai yang didapat dari widget
+                    st.warning("Harap isi deskripsi kebutuhan.")
+                else:
+                    # Simpan data input awal (gunakan nilai yang sudah dibaca)
+                    # Unggahan langsung diekstrak; session hanya menyimpan hash + teks (bukan isi file mentah)
+                    payload["initial_data"] = {
+                        "prompt": prompt_value_from_input, # Simpan nilai yang benar
+                        "files": collect_upload_refs(uploaded_files_list)
+                    }
+
+                    # Deteksi budget (parser lokal dulu, LLM hanya jika hasilnya ragu) dijalankan sebagai job
+                    use_cache = llm_cache_enabled_for_session()
+                    start_job("budget", lambda job: detect_budget(prompt_value_from_input, use_cache=use_cache),
+                              "budget_job_id", context={"initial_data": payload["initial_data"]})
+
+        # Tunggu job budget, lalu lanjutkan pencocokan GSheet & pemilihan halaman berikutnya
+        budget_job = job_manager.get(st.session_state.get("budget_job_id"))
+        if budget_job is not None:
+            if not budget_job.done:
+                poll_job(budget_job, "Menganalisis budget...")
+                st.stop() # Langkah berikutnya menunggu hasil job; poller menjalankan ulang halaman setelah selesai
+            del st.session_state["budget_job_id"]
+            # Job yang gagal diperlakukan seperti budget tidak terdeteksi; pesan error-nya ditampilkan di langkah berikutnya
+            budget, budget_source = budget_job.result if budget_job.status == "done" else (None, "AI")
+            st.session_state.budget = budget
+            st.session_state.budget_source = budget_source
+            st.session_state.budget_error = budget_job.error
+            prompt_value_from_input = payload["initial_data"]["prompt"]
+
+            # --- LOGIKA PENCOCOKAN GSHEET ---
+            gsheet_enabled = st.session_state.get("use_gsheet_toggle", False)
+            # Judul diambil dari salinan lokal sheet (tidak pernah menunggu penyegaran yang sedang berjalan)
+            sheet_mirror = get_active_sheet_mirror()
+            gsheet_titles = list(sheet_mirror.titles) if sheet_mirror else []
+
+            if gsheet_enabled and gsheet_titles:
+                st.info("Fitur Google Sheet aktif, mencoba mencocokkan...") # Info tambahan
+                with st.spinner("Mencocokkan permintaan Anda dengan data proyek..."):
+                    ai_match_response = find_prompt_matches(prompt_value_from_input, gsheet_titles, use_cache=llm_cache_enabled_for_session())
+                matches = ai_match_response.get("matches", [])
+                payload["ai_matches"] = matches # Simpan hasil pencocokan
+
+                if matches:
+                    st.session_state.page = "disambiguation" # Pindah ke halaman konfirmasi
+                else:
+                    st.info("Tidak ditemukan data proyek yang cocok di Google Sheet.")
+                    st.session_state.page = "load_recipes_and_process" # Lanjut tanpa konfirmasi
+            else: # Lanjut tanpa pencocokan
+                if gsheet_enabled:
+                     st.warning("Pencarian Google Sheet diaktifkan, tetapi data belum dimuat/kosong/tidak valid.")
+                ## st.info("Melanjutkan tanpa menggunakan data dari Google Sheet.")
+                st.session_state.page = "load_recipes_and_process"
+            st.rerun()
+
+    elif st.session_state.page == "disambiguation":
+        st.header("Konfirmasi Proyek Terkait")
+        st.info("AI menemukan kemungkinan proyek terkait di Google Sheet berdasarkan permintaan Anda.")
+
+        matches = payload.get("ai_matches", [])
+        sheet_mirror = get_active_sheet_mirror()
+
+        if not matches or sheet_mirror is None:
+            st.error("Data pencocokan tidak ditemukan. Kembali ke awal.")
+            if st.button("Kembali"): st.session_state.page = "initial_input"; st.rerun()
+            st.stop()
+
+        # Tambahkan opsi "Bukan salah satu di atas"
+        options = matches + ["Bukan salah satu di atas / Permintaan Baru"]
+
+        # Gunakan radio button jika sedikit pilihan, selectbox jika banyak
+        if len(options) <= 5:
+            selected_title = st.radio("Manakah proyek yang Anda maksud?", options, index=0, key="match_selector")
+        else:
+            selected_title = st.selectbox("Manakah proyek yang Anda maksud?", options, index=0, key="match_selector")
+
+        if st.button("Konfirmasi Pilihan & Lanjutkan"):
+            augmented_prompt = payload["initial_data"]["prompt"] # Mulai dengan prompt asli
+
+            # Cari baris data yang sesuai lewat indeks Title di salinan lokal sheet
+            selected_row = None
+            if selected_title != "Bukan salah satu di atas / Permintaan Baru":
+                selected_row = sheet_mirror.get_row(selected_title)
+                if selected_row is None:
+                    st.warning(f"Proyek '{selected_title}' sudah tidak ada di Google Sheet.")
+            if selected_row is not None:
+                # Augmentasi prompt
+                augmented_prompt = augment_prompt_with_gsheet_data(augmented_prompt, selected_row)
+                st.success(f"Data dari proyek '{selected_title}' akan ditambahkan ke konteks.")
+                # Tampilkan data yang ditambahkan (opsional)
+                with st.expander("Lihat Data yang Ditambahkan"):
+                     st.dataframe(selected_row.to_frame().T) # Tampilkan sebagai tabel kecil
+            else:
+                st.info("Melanjutkan hanya dengan deskripsi awal Anda.")
+
+            # Update prompt di initial_data sebelum lanjut
+            payload["initial_data"]["prompt"] = augmented_prompt
+            # Lanjut ke tahap pemuatan resep
+            st.session_state.page = "load_recipes_and_process"
+            st.rerun()
 
         st.write("---")
-        st.subheader("Siapkan & Kirim Data Batch ke Google Docs")
+        if st.button("Batalkan & Kembali ke Input Awal"):
+            st.session_state.page = "initial_input"
+            # Reset state yang relevan
+            payload["ai_matches"] = None
+            st.rerun()
 
-        # Ambil URL Web App dari Secrets atau fallback
-        # apps_script_url = st.secrets.get("APPS_SCRIPT_WEB_APP_URL")
-        apps_script_url = "https://script.google.com/macros/s/AKfycbzly2uf47C9_6pknw9-VmY8n1OmpOmt2sAwqKgtTZSlBiwYF0MAla4DdbqULOhkrUUi/exec"
-        if not apps_script_url:
-            apps_script_url = "https://script.google.com/macros/s/AKfycbzly2uf47C9_6pknw9-VmY8n1OmpOmt2sAwqKgtTZSlBiwYF0MAla4DdbqULOhkrUUi/exec" # Fallback
-            st.warning("URL Apps Script diambil dari kode (hardcoded).")
+    # --- LANGKAH 1.8 (DIMODIFIKASI): Tentukan & Muat Resep yang Relevan ---
+    elif st.session_state.page == "load_recipes_and_process":
+
+        # Ambil data yang dibutuhkan untuk membuat keputusan
+        budget = st.session_state.get('budget')
+        # Ambil prompt yang mungkin sudah di-augmentasi oleh GSheet
+        prompt_text = payload["initial_data"].get("prompt", "").lower()
+
+        st.info("Menganalisis kondisi...")
+        st.caption(f"Budget terdeteksi: {budget} (sumber: {st.session_state.get('budget_source', 'AI')})")
+        st.caption(f"Prompt (awal): {prompt_text[:70]}...")
+
+        # --- Logika Pemilihan Template Dinamis ---
+        if budget is None:
+            st.error("Budget tidak dapat terdeteksi dari deskripsi Anda. Tidak dapat melanjutkan.")
+            if st.session_state.get("budget_error"):
+                st.error(f"Analisis budget oleh AI gagal: {st.session_state.budget_error}")
+            if st.button("Kembali ke Input Awal"):
+                st.session_state.page = "initial_input"; st.rerun()
+            st.stop()
+
+        template_set_name = select_template_set(budget, prompt_text)
+        if not template_set_name:
+             st.error("Tidak ada set template yang cocok dengan kondisi Anda. Proses dihentikan.")
+             if st.button("Kembali"): st.session_state.page = "initial_input"; st.rerun()
+             st.stop()
+
+        # --- Ambil Set Resep dari Registry (tanpa I/O file jika tidak ada yang berubah) ---
+        template_set = recipe_registry.get_template_set(template_set_name)
+
+        if not template_set["errors"]:
+            st.session_state.template_set_name = template_set_name
+            st.session_state.recipes_to_process = template_set["recipes"]
+            st.session_state.page = "processing" # Lanjut ke pemrosesan AI
+            # Reset state AI/JSON sebelumnya
+            payload["ai_extracted_data"] = None
+            payload["final_combined_data"] = None
+            st.rerun()
+        else:
+            for error in template_set["errors"]:
+                st.error(error)
+            st.error("Gagal memuat resep untuk set template yang dipilih. Proses dihentikan.")
+            # Jika resep gagal dimuat, beri opsi kembali
+            if st.button("Kembali ke Input Awal"):
+                 st.session_state.page = "initial_input"; st.rerun()
+            st.stop()
+
+    # --- LANGKAH 2: PEMROSESAN AI & VERIFIKASI GABUNGAN ---
+    elif st.session_state.page == "processing":
+        # [ORIGINAL] Header dan validasi awal
+        st.header("Langkah 2: Verifikasi & Lengkapi Data Gabungan")
+
+        if not st.session_state.get('recipes_to_process') or not st.session_state.get('template_set_name'):
+            st.error("Resep dokumen tidak ditemukan. Kembali ke langkah awal.")
+            if st.button("Kembali"): st.session_state.page = "initial_input"; st.rerun()
+            st.stop()
+
+        # Placeholders & Examples gabungan sudah disiapkan oleh registry (cukup lookup dict per rerun)
+        template_set = recipe_registry.get_template_set(st.session_state.template_set_name)
+        if template_set["errors"]:
+            for error in template_set["errors"]:
+                st.error(error)
+            if st.button("Kembali"): st.session_state.page = "initial_input"; st.rerun()
+            st.stop()
+        st.session_state.recipes_to_process = template_set["recipes"]
+        all_placeholders = template_set["placeholders"]
+        all_examples = template_set["examples"]
+
+        # [ORIGINAL] Tahap AI First Pass (jika belum dijalankan) - sekarang sebagai job latar belakang
+        if 'ai_pass_done' not in st.session_state or not st.session_state.ai_pass_done:
+            extraction_job = job_manager.get(st.session_state.get("extraction_job_id"))
+            if extraction_job is None:
+                initial_data = payload["initial_data"]
+                use_cache = llm_cache_enabled_for_session()
+                recipes = st.session_state.recipes_to_process
+                # Permintaan yang mirip proyek sebelumnya (misal perpanjangan) diisi dari riwayat
+                known_data, history_entry = history_known_data(st.session_state.template_set_name, initial_data["prompt"], all_placeholders)
+                st.session_state.history_match = (
+                    {"title": history_entry["title"], "score": history_entry["score"], "known_fields": len(known_data)}
+                    if history_entry else None
+                )
+                extraction_job = start_job(
+                    "ekstraksi",
+                    lambda job: extract_initial_data(
+                        initial_data["prompt"], collect_upload_texts(initial_data["files"]), recipes, all_placeholders, all_examples,
+                        mode=AI_EXTRACTION_MODE, use_cache=use_cache,
+                        on_field=(lambda key, value: job.add_progress((key, value))) if AI_EXTRACTION_STREAMING else None,
+                        known_data=known_data
+                    ),
+                    "extraction_job_id",
+                    context={
+                        "page": "processing",
+                        "initial_data": initial_data, # Ref unggahan kecil, aman dipulihkan sesi baru
+                        "budget": st.session_state.get("budget"),
+                        "budget_source": st.session_state.get("budget_source"),
+                        "template_set_name": st.session_state.template_set_name,
+                        "recipes_to_process": recipes,
+                        "history_match": st.session_state.history_match,
+                    }
+                )
+            if not extraction_job.done:
+                poll_job(extraction_job, "AI sedang menganalisis input Anda untuk ekstraksi awal...",
+                         show_progress=(lambda job: show_live_fields(all_placeholders, job.progress()))
+                         if AI_EXTRACTION_STREAMING else None)
+                st.stop() # Langkah berikutnya menunggu hasil job; poller menjalankan ulang halaman setelah selesai
+
+            del st.session_state["extraction_job_id"]
+            if extraction_job.status == "done":
+                report = extraction_job.result
+            else:
+                report = {"data": {}, "error": f"Job ekstraksi gagal: {extraction_job.error}", "warnings": [], "debug": []}
+            payload["first_pass_report"] = report
+            payload["ai_extracted_data"] = {"error": report["error"]} if report["error"] else report["data"]
+            st.session_state.ai_pass_done = True
+            st.rerun()
 
-        if not apps_script_url:
-            st.error("Error Konfigurasi: URL Web App Google Apps Script tidak ditemukan.")
+        if payload.get("first_pass_report"):
+            show_first_pass_report(payload["first_pass_report"])
+        history_match = st.session_state.get("history_match")
+        if history_match:
+            st.info(f"📚 {history_match['known_fields']} field diisi dari riwayat proyek '{history_match['title']}' "
+                    f"(kemiripan {history_match['score']:.0%}); hanya field yang berubah/kosong yang dikirim ke AI.")
+
+        # [MODIFIED] Tampilkan Hasil AI & Formulir Verifikasi dengan visual indicator
+        ai_data = payload.get("ai_extracted_data")
+
+        st.info("AI telah mencoba mengekstrak informasi berikut untuk semua dokumen. Silakan periksa, perbaiki, dan lengkapi data manual di bawah ini.")
+        if isinstance(ai_data, dict) and "error" in ai_data:
+            st.error(f"Ekstraksi AI gagal: {ai_data['error']}")
+        elif not ai_data:
+            st.warning("Tidak ada data yang berhasil diekstrak oleh AI.")
         else:
-            if st.button("Kirim Data & Buat Semua Dokumen di Google Docs"):
-                with st.spinner("Mempersiapkan dan mengirim data batch ke Google Apps Script..."):
-                    try:
-                        # --- MEMBANGUN PAYLOAD BATCH ---
-                        batch_payload = {"documents": []}
-                        for pdf_path, recipe_data in recipes_to_process.items():
-                            google_doc_id = recipe_data.get("google_doc_id")
-                            placeholders_for_this_doc = recipe_data.get("placeholders", {}).keys()
-
-                            # Validasi ketat: google_doc_id harus ada, tidak None, tidak kosong, dan bertipe string
-                            if not google_doc_id or not isinstance(google_doc_id, str) or not google_doc_id.strip():
-                                st.error(f"ID Google Doc tidak valid untuk {os.path.basename(pdf_path)}. Nilai: {repr(google_doc_id)}")
-                                continue # Lanjut ke dokumen berikutnya jika ID tidak valid
-
-                            # Pastikan google_doc_id adalah string yang sudah di-strip
-                            google_doc_id = google_doc_id.strip()
-
-                            # Filter data gabungan, hanya ambil yang relevan untuk dokumen ini
-                            data_for_this_doc = {
-                                key: format_for_gdocs(final_combined_data.get(key))
-                                for key in placeholders_for_this_doc
-                                if not key.endswith("_CALCULATED") # Jangan kirim key kalkulasi
-                                and final_combined_data.get(key) is not None # Hanya kirim jika ada nilainya
-                            }
-                            # Tambahkan hasil kalkulasi (jika ada) dengan nama base key
-                            for key in placeholders_for_this_doc:
-                                 if key.endswith("_CALCULATED"):
-                                      base_key = key.replace("_CALCULATED", "")
-                                      if base_key in final_combined_data:
-                                           data_for_this_doc[base_key] = format_for_gdocs(final_combined_data[base_key])
-
-
-                            batch_payload["documents"].append({
-                                "google_doc_id": google_doc_id,
-                                "data_to_fill": data_for_this_doc
-                            })
-                        # --- AKHIR MEMBANGUN PAYLOAD ---
-
-                        if not batch_payload["documents"]:
-                             st.warning("Tidak ada dokumen valid yang bisa dikirim.")
-                        else:
-                             # Validasi akhir: Pastikan semua dokumen dalam payload memiliki google_doc_id yang valid
-                             valid_documents = []
-                             for doc in batch_payload["documents"]:
-                                 doc_id = doc.get("google_doc_id")
-                                 if doc_id and isinstance(doc_id, str) and doc_id.strip():
-                                     valid_documents.append({
-                                         "google_doc_id": doc_id.strip(),
-                                         "data_to_fill": doc.get("data_to_fill", {})
-                                     })
-                                 else:
-                                     st.error(f"Ditemukan dokumen dengan google_doc_id tidak valid: {repr(doc_id)}")
-                             
-                             if not valid_documents:
-                                 st.error("Tidak ada dokumen dengan google_doc_id yang valid untuk dikirim.")
-                             else:
-                                 # Gunakan payload yang sudah divalidasi
-                                 batch_payload["documents"] = valid_documents
-                                 
-
-                                 # Kirim payload batch
-                                 response = requests.post(
-                                    apps_script_url,
-                                    headers={'Content-Type': 'application/json'},
-                                    json=batch_payload
-                                 )
-                                 response.raise_for_status()
-                                 result = response.json()
-
-                                 # --- Tampilkan hasil batch ---
-                                 st.subheader("Hasil Pembuatan Dokumen:")
-                                 if result.get("status") == "completed":
-                                     for doc_result in result.get("results", []):
-                                         if doc_result.get("status") == "success":
-                                             st.success(f"✅ Dokumen '{doc_result.get('fileName', 'N/A')}' berhasil dibuat.")
-                                             st.markdown(f"   [🔗 Buka Dokumen]({doc_result.get('docUrl')})")
-                                         else:
-                                             st.error(f"❌ Gagal membuat dokumen dari template ID ...{doc_result.get('templateId', 'N/A')[-12:]}: {doc_result.get('message')}")
-                                 elif result.get("status") == "error":
-                                      st.error(f"Terjadi error global di Apps Script: {result.get('message')}")
-                                 else:
-                                      st.warning("Respons dari Apps Script tidak dikenali.")
-                                      st.json(result)
-                    except requests.exceptions.RequestException as req_e: # Specific exception first
-                            st.error(f"Gagal mengirim data ke Apps Script (Request Error): {req_e}")
-                            # Safely attempt to show response text if available
-                            if 'response' in locals() and hasattr(response, 'text'):
-                                st.text_area("Respons Server (jika ada):", value=response.text, height=100)
-
-                    except json.JSONDecodeError as json_e: # Specific exception for JSON parsing
-                            st.warning(f"Respons dari Apps Script bukan JSON valid: {json_e}")
-                            # Show raw text since JSON parsing failed
-                            if 'response' in locals() and hasattr(response, 'text'):
-                                st.text_area("Respons Mentah Server:", value=response.text, height=100)
-                    except Exception as e: # Generic catch-all last
-                            st.error(f"Terjadi kesalahan tak terduga saat mengirim/memproses: {e}")
-                            # Avoid accessing 'response' here as its state is unknown
-                            st.exception(e) # Display full traceback for debugging
-                    except Exception as e:
-                        st.error(f"Gagal mengirim/memproses batch: {e}")
-                        if 'response' in locals(): st.text_area("Respons Mentah:", response.text)
+            show_json_preview("Lihat Hasil Mentah Ekstraksi AI", ai_data, key="preview_ai_data")
 
-    else:
-        st.error("Tidak ada hasil JSON atau resep. Terjadi kesalahan.")
+        field_regeneration_panel(template_set)
+        verification_form(template_set, ai_data)
 
-    st.write("---")
-    if st.button("Buat Permintaan Baru"):
-        keys_to_reset = list(st.session_state.keys()) # Reset semua state
-        for key in keys_to_reset:
-             del st.session_state[key]
-        st.rerun()
\ No newline at end of file
+    # --- LANGKAH 3: HASIL AKHIR & PENGIRIMAN BATCH ---
+    elif st.session_state.page == "results":
+        st.header("Hasil Akhir & Pengiriman ke Google Docs")
+
+        # Ambil data gabungan yang sudah final dan daftar resep
+        final_combined_data = payload.get('final_combined_data')
+        recipes_to_process = st.session_state.get('recipes_to_process')
+
+        if final_combined_data and recipes_to_process:
+            st.success("Proses pengumpulan dan kalkulasi data selesai.")
+            show_json_preview("Lihat Data Final Gabungan (JSON)", final_combined_data, key="preview_final_data")
+
+            # Pengiriman & render lokal masing-masing fragment: klik dan polling job hanya menjalankan bagian itu
+            document_dispatch_section(final_combined_data, recipes_to_process)
+            local_render_section(final_combined_data, recipes_to_process)
+
+        else:
+            st.error("Tidak ada hasil JSON atau resep. Terjadi kesalahan.")
+
+        st.write("---")
+        if st.button("Buat Permintaan Baru"):
+            keys_to_reset = list(st.session_state.keys()) # Reset semua state
+            for key in keys_to_reset:
+                 del st.session_state[key]
+            payload.clear()
+            st.query_params.clear()
+            st.rerun()
+
+# Lama top-level script (import + singleton) untuk run ini; run pertama di proses tercatat sebagai cold start
+startup_report.record_script_setup(time.perf_counter() - _SCRIPT_STARTED)
+
+if __name__ == "__main__":
+    # `streamlit run` menjalankan file ini sebagai __main__; import dari modul lain (misal batch) tidak merender UI
+    main()
@@ -0,0 +1,26 @@
+"""
+Konfigurasi bersama untuk test: streamlit_app di-import dalam mode bare (tanpa `streamlit run`),
+tanpa Gemini dan tanpa jaringan. Semua store persisten diarahkan ke direktori sementara sebelum
+import, agar test tidak menulis ke .cache/ milik instance yang sedang berjalan.
+"""
+import atexit
+import os
+import shutil
+import sys
+import tempfile
+
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+_STORE_DIR = tempfile.mkdtemp(prefix="docgen_tests_")
+atexit.register(shutil.rmtree, _STORE_DIR, ignore_errors=True)
+
+os.environ.update({
+    "METRICS_PORT": "0",
+    "METRICS_LOG_PATH": os.path.join(_STORE_DIR, "spans.jsonl"),
+    "LLM_CACHE_PATH": os.path.join(_STORE_DIR, "llm_responses.sqlite3"),
+    "DOC_RESULT_CACHE_PATH": os.path.join(_STORE_DIR, "document_results.sqlite3"),
+    "HISTORY_PATH": os.path.join(_STORE_DIR, "project_history.sqlite3"),
+    "GSHEET_MIRROR_PATH": os.path.join(_STORE_DIR, "gsheet_mirror.sqlite3"),
+    "UPLOAD_TEXT_STORE_DIR": os.path.join(_STORE_DIR, "upload_texts"),
+})
+if APP_DIR not in sys.path:
+    sys.path.insert(0, APP_DIR)
@@ -0,0 +1,174 @@
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+import streamlit_app as app
+
+
+class FakeAppsScript:
+    """
+    Server lokal pengganti Apps Script. Setiap POST mengambil perilaku berikutnya dari antrean
+    (kode HTTP, atau None = sukses); jika antrean habis, semua dokumen dibuat.
+    """
+
+    def __init__(self, delay_s=0.0):
+        self.delay_s = delay_s
+        self.behaviours = []
+        self.requests = [] # list google_doc_id per POST
+        self._lock = threading.Lock()
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                documents = json.loads(self.rfile.read(int(self.headers["Content-Length"])))["documents"]
+                with fake._lock:
+                    fake.requests.append([document["google_doc_id"] for document in documents])
+                    behaviour = fake.behaviours.pop(0) if fake.behaviours else None
+                time.sleep(fake.delay_s)
+                if isinstance(behaviour, int):
+                    self._reply(behaviour, {"status": "error", "message": f"HTTP {behaviour}"})
+                elif isinstance(behaviour, dict):
+                    self._reply(200, behaviour)
+                else:
+                    self._reply(200, {"status": "completed", "results": [
+                        {"status": "success", "templateId": document["google_doc_id"],
+                         "fileName": document["google_doc_id"], "docUrl": f"https://docs/{document['google_doc_id']}"}
+                        for document in documents
+                    ]})
+
+            def _reply(self, status, body):
+                payload = json.dumps(body).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.server.server_port}/exec"
+        threading.Thread(target=self.server.serve_forever, kwargs={"poll_interval": 0.05}, daemon=True).start()
+
+    @property
+    def documents_sent(self):
+        return [doc_id for request in self.requests for doc_id in request]
+
+
+@pytest.fixture
+def apps_script():
+    fake = FakeAppsScript()
+    yield fake
+    fake.server.shutdown()
+
+
+def payload(*doc_ids):
+    return {"documents": [{"google_doc_id": doc_id, "data_to_fill": {"Title": doc_id}} for doc_id in doc_ids]}
+
+
+def make_dispatcher(url, **kwargs):
+    options = {"chunk_size": 2, "max_workers": 3, "timeout": 5, "max_retries": 2, "backoff_s": 0}
+    return app.AppsScriptDispatcher(url, **{**options, **kwargs})
+
+
+def test_results_keep_payload_order_across_chunks(apps_script):
+    apps_script.delay_s = 0.05
+    seen = []
+    result = make_dispatcher(apps_script.url).dispatch(payload("a", "b", "c", "d", "e"), on_result=seen.append)
+    assert [doc["templateId"] for doc in result["results"]] == ["a", "b", "c", "d", "e"]
+    assert all(doc["status"] == "success" for doc in result["results"])
+    assert sorted(len(request) for request in apps_script.requests) == [1, 2, 2]
+    assert sorted(doc["templateId"] for doc in seen) == ["a", "b", "c", "d", "e"]
+
+
+def test_transient_errors_are_retried(apps_script):
+    apps_script.behaviours = [503, 429]
+    result = make_dispatcher(apps_script.url).dispatch(payload("a"))
+    assert result["results"][0]["status"] == "success"
+    assert len(apps_script.requests) == 3
+
+
+def test_retries_are_bounded(apps_script):
+    apps_script.behaviours = [503, 503, 503, 503]
+    result = make_dispatcher(apps_script.url, max_retries=1).dispatch(payload("a", "b"))
+    assert len(apps_script.requests) == 2
+    assert [doc["status"] for doc in result["results"]] == ["error", "error"]
+    assert result["results"][0]["message"] == "Gagal setelah 2 percobaan: HTTP 503"
+
+
+def test_client_errors_are_not_retried(apps_script):
+    apps_script.behaviours = [400]
+    result = make_dispatcher(apps_script.url).dispatch(payload("a"))
+    assert len(apps_script.requests) == 1
+    assert result["results"][0]["message"].startswith("Gagal mengirim ke Apps Script:")
+
+
+def test_apps_script_error_status_is_reported_per_document(apps_script):
+    apps_script.behaviours = [{"status": "error", "message": "template tidak ditemukan"}]
+    result = make_dispatcher(apps_script.url).dispatch(payload("a", "b"))
+    assert [doc["message"] for doc in result["results"]] == ["Error di Apps Script: template tidak ditemukan"] * 2
+
+
+def test_unreachable_server_reports_every_document():
+    result = make_dispatcher("http://127.0.0.1:1/exec", max_retries=0).dispatch(payload("a", "b", "c"))
+    assert [doc["status"] for doc in result["results"]] == ["error"] * 3
+
+
+def test_retry_after_header_is_respected():
+    dispatcher = make_dispatcher("http://unused", backoff_s=1)
+    response = type("Response", (), {"headers": {"Retry-After": "7"}})()
+    assert dispatcher._backoff_delay(0, response) == 7.0
+    assert 2.0 <= dispatcher._backoff_delay(2) <= 4.0
+
+
+@pytest.fixture
+def result_cache(tmp_path):
+    return app.DocumentResultCache(str(tmp_path / "document_results.sqlite3"), max_age_seconds=3600)
+
+
+def test_unchanged_documents_reuse_the_created_document(apps_script, result_cache):
+    dispatcher = make_dispatcher(apps_script.url, result_cache=result_cache)
+    first = dispatcher.dispatch(payload("a", "b"))
+    second = dispatcher.dispatch(payload("a", "b", "c"))
+    assert apps_script.documents_sent == ["a", "b", "c"]
+    assert [doc.get("cached", False) for doc in second["results"]] == [True, True, False]
+    assert second["results"][0]["docUrl"] == first["results"][0]["docUrl"]
+
+
+def test_changed_data_or_use_cache_false_recreates(apps_script, result_cache):
+    dispatcher = make_dispatcher(apps_script.url, result_cache=result_cache)
+    dispatcher.dispatch(payload("a"))
+    changed = {"documents": [{"google_doc_id": "a", "data_to_fill": {"Title": "berubah"}}]}
+    dispatcher.dispatch(changed)
+    dispatcher.dispatch(payload("a"), use_cache=False)
+    assert apps_script.documents_sent == ["a", "a", "a"]
+
+
+def test_failed_documents_are_not_cached(apps_script, result_cache):
+    apps_script.behaviours = [400]
+    dispatcher = make_dispatcher(apps_script.url, result_cache=result_cache)
+    assert dispatcher.dispatch(payload("a"))["results"][0]["status"] == "error"
+    assert dispatcher.dispatch(payload("a"))["results"][0]["status"] == "success"
+    assert apps_script.documents_sent == ["a", "a"]
+    assert result_cache.stats()["inflight"] == 0
+
+
+def test_concurrent_duplicate_dispatches_share_one_request(apps_script, result_cache):
+    apps_script.delay_s = 0.3
+    dispatcher = make_dispatcher(apps_script.url, result_cache=result_cache)
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(dispatcher.dispatch(payload("a"))["results"][0]))
+               for _ in range(3)]
+    for thread in threads:
+        thread.start()
+        time.sleep(0.02) # Pengiriman pertama sudah mengklaim dokumen sebelum yang lain mulai
+    for thread in threads:
+        thread.join()
+    assert apps_script.documents_sent == ["a"]
+    assert sorted(result.get("deduplicated", False) for result in results) == [False, True, True]
+    assert len({result["docUrl"] for result in results}) == 1
+    assert result_cache.stats()["inflight"] == 0
@@ -0,0 +1,55 @@
+import pytest
+
+import streamlit_app as app
+
+
+@pytest.mark.parametrize("num_str, has_suffix, expected", [
+    ("26.401.000.000", False, (26_401_000_000.0, False)),
+    ("500.000", False, (500_000.0, False)),
+    ("17,5", False, (17.5, False)),
+    ("17.5", True, (17.5, False)),
+    ("1.000,50", False, (1000.5, False)),
+    ("1,000.50", False, (1000.5, False)),
+    ("1,500", False, (1500.0, True)), # Koma + tiga digit bisa ribuan atau desimal
+])
+def test_parse_indonesian_number(num_str, has_suffix, expected):
+    assert app.parse_indonesian_number(num_str, has_suffix=has_suffix) == expected
+
+
+@pytest.mark.parametrize("description, amount", [
+    ("Usulan anggaran 17,5jt. Tanggal 10 Oktober 2025.", 17_500_000),
+    ("Usulan anggaran 1.500.000.000. Pos Anggaran VI. 3. Contract execution 3 bulan.", 1_500_000_000),
+    ("total biaya sekitar 500 juta rupiah", 500_000_000),
+    ("anggaran 2 M", 2_000_000_000),
+    ("IDR 1.000.000,-", 1_000_000),
+    ("perpanjangan adobe 17.5 jt", 17_500_000),
+])
+def test_confident_amounts_skip_the_llm(description, amount):
+    result = app.parse_budget_locally(description)
+    assert result["amount"] == amount
+    assert result["confidence"] >= app.BUDGET_PARSE_MIN_CONFIDENCE
+
+
+def test_strong_keyword_beats_prognosa_and_dates():
+    result = app.parse_budget_locally(
+        "pengadaan laptop. Prognosa 2025 100jt. Terpakai 0. Usulan anggaran 17,5jt. Tanggal 10 Oktober 2025."
+    )
+    assert result["amount"] == 17_500_000
+    assert result["source"] == "Usulan anggaran 17,5jt"
+
+
+def test_unit_price_times_quantity():
+    result = app.parse_budget_locally("harganya 500 ribu per lisensi, kami butuh 10")
+    assert result["amount"] == 5_000_000
+
+
+def test_ambiguous_per_user_budget_defers_to_llm():
+    result = app.parse_budget_locally("budget 10jt untuk 20 users")
+    assert result["confidence"] < app.BUDGET_PARSE_MIN_CONFIDENCE
+
+
+@pytest.mark.parametrize("description", [
+    "", "proyek ini tidak ada budgetnya", "kebutuhan 50 unit, mohon segera",
+])
+def test_no_amount(description):
+    assert app.parse_budget_locally(description) == {"amount": None, "confidence": 0.0, "source": None}
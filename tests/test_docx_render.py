@@ -0,0 +1,110 @@
+import io
+import zipfile
+
+import pytest
+
+import process_workers
+
+W_NS = "http://schemas.openxmlformats.org/wordprocessingml/2006/main"
+PATTERN = process_workers.placeholder_pattern("{{%s}}")
+
+
+def fill(paragraph_xml, replacements, pattern=PATTERN):
+    return process_workers._fill_paragraph(paragraph_xml, replacements, pattern)
+
+
+def test_placeholder_inside_one_run():
+    xml = '<w:p><w:r><w:t>Judul: {{Title}}</w:t></w:r>'
+    assert fill(xml, {"Title": "Laptop"}) == '<w:p><w:r><w:t xml:space="preserve">Judul: Laptop</w:t></w:r>'
+
+
+def test_split_placeholder_keeps_runs_outside_the_match():
+    bold_label = '<w:r><w:rPr><w:b/></w:rPr><w:t xml:space="preserve">Nama: </w:t></w:r>'
+    italic_tail = '<w:r><w:rPr><w:i/></w:rPr><w:t>akhir</w:t></w:r>'
+    xml = f'<w:p>{bold_label}<w:r><w:t>{{{{Na</w:t></w:r><w:r><w:t>ma}}}} di </w:t></w:r>{italic_tail}'
+    filled = fill(xml, {"Nama": "Budi"})
+    assert filled.startswith(f"<w:p>{bold_label}")
+    assert filled.endswith(italic_tail)
+    assert '<w:t xml:space="preserve">Budi</w:t>' in filled
+    assert '<w:t xml:space="preserve"> di </w:t>' in filled
+
+
+def test_placeholder_spanning_three_runs_blanks_the_middle_run():
+    xml = '<w:p><w:r><w:t>a{{</w:t></w:r><w:r><w:b/><w:t>Ke</w:t></w:r><w:r><w:t>y}}b</w:t></w:r>'
+    assert fill(xml, {"Key": "1"}) == (
+        '<w:p><w:r><w:t xml:space="preserve">a1</w:t></w:r><w:r><w:b/><w:t/></w:r>'
+        '<w:r><w:t xml:space="preserve">b</w:t></w:r>'
+    )
+
+
+def test_several_placeholders_and_unknown_keys():
+    xml = '<w:p><w:r><w:t>{{A}} dan {{B}} dan {{Tidak_ada}}</w:t></w:r>'
+    assert "1 dan 2 dan {{Tidak_ada}}" in fill(xml, {"A": "1", "B": "2"})
+
+
+def test_paragraph_without_known_placeholder_is_returned_unchanged():
+    xml = '<w:p><w:r><w:t>tanpa placeholder &amp; aman {{Lain}}</w:t></w:r>'
+    assert fill(xml, {"A": "1"}) is xml
+
+
+def test_values_are_escaped_and_newlines_become_breaks():
+    xml = '<w:p><w:r><w:t>{{A}}</w:t></w:r>'
+    assert fill(xml, {"A": "PT A & B <Tbk>\nbaris 2"}) == (
+        '<w:p><w:r><w:t xml:space="preserve">PT A &amp; B &lt;Tbk&gt;</w:t><w:br/>'
+        '<w:t xml:space="preserve">baris 2</w:t></w:r>'
+    )
+
+
+def test_escaped_template_text_is_matched_after_unescaping():
+    xml = '<w:p><w:r><w:t>R&amp;D {{A}}</w:t></w:r>'
+    assert fill(xml, {"A": "1"}) == '<w:p><w:r><w:t xml:space="preserve">R&amp;D 1</w:t></w:r>'
+
+
+def test_custom_placeholder_format():
+    pattern = process_workers.placeholder_pattern("[[%s]]")
+    xml = '<w:p><w:r><w:t>[[A]] {{A}}</w:t></w:r>'
+    assert fill(xml, {"A": "1"}, pattern) == '<w:p><w:r><w:t xml:space="preserve">1 {{A}}</w:t></w:r>'
+
+
+def test_nested_opening_marker_matches_the_inner_placeholder():
+    xml = '<w:p><w:r><w:t>{{ {{A}}</w:t></w:r>'
+    assert fill(xml, {"A": "1"}) == '<w:p><w:r><w:t xml:space="preserve">{{ 1</w:t></w:r>'
+
+
+@pytest.mark.parametrize("value, expected", [
+    (None, ""),
+    (17500000, "17500000"),
+    ([{"NO": "1", "ITEM": "Laptop", "CATATAN": ""}, {"NO": "2", "ITEM": None}], "1 | Laptop\n2"),
+    (["a", "b"], "a\nb"),
+])
+def test_value_to_text(value, expected):
+    assert process_workers.value_to_text(value) == expected
+
+
+def test_render_docx_template_fills_body_and_header_only(tmp_path):
+    template = tmp_path / "template.docx"
+    body = (f'<w:document xmlns:w="{W_NS}"><w:body>'
+            '<w:p><w:r><w:t>Judul: {{Title_</w:t></w:r><w:r><w:rPr><w:b/></w:rPr><w:t>uppercase}}</w:t></w:r></w:p>'
+            '<w:p><w:r><w:t>{{Pembelian}}</w:t></w:r></w:p>'
+            '<w:p><w:r><w:t>{{Tidak}}</w:t></w:r></w:p></w:body></w:document>')
+    header = f'<w:hdr xmlns:w="{W_NS}"><w:p><w:r><w:t>{{{{Nomor}}}}</w:t></w:r></w:p></w:hdr>'
+    styles = f'<w:styles xmlns:w="{W_NS}"><!-- {{{{Nomor}}}} --></w:styles>'
+    with zipfile.ZipFile(template, "w") as docx:
+        docx.writestr("word/document.xml", body)
+        docx.writestr("word/header1.xml", header)
+        docx.writestr("word/styles.xml", styles)
+
+    output = process_workers.render_docx_template(str(template), {
+        "Title_uppercase": "PENGADAAN LAPTOP",
+        "Pembelian": [{"NO": "1", "ITEM": "Laptop"}, {"NO": "2", "ITEM": "Mouse"}],
+        "Nomor": "ND/001",
+    })
+
+    with zipfile.ZipFile(io.BytesIO(output)) as docx:
+        filled_body = docx.read("word/document.xml").decode("utf-8")
+        assert ('<w:t xml:space="preserve">Judul: PENGADAAN LAPTOP</w:t></w:r><w:r><w:rPr><w:b/></w:rPr><w:t/>'
+                in filled_body)
+        assert '1 | Laptop</w:t><w:br/><w:t xml:space="preserve">2 | Mouse' in filled_body
+        assert "{{Tidak}}" in filled_body
+        assert "ND/001" in docx.read("word/header1.xml").decode("utf-8")
+        assert docx.read("word/styles.xml").decode("utf-8") == styles
@@ -0,0 +1,111 @@
+import pytest
+
+import streamlit_app as app
+
+
+def evaluate(calculated, final_data):
+    engine = app.FormulaEngine(calculated)
+    return engine.evaluate(final_data), final_data
+
+
+@pytest.mark.parametrize("value, expected", [
+    ("1.000.000", 1_000_000.0),
+    ("1,000", 1000.0),
+    ("17,5", 17.5),
+    ("Rp 1.500.000,-", 1_500_000.0),
+    ("IDR 2.000", 2000.0),
+    ("-2.000", -2000.0),
+    (3, 3.0),
+    ("abc", None),
+    (True, None),
+    (None, None),
+])
+def test_clean_currency(value, expected):
+    assert app.clean_currency(value) == expected
+
+
+def test_clean_currency_series_matches_scalar_rule():
+    pd = pytest.importorskip("pandas")
+    values = ["1,000", "1.000.000", "17,5", "Rp 1.500.000,-", "abc", None, 3, "500.000"]
+    series = app.clean_currency_series(pd.Series(values, dtype=object))
+    for value, parsed in zip(values, series):
+        expected = app.clean_currency(value)
+        assert (pd.isna(parsed) and expected is None) or parsed == expected
+
+
+def test_formulas_run_in_dependency_order():
+    # PPN dihitung dari Total, yang sendirinya hasil formula; urutan di resep sengaja terbalik
+    messages, data = evaluate(
+        {"Grand_total_CALCULATED": "Total + PPN", "PPN_CALCULATED": "Total * 0.11", "Total_CALCULATED": "Harga * Jumlah"},
+        {"Harga": "1.000.000", "Jumlah": "3"},
+    )
+    assert messages == []
+    assert data["Total"] == 3_000_000
+    assert data["PPN"] == pytest.approx(330_000)
+    assert data["Grand_total"] == pytest.approx(3_330_000)
+
+
+def test_cycle_is_reported_and_other_formulas_still_run():
+    messages, data = evaluate(
+        {"A_CALCULATED": "B + 1", "B_CALCULATED": "A + 1", "C_CALCULATED": "X * 2"},
+        {"X": "5"},
+    )
+    assert data["A"].startswith("ERROR_CALCULATION: dependensi melingkar")
+    assert data["B"].startswith("ERROR_CALCULATION: dependensi melingkar")
+    assert data["C"] == 10
+    assert sum(1 for level, _ in messages if level == "error") == 2
+
+
+@pytest.mark.parametrize("expression", [
+    "__import__('os').system('true')",
+    "X.real",
+    "[X, X]",
+    "X if X else 0",
+    "abs(X)",
+])
+def test_only_arithmetic_is_allowed(expression):
+    messages, data = evaluate({"Y_CALCULATED": expression}, {"X": "5"})
+    assert data["Y"].startswith("ERROR_CALCULATION:")
+    assert messages and messages[0][0] == "error"
+
+
+def test_syntax_error_is_reported():
+    _, data = evaluate({"Y_CALCULATED": "X *"}, {"X": "5"})
+    assert data["Y"].startswith("ERROR_CALCULATION:")
+
+
+def test_missing_and_invalid_variables():
+    _, data = evaluate({"Y_CALCULATED": "X + Z + W"}, {"X": "abc", "W": "1"})
+    assert data["Y"].startswith("ERROR_MISSING_VARS:")
+    assert "'X' (nilai 'abc' tidak valid)" in data["Y"]
+    assert "'Z' (tidak ditemukan)" in data["Y"]
+
+
+def test_upstream_error_does_not_add_a_cleaning_warning():
+    messages, data = evaluate({"Y_CALCULATED": "X * 2"}, {"X": "ERROR_CALCULATION: sebelumnya"})
+    assert data["Y"].startswith("ERROR_MISSING_VARS:")
+    assert messages == []
+
+
+def test_division_by_zero_becomes_calculation_error():
+    messages, data = evaluate({"Y_CALCULATED": "X / Z"}, {"X": "5", "Z": "0"})
+    assert data["Y"].startswith("ERROR_CALCULATION:")
+    assert messages[0][0] == "error"
+
+
+def test_row_formula_is_vectorised_over_line_items():
+    pytest.importorskip("pandas")
+    rows = [{"NO": "1", "HARGA": "1,000", "JUMLAH": "2"}, {"NO": "2", "HARGA": "Rp 500.000", "JUMLAH": 3}]
+    messages, data = evaluate({"SUBTOTAL_CALCULATED": "HARGA * JUMLAH * Kurs"}, {"Pembelian": rows, "Kurs": "1"})
+    assert messages == []
+    # "1,000" dibaca sama seperti field skalar (seribu), bukan 1.0
+    assert [row["SUBTOTAL"] for row in rows] == [2000.0, 1_500_000.0]
+    assert data["SUBTOTAL"] == 1_502_000.0
+
+
+def test_invalid_row_values_name_the_rows():
+    pytest.importorskip("pandas")
+    rows = [{"HARGA": "1.000", "JUMLAH": "2"}, {"HARGA": "gratis", "JUMLAH": "1"}]
+    _, data = evaluate({"SUBTOTAL_CALCULATED": "HARGA * JUMLAH"}, {"Pembelian": rows})
+    assert data["SUBTOTAL"].startswith("ERROR_MISSING_VARS:")
+    assert "Pembelian nomor [2]" in data["SUBTOTAL"]
@@ -0,0 +1,64 @@
+import threading
+import time
+
+import pytest
+
+import streamlit_app as app
+
+
+@pytest.fixture
+def job_manager():
+    return app.JobManager(max_workers=2, retention_s=60)
+
+
+def wait_done(job, timeout_s=5):
+    deadline = time.time() + timeout_s
+    while not job.done and time.time() < deadline:
+        time.sleep(0.01)
+    return job
+
+
+def test_result_progress_and_context(job_manager):
+    def work(job):
+        job.add_progress("setengah")
+        return 42
+    job = wait_done(job_manager.submit("uji", work, context={"page": "results"}))
+    assert (job.status, job.result, job.error) == ("done", 42, None)
+    assert job.progress() == ["setengah"]
+    assert job.context == {"page": "results"}
+
+
+def test_exception_becomes_job_error(job_manager):
+    def work(job):
+        raise ValueError("respons tidak valid")
+    job = wait_done(job_manager.submit("uji", work))
+    assert job.status == "error"
+    assert job.error == "ValueError: respons tidak valid"
+
+
+def test_refreshed_browser_restores_the_job_with_its_token(job_manager):
+    release = threading.Event()
+    job = job_manager.submit("uji", lambda job: release.wait(5), context={"initial_data": {"prompt": "rahasia"}})
+    # Setelah refresh, session_id berubah; yang tersisa hanya ?job=&token= di URL browser yang sama
+    query_params = {"job": job.id, "token": job.token}
+    assert job_manager.get_with_token(query_params["job"], query_params["token"]) is job
+    release.set()
+    wait_done(job)
+
+
+def test_job_id_without_the_right_token_restores_nothing(job_manager):
+    job = wait_done(job_manager.submit("uji", lambda job: 1, context={"initial_data": {"prompt": "rahasia"}}))
+    assert job_manager.get(job.id) is job
+    assert job_manager.get_with_token(job.id, None) is None
+    assert job_manager.get_with_token(job.id, "tebakan") is None
+    assert job_manager.get_with_token(job.id, job.token[:-1]) is None
+    assert job_manager.get_with_token("tidak-ada", job.token) is None
+    assert job_manager.submit("uji", lambda job: 2).token != job.token
+
+
+def test_finished_jobs_are_pruned_after_retention():
+    manager = app.JobManager(max_workers=1, retention_s=0)
+    job = wait_done(manager.submit("uji", lambda job: 1))
+    job.finished_at -= 1
+    manager.submit("uji", lambda job: 2)
+    assert manager.get(job.id) is None
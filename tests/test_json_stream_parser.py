@@ -0,0 +1,55 @@
+import json
+
+import pytest
+
+import streamlit_app as app
+
+RESPONSE = {
+    "Title": "Pengadaan laptop, tahap {1}",
+    "Pembelian": [{"NO": "1", "HARGA": "17.500.000"}, {"NO": "2", "HARGA": "0"}],
+    "Detail": {"catatan": "kurung tutup } di dalam string"},
+    "Kutipan": 'tanda kutip \" dan backslash \\ ',
+    "Usulan_anggaran": 17500000,
+    "Kosong": None,
+}
+
+
+def feed_in_chunks(parser, text, size):
+    completed = []
+    for start in range(0, len(text), size):
+        completed.extend(parser.feed(text[start:start + size]))
+    return completed
+
+
+@pytest.mark.parametrize("chunk_size", [1, 3, 17, 10_000])
+def test_fields_complete_in_order_for_any_chunking(chunk_size):
+    parser = app.IncrementalJSONObjectParser()
+    completed = feed_in_chunks(parser, json.dumps(RESPONSE, ensure_ascii=False), chunk_size)
+    assert completed == list(RESPONSE.items())
+    assert parser.fields == RESPONSE
+
+
+def test_field_is_reported_as_soon_as_its_comma_arrives():
+    parser = app.IncrementalJSONObjectParser()
+    assert parser.feed('{"a": "satu", "b": [1, 2') == [("a", "satu")]
+    assert parser.feed("]") == []
+    assert parser.feed(', "c"') == [("b", [1, 2])]
+    assert parser.feed(": 3}") == [("c", 3)]
+
+
+def test_text_around_the_object_is_ignored():
+    parser = app.IncrementalJSONObjectParser()
+    completed = feed_in_chunks(parser, 'Berikut hasilnya:\n```json\n{"a": 1, "b": "x"}\n```', 4)
+    assert completed == [("a", 1), ("b", "x")]
+
+
+def test_truncated_response_keeps_completed_fields_only():
+    parser = app.IncrementalJSONObjectParser()
+    parser.feed('{"a": 1, "b": {"c": [1, 2]}, "d": "terpot')
+    assert parser.fields == {"a": 1, "b": {"c": [1, 2]}}
+
+
+def test_malformed_pair_is_skipped():
+    parser = app.IncrementalJSONObjectParser()
+    assert parser.feed('{"a": tru, "b": 2}') == [("b", 2)]
+    assert parser.fields == {"b": 2}
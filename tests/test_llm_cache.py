@@ -0,0 +1,118 @@
+import types
+
+import pytest
+
+import streamlit_app as app
+
+
+class FakeModel:
+    model_name = "gemini-uji"
+
+    def __init__(self, *responses):
+        self.responses = list(responses)
+        self.prompts = []
+
+    def generate_content(self, prompt, generation_config=None):
+        self.prompts.append(prompt)
+        text = self.responses.pop(0) if self.responses else "respons"
+        return types.SimpleNamespace(parts=[types.SimpleNamespace(text=text)])
+
+
+@pytest.fixture
+def cache(tmp_path):
+    return app.LLMResponseCache(str(tmp_path / "llm_responses.sqlite3"), max_entries=100, max_age_seconds=3600)
+
+
+@pytest.fixture
+def fake_model(monkeypatch, cache):
+    fake = FakeModel()
+    monkeypatch.setattr(app, "model", fake, raising=False) # Tanpa API key, model tidak dibuat saat import
+    monkeypatch.setattr(app, "llm_cache", cache)
+    return fake
+
+
+def test_key_covers_model_prompt_and_config():
+    key = app.LLMResponseCache.make_key("m", "p", {"temperature": 0})
+    assert key == app.LLMResponseCache.make_key("m", "p", {"temperature": 0})
+    assert key != app.LLMResponseCache.make_key("m2", "p", {"temperature": 0})
+    assert key != app.LLMResponseCache.make_key("m", "p2", {"temperature": 0})
+    assert key != app.LLMResponseCache.make_key("m", "p", {"temperature": 1})
+
+
+def test_entries_survive_a_new_instance(cache):
+    cache.set("k", "m", "isi")
+    reopened = app.LLMResponseCache(cache.path, max_entries=100, max_age_seconds=3600)
+    assert reopened.get("k") == "isi"
+
+
+def test_expired_entries_are_misses(cache):
+    cache.set("k", "m", "isi")
+    cache.max_age_seconds = 0
+    assert cache.get("k") is None
+    cache.evict()
+    assert cache.stats()["entries"] == 0
+
+
+def test_least_recently_used_entry_is_evicted(cache):
+    cache.max_entries = 2
+    cache.set("a", "m", "1")
+    cache.set("b", "m", "2")
+    assert cache.get("a") == "1" # "b" sekarang yang paling lama tidak diakses
+    cache.set("c", "m", "3")
+    assert cache.get("b") is None
+    assert (cache.get("a"), cache.get("c")) == ("1", "3")
+
+
+def test_stats_count_hits_and_misses(cache):
+    cache.set("k", "m", "isi")
+    cache.get("k")
+    cache.get("tidak-ada")
+    stats = cache.stats()
+    assert (stats["entries"], stats["hits"], stats["misses"], stats["hit_rate"]) == (1, 1, 1, 0.5)
+    cache.clear()
+    assert cache.stats()["entries"] == 0
+
+
+def test_repeated_prompt_is_served_from_cache(fake_model):
+    assert app.generate_text("prompt") == "respons"
+    assert app.generate_text("prompt") == "respons"
+    assert len(fake_model.prompts) == 1
+
+
+def test_use_cache_false_always_calls_the_model(fake_model):
+    app.generate_text("prompt")
+    app.generate_text("prompt", use_cache=False)
+    assert len(fake_model.prompts) == 2
+
+
+def test_responses_rejected_by_cache_if_are_not_stored(fake_model):
+    fake_model.responses = ["bukan json", '{"a": 1}']
+    assert app.generate_text("prompt", cache_if=app.is_valid_json_object_response) == "bukan json"
+    assert app.generate_text("prompt", cache_if=app.is_valid_json_object_response) == '{"a": 1}'
+    assert app.generate_text("prompt", cache_if=app.is_valid_json_object_response) == '{"a": 1}'
+    assert len(fake_model.prompts) == 2
+
+
+@pytest.mark.parametrize("response, expected", [
+    ("17500000", 17_500_000.0),
+    (" 17 500 000\n", 17_500_000.0),
+    ("17500000.5", 17_500_000.5),
+    ("null", None),
+])
+def test_cached_budget_responses_are_the_ones_the_consumer_parses(response, expected):
+    assert app.is_valid_budget_response(response)
+    assert app.parse_budget_response(response) == expected
+
+
+@pytest.mark.parametrize("response", ["17.500.000", ".", "Rp 17500000", "nan", "1e7", ""])
+def test_unparseable_budget_responses_are_not_cached(response):
+    assert not app.is_valid_budget_response(response)
+
+
+def test_dotted_thousands_budget_is_an_error_and_not_cached(fake_model):
+    fake_model.responses = ["17.500.000", "17500000"]
+    with pytest.raises(ValueError, match="17.500.000"):
+        app.analyze_budget_with_llm("perpanjangan adobe 17,5 jt")
+    assert app.analyze_budget_with_llm("perpanjangan adobe 17,5 jt") == 17_500_000.0
+    assert app.analyze_budget_with_llm("perpanjangan adobe 17,5 jt") == 17_500_000.0
+    assert len(fake_model.prompts) == 2
@@ -0,0 +1,78 @@
+import pytest
+
+import streamlit_app as app
+
+PLACEHOLDERS = {
+    "Title": {"instruction": "judul"},
+    "Vendor": {"instruction": "vendor"},
+    "Periode": {"instruction": "periode"},
+    "Jumlah_unit": {"instruction": "jumlah", "type": "number"},
+    "Tujuan": {"instruction": "tujuan"},
+    "Total_CALCULATED": "Harga * Jumlah_unit",
+}
+LAST_YEAR = {
+    "Title": "Perpanjangan Lisensi Citrix",
+    "Vendor": "PT Mitra Solusi",
+    "Periode": "Januari 2024 - Desember 2024",
+    "Jumlah_unit": 50,
+    "Tujuan": "",
+    "Total_CALCULATED": 1000,
+}
+
+
+@pytest.fixture
+def history(tmp_path, monkeypatch):
+    history = app.ProjectHistory(str(tmp_path / "project_history.sqlite3"), max_entries=100)
+    monkeypatch.setattr(app, "project_history", history)
+    return history
+
+
+def test_similar_title_in_the_same_set_is_found(history):
+    history.record("LISENSI_LESS_300", "Perpanjangan Lisensi Citrix", "prompt lama", LAST_YEAR)
+    entry = history.find_similar("LISENSI_LESS_300", "perpanjangan lisensi citrix 2025", 0.75)
+    assert (entry["title"], entry["prompt"], entry["final_data"]) == ("Perpanjangan Lisensi Citrix", "prompt lama", LAST_YEAR)
+    assert history.find_similar("PENGADAAN_LESS_300", "perpanjangan lisensi citrix 2025", 0.75) is None
+    assert history.find_similar("LISENSI_LESS_300", "pengadaan laptop", 0.75) is None
+
+
+def test_record_replaces_the_same_title_and_ignores_blank_titles(history):
+    history.record("LISENSI_LESS_300", "Lisensi Citrix", "v1", {"Title": "Lisensi Citrix", "Vendor": "A"})
+    history.record("LISENSI_LESS_300", " Lisensi Citrix ", "v2", {"Title": "Lisensi Citrix", "Vendor": "B"})
+    history.record("LISENSI_LESS_300", "  ", "v3", {"Vendor": "C"})
+    history.record("LISENSI_LESS_300", None, "v4", {"Vendor": "D"})
+    entry = history.find_similar("LISENSI_LESS_300", "lisensi citrix", 0.75)
+    assert (entry["prompt"], entry["final_data"]["Vendor"]) == ("v2", "B")
+
+
+def test_oldest_entries_are_pruned(tmp_path):
+    history = app.ProjectHistory(str(tmp_path / "h.sqlite3"), max_entries=2)
+    for title in ("Lisensi Citrix", "Lisensi Oracle", "Lisensi Adobe"):
+        history.record("LISENSI_LESS_300", title, "", {"Title": title})
+    assert history.find_similar("LISENSI_LESS_300", "lisensi citrix", 0.9) is None
+    assert history.find_similar("LISENSI_LESS_300", "lisensi adobe", 0.9)["title"] == "Lisensi Adobe"
+
+
+def test_known_data_skips_numbers_dates_and_blank_fields(history):
+    history.record("LISENSI_LESS_300", LAST_YEAR["Title"], "prompt lama", LAST_YEAR)
+    known, entry = app.history_known_data("LISENSI_LESS_300", "perpanjangan lisensi citrix tahun ini", PLACEHOLDERS)
+    assert entry["title"] == "Perpanjangan Lisensi Citrix"
+    assert known == {"Title": "Perpanjangan Lisensi Citrix", "Vendor": "PT Mitra Solusi"}
+
+
+def test_known_data_skips_fields_the_user_rewrote(history):
+    history.record("LISENSI_LESS_300", LAST_YEAR["Title"], "prompt lama", LAST_YEAR)
+    known, _ = app.history_known_data("LISENSI_LESS_300", "perpanjangan lisensi citrix\nVendor: PT Baru", PLACEHOLDERS)
+    assert "Vendor" not in known
+
+
+def test_no_similar_project_means_no_known_data(history):
+    assert app.history_known_data("LISENSI_LESS_300", "perpanjangan lisensi citrix", PLACEHOLDERS) == ({}, None)
+
+
+def test_history_is_recorded_only_after_a_document_is_produced(history):
+    failed = {"results": [{"status": "error", "message": "HTTP 500"}]}
+    assert app.record_produced_project("LISENSI_LESS_300", "prompt", LAST_YEAR, failed) is failed
+    assert history.find_similar("LISENSI_LESS_300", "perpanjangan lisensi citrix", 0.75) is None
+    produced = {"results": [{"status": "error"}, {"status": "success", "docUrl": "https://docs/x"}]}
+    assert app.record_produced_project("LISENSI_LESS_300", "prompt", LAST_YEAR, produced) is produced
+    assert history.find_similar("LISENSI_LESS_300", "perpanjangan lisensi citrix", 0.75)["prompt"] == "prompt"
@@ -0,0 +1,64 @@
+import json
+
+import streamlit_app as app
+
+PLACEHOLDERS = {
+    "Title": {"instruction": "judul"},
+    "Tujuan": {"instruction": "tujuan"},
+    "Latar_belakang": {"instruction": "latar belakang"},
+    "Total_CALCULATED": "Harga * Jumlah",
+}
+EXAMPLES = {
+    "Title": "Pengadaan Lisensi Oracle",
+    "Tujuan": "mendukung operasional",
+    "Latar_belakang": "lisensi lama habis " * 100,
+}
+
+
+def examples_in(prompt):
+    marker = "CONTOH OUTPUT (referensi gaya, panjang, dan format):\n"
+    if marker not in prompt:
+        return {}
+    return json.loads(prompt.split(marker, 1)[1].split("\n", 1)[0])
+
+
+def test_fields_exclude_calculated_placeholders():
+    prompt = app.build_first_pass_prompt("perpanjangan lisensi", "", PLACEHOLDERS, EXAMPLES)
+    assert '{"Title":"...","Tujuan":"...","Latar_belakang":"..."}' in prompt
+    assert "Total_CALCULATED" not in prompt
+
+
+def test_long_examples_are_truncated():
+    example = examples_in(app.build_first_pass_prompt("perpanjangan lisensi", "", PLACEHOLDERS, EXAMPLES))
+    assert len(example["Latar_belakang"]) == app.PROMPT_EXAMPLE_MAX_CHARS or example["Latar_belakang"].endswith("…")
+    assert len(example["Latar_belakang"]) <= app.PROMPT_EXAMPLE_MAX_CHARS + 1
+    assert app.truncate_example(["a", "b", "c"], max_items=2) == ["a", "b"]
+
+
+def test_examples_for_fields_the_user_already_gave_are_dropped():
+    prompt_text = "perpanjangan lisensi\nTujuan: menjaga layanan tetap berjalan\nlatar belakang : kontrak habis"
+    assert app.find_provided_fields(prompt_text, PLACEHOLDERS) == {"Tujuan", "Latar_belakang"}
+    example = examples_in(app.build_first_pass_prompt(prompt_text, "", PLACEHOLDERS, EXAMPLES))
+    assert list(example) == ["Title"]
+
+
+def test_over_budget_drops_the_largest_example_first():
+    full = app.build_first_pass_prompt("perpanjangan lisensi", "", PLACEHOLDERS, EXAMPLES)
+    budget = app.estimate_tokens(full) - 10
+    example = examples_in(app.build_first_pass_prompt("perpanjangan lisensi", "", PLACEHOLDERS, EXAMPLES, token_budget=budget))
+    assert list(example) == ["Title", "Tujuan"]
+
+
+def test_context_is_cut_after_every_example_is_dropped():
+    context = "isi lampiran " * 2000
+    prompt = app.build_first_pass_prompt("perpanjangan lisensi", context, PLACEHOLDERS, EXAMPLES, token_budget=800)
+    assert examples_in(prompt) == {}
+    assert "isi lampiran" in prompt and context not in prompt
+    assert app.estimate_tokens(prompt) <= 800 + 1
+
+
+def test_prompt_within_budget_is_left_whole():
+    context = "isi lampiran singkat"
+    prompt = app.build_first_pass_prompt("perpanjangan lisensi", context, PLACEHOLDERS, EXAMPLES, token_budget=100_000)
+    assert f"context pendukung: {context}\n" in prompt
+    assert list(examples_in(prompt)) == ["Title", "Tujuan", "Latar_belakang"]
@@ -0,0 +1,113 @@
+import threading
+import time
+
+import pytest
+from google.api_core import exceptions as google_exceptions
+
+import streamlit_app as app
+
+
+def wait_for(condition, timeout_s=5):
+    deadline = time.time() + timeout_s
+    while not condition() and time.time() < deadline:
+        time.sleep(0.01)
+    assert condition()
+
+
+def test_interactive_callers_are_served_before_batch_callers():
+    limiter = app.LLMRateLimiter(rpm=6000, tpm=1_000_000, max_concurrency=1)
+    limiter.acquire(10)
+    order = []
+
+    def caller(name, priority):
+        limiter.acquire(10, priority)
+        order.append(name)
+        limiter.release(10)
+
+    threads = [threading.Thread(target=caller, args=("batch", app.LLM_PRIORITY_BATCH))]
+    threads[0].start()
+    wait_for(lambda: limiter.stats()["queue_depth"] == 1)
+    threads.append(threading.Thread(target=caller, args=("interaktif", app.LLM_PRIORITY_INTERACTIVE)))
+    threads[1].start()
+    wait_for(lambda: limiter.stats()["queue_depth"] == 2)
+    limiter.release(10)
+    for thread in threads:
+        thread.join(5)
+    assert order == ["interaktif", "batch"]
+
+
+def test_concurrency_is_capped():
+    limiter = app.LLMRateLimiter(rpm=6000, tpm=1_000_000, max_concurrency=2)
+    limiter.acquire(10)
+    limiter.acquire(10)
+    acquired = threading.Event()
+    thread = threading.Thread(target=lambda: (limiter.acquire(10), acquired.set()))
+    thread.start()
+    assert not acquired.wait(0.2)
+    limiter.release(10)
+    assert acquired.wait(5)
+    thread.join(5)
+    assert limiter.stats()["active"] == 2
+
+
+def test_backoff_holds_every_caller():
+    limiter = app.LLMRateLimiter(rpm=6000, tpm=1_000_000, max_concurrency=4)
+    limiter.backoff(0.3)
+    assert limiter.acquire(10) >= 0.25
+
+
+def test_request_budget_refills_over_time():
+    limiter = app.LLMRateLimiter(rpm=120, tpm=1_000_000, max_concurrency=4) # 2 permintaan/detik
+    for _ in range(120):
+        limiter.acquire(1)
+        limiter.release(1)
+    assert 0.25 <= limiter.acquire(1) <= 1.0
+
+
+@pytest.fixture
+def limiter(monkeypatch):
+    limiter = app.LLMRateLimiter(rpm=6000, tpm=1_000_000, max_concurrency=2)
+    monkeypatch.setattr(app, "llm_rate_limiter", limiter)
+    monkeypatch.setattr(app, "LLM_QUOTA_BACKOFF_S", 0.01)
+    return limiter
+
+
+def test_quota_errors_are_retried_with_backoff(limiter):
+    attempts = []
+
+    def request():
+        attempts.append(time.monotonic())
+        if len(attempts) < 3:
+            raise google_exceptions.TooManyRequests("kuota habis")
+        return "ok", {}
+
+    assert app.call_model_rate_limited(request, "prompt") == "ok"
+    assert len(attempts) == 3
+    assert attempts[2] - attempts[1] >= 0.015 # Backoff berlipat: 0.01 lalu 0.02 detik
+    assert limiter.stats()["active"] == 0
+
+
+def test_quota_retries_are_bounded(limiter, monkeypatch):
+    monkeypatch.setattr(app, "LLM_QUOTA_MAX_RETRIES", 1)
+    calls = []
+
+    def request():
+        calls.append(1)
+        raise google_exceptions.TooManyRequests("kuota habis")
+
+    with pytest.raises(google_exceptions.TooManyRequests):
+        app.call_model_rate_limited(request, "prompt")
+    assert len(calls) == 2
+    assert limiter.stats()["active"] == 0
+
+
+def test_other_errors_are_not_retried(limiter):
+    calls = []
+
+    def request():
+        calls.append(1)
+        raise RuntimeError("gagal")
+
+    with pytest.raises(RuntimeError):
+        app.call_model_rate_limited(request, "prompt")
+    assert len(calls) == 1
@@ -0,0 +1,84 @@
+import json
+import os
+
+import pytest
+
+import streamlit_app as app
+
+
+def write_recipe(path, placeholders, examples=None, mtime=None):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text(json.dumps({"google_doc_id": path.stem, "placeholders": placeholders, "examples": examples or {}}))
+    if mtime is not None:
+        os.utime(path, (mtime, mtime))
+
+
+@pytest.fixture
+def templates_dir(tmp_path, monkeypatch):
+    write_recipe(tmp_path / "Nota" / "Nota Dinas.json",
+                 {"Title": {"instruction": "judul"}, "Tujuan": {"instruction": "tujuan"}},
+                 {"Title": "Pengadaan A"}, mtime=1_000)
+    write_recipe(tmp_path / "RAB" / "RAB.JSON",
+                 {"Title": {"instruction": "judul lain"}, "Harga": {"instruction": "harga"}},
+                 {"Title": "Pengadaan B", "Harga": 10}, mtime=1_000)
+    monkeypatch.setattr(app, "TEMPLATE_SETS", {"UJI": [
+        os.path.join(str(tmp_path), "Nota", "Nota Dinas.pdf"),
+        os.path.join(str(tmp_path), "RAB", "RAB.pdf"),
+    ]})
+    return tmp_path
+
+
+def test_template_set_merges_recipes_in_order(templates_dir):
+    compiled = app.RecipeRegistry(str(templates_dir)).get_template_set("UJI")
+    assert compiled["errors"] == []
+    assert len(compiled["recipes"]) == 2
+    assert list(compiled["placeholders"]) == ["Title", "Tujuan", "Harga"]
+    assert compiled["placeholders"]["Title"] == {"instruction": "judul"} # Resep pertama menang
+    assert compiled["examples"] == {"Title": "Pengadaan A", "Harga": 10}
+
+
+def test_unchanged_set_is_not_recompiled(templates_dir):
+    registry = app.RecipeRegistry(str(templates_dir))
+    assert registry.get_template_set("UJI") is registry.get_template_set("UJI")
+
+
+def test_changed_recipe_is_reloaded_by_mtime(templates_dir):
+    registry = app.RecipeRegistry(str(templates_dir))
+    first = registry.get_template_set("UJI")
+    write_recipe(templates_dir / "RAB" / "RAB.JSON", {"Harga": {"instruction": "harga"}, "Pajak": {"instruction": "ppn"}},
+                 mtime=2_000)
+    second = registry.get_template_set("UJI")
+    assert second is not first
+    assert "Pajak" in second["placeholders"]
+    recipe, error = registry.get_recipe(app.TEMPLATE_SETS["UJI"][1])
+    assert error is None and "Pajak" in recipe["placeholders"]
+
+
+def test_missing_and_broken_recipes_are_reported(templates_dir):
+    (templates_dir / "RAB" / "RAB.JSON").write_text("{rusak")
+    registry = app.RecipeRegistry(str(templates_dir))
+    compiled = registry.get_template_set("UJI")
+    assert list(compiled["recipes"]) == [app.TEMPLATE_SETS["UJI"][0]]
+    assert len(compiled["errors"]) == 1 and "RAB.JSON" in compiled["errors"][0]
+    recipe, error = registry.get_recipe(os.path.join(str(templates_dir), "Tidak Ada.pdf"))
+    assert recipe is None and error.startswith("File resep tidak ditemukan")
+
+
+def test_recipe_added_after_the_first_scan_is_found(templates_dir):
+    registry = app.RecipeRegistry(str(templates_dir))
+    write_recipe(templates_dir / "Baru" / "Baru.json", {"Title": {"instruction": "judul"}})
+    recipe, error = registry.get_recipe(os.path.join(str(templates_dir), "Baru", "Baru.pdf"))
+    assert error is None and list(recipe["placeholders"]) == ["Title"]
+
+
+
+@pytest.mark.parametrize("budget, prompt, expected", [
+    (500_000_000, "Perpanjangan LISENSI Oracle", "LISENSI_MORE_300"),
+    (500_000_000, "pengadaan server", "PENGADAAN_MORE_300"),
+    (500_000_000, "server baru", "PENGADAAN_MORE_300"),
+    (17_500_000, "lisensi adobe", "LISENSI_LESS_300"),
+    (17_500_000, "pengadaan laptop", "PENGADAAN_LESS_300"),
+    (17_500_000, "laptop", "PENGADAAN_LESS_300"),
+])
+def test_select_template_set(budget, prompt, expected):
+    assert app.select_template_set(budget, prompt) == expected
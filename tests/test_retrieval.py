@@ -0,0 +1,45 @@
+import streamlit_app as app
+
+
+def test_bm25_ranks_by_relevance_and_drops_non_matches():
+    index = app.BM25Index([
+        "lisensi oracle database renewal",
+        "laptop kantor dan mouse",
+        "server virtualisasi oracle",
+        "jadwal rapat",
+    ])
+    assert index.search("oracle database", 3) == [0, 2]
+    assert index.search("oracle", 1) == [2] # Dokumen lebih pendek menang untuk satu istilah yang sama
+    assert index.search("tidak relevan sama sekali", 3) == []
+    assert app.BM25Index([]).search("oracle", 3) == []
+
+
+def test_stopwords_do_not_match():
+    index = app.BM25Index(["pengadaan dan untuk yang", "pengadaan server"])
+    assert index.search("dan untuk yang", 2) == []
+
+
+def test_split_into_chunks_overlaps_and_cuts_at_whitespace():
+    text = " ".join(f"kata{i}" for i in range(200))
+    chunks = app.split_into_chunks(text, chunk_chars=100, overlap_chars=20)
+    assert all(len(chunk) <= 100 for chunk in chunks)
+    assert chunks[0].startswith("kata0 ") and chunks[-1].endswith("kata199")
+    # Setiap potongan dimulai sebelum potongan sebelumnya berakhir (tumpang tindih)
+    assert all(chunk.split()[0] in previous for previous, chunk in zip(chunks, chunks[1:]))
+
+
+def test_small_uploads_are_sent_whole():
+    index = app.UploadRetrievalIndex({"a.pdf": "isi pendek"}, token_budget=1000)
+    assert index.context_for({"Title": {"instruction": "judul"}}) == "\n\n--- KONTEKS DARI DOKUMEN 'a.pdf' ---\nisi pendek"
+
+
+def test_large_uploads_send_only_relevant_chunks_within_budget():
+    filler = "\n".join(f"baris pengisi nomor {i} tanpa informasi penting" for i in range(400))
+    relevant = "Nomor kontrak lama adalah KTR/2024/099 untuk layanan lisensi."
+    texts = {"lampiran.pdf": filler[:8000] + "\n" + relevant + "\n" + filler[8000:]}
+    index = app.UploadRetrievalIndex(texts, token_budget=500)
+    context = index.context_for({"Nomor_kontrak": {"instruction": "nomor kontrak lama", "description": ""},
+                                 "Total_CALCULATED": "A * B"}, token_budget=500, top_k=2)
+    assert "KTR/2024/099" in context
+    assert "(potongan relevan)" in context
+    assert app.estimate_tokens(context) < app.estimate_tokens(texts["lampiran.pdf"]) // 4
@@ -0,0 +1,131 @@
+import time
+
+import pytest
+
+import streamlit_app as app
+
+
+@pytest.fixture
+def registry():
+    return app.SessionActivityRegistry(idle_timeout_s=0.2)
+
+
+def handle_of(state):
+    return state[app.SESSION_PAYLOAD_HANDLE_KEY]
+
+
+def test_payload_lives_in_the_registry_and_state_keeps_only_a_handle(registry):
+    state = {"bypass_llm_cache": True}
+    payload, evicted = registry.touch(state)
+    payload["final_combined_data"] = {"Title": "x"}
+    assert evicted is False
+    assert set(state) == {"bypass_llm_cache", app.SESSION_PAYLOAD_HANDLE_KEY}
+    assert registry.payload(handle_of(state)) is payload
+    assert registry.touch(state) == (payload, False)
+
+
+def test_each_session_state_gets_its_own_payload(registry):
+    first, second = {}, {}
+    registry.touch(first)[0]["initial_data"] = {"prompt": "pertama"}
+    assert registry.touch(second)[0] == {}
+    assert handle_of(first) != handle_of(second)
+
+
+def test_idle_sessions_are_freed_when_another_session_runs(registry):
+    closed_tab = {}
+    registry.touch(closed_tab)[0]["ai_extracted_data"] = {"a": "b" * 1000}
+    time.sleep(0.3)
+    registry.touch({})
+    assert registry.payload(handle_of(closed_tab)) is None
+    assert registry.stats() == {"sessions": 1, "evicted": 1}
+
+
+def test_returning_idle_session_is_reset_on_its_own_run(registry):
+    state = {"page": "results", "budget": 1, "use_gsheet_toggle": True}
+    registry.touch(state)[0]["initial_data"] = {"prompt": "lama"}
+    time.sleep(0.3)
+    payload, evicted = registry.touch(state)
+    assert evicted is True and payload == {}
+    assert set(state) == {"use_gsheet_toggle", app.SESSION_PAYLOAD_HANDLE_KEY}
+    assert registry.touch(state)[1] is False
+
+
+def test_fragment_access_keeps_the_session_active(registry):
+    state = {}
+    registry.touch(state)
+    for _ in range(3):
+        time.sleep(0.1)
+        assert registry.payload(handle_of(state)) is not None
+        registry.touch({})
+    assert registry.payload(handle_of(state)) is not None
+
+
+def test_payload_cap_trims_in_order():
+    payload = {
+        "first_pass_report": {"debug": ["x" * 1000]},
+        "ai_matches": ["judul " * 200],
+        "ai_extracted_data": {"a": "b" * 1000},
+        "final_combined_data": {"a": 1},
+    }
+    total, trimmed = app.enforce_session_payload_cap(payload, 1500, page="results")
+    assert trimmed == ["first_pass_report", "ai_matches"]
+    assert payload["first_pass_report"]["debug"] == [] and payload["ai_matches"] is None
+    assert payload["ai_extracted_data"] == {"a": "b" * 1000}
+    assert total <= 1500
+
+    total, trimmed = app.enforce_session_payload_cap(payload, 100, page="results")
+    assert trimmed == ["ai_extracted_data"]
+    assert total <= 100
+
+
+def test_payload_still_over_the_cap_is_refused():
+    payload = {"initial_data": {"prompt": "x" * 5000}, "final_combined_data": {"a": 1}, "ai_matches": ["judul"]}
+    total, trimmed = app.enforce_session_payload_cap(payload, 1000, page="results")
+    assert total == 0 <= 1000
+    assert set(trimmed) == {"initial_data", "final_combined_data", "ai_matches"}
+    assert not any(payload.values())
+
+
+def test_payload_under_the_cap_is_left_alone():
+    payload = {"first_pass_report": {"debug": ["x"]}, "ai_extracted_data": {"a": "b"}, "final_combined_data": {"a": 1}}
+    total, trimmed = app.enforce_session_payload_cap(payload, 10_000)
+    assert trimmed == []
+    assert total == sum(app.estimate_payload_bytes(value) for value in payload.values())
+    assert payload["first_pass_report"]["debug"] == ["x"]
+
+
+def test_sheet_matches_are_kept_on_the_disambiguation_page():
+    payload = {"ai_matches": ["judul " * 500], "initial_data": {"prompt": "p"}}
+    total, trimmed = app.enforce_session_payload_cap(payload, 5000, page="disambiguation")
+    assert trimmed == [] and payload["ai_matches"]
+    assert total <= 5000
+
+
+@pytest.fixture
+def upload_store(tmp_path):
+    return app.UploadTextStore(str(tmp_path / "uploads"), spill_chars=10, retention_s=0.2)
+
+
+def test_short_upload_text_stays_in_the_ref(upload_store):
+    ref = upload_store.put("catatan.txt", "a" * 64, "pendek")
+    assert ref["text"] == "pendek" and upload_store.get(ref) == "pendek"
+    assert upload_store.stats()["files"] == 0
+
+
+def test_referenced_upload_text_outlives_the_retention_while_kept_alive(upload_store):
+    ref = upload_store.put("kontrak.pdf", "a" * 64, "isi kontrak " * 10)
+    assert ref["text"] is None
+    for _ in range(3):
+        time.sleep(0.1)
+        assert upload_store.keep_alive([ref]) == []
+        upload_store.put("lain.pdf", "b" * 64, "dokumen lain " * 10) # Memicu pembersihan
+    assert upload_store.get(ref) == "isi kontrak " * 10
+
+
+def test_expired_upload_text_fails_loudly(upload_store):
+    ref = upload_store.put("kontrak.pdf", "a" * 64, "isi kontrak " * 10)
+    time.sleep(0.3)
+    upload_store.put("lain.pdf", "b" * 64, "dokumen lain " * 10)
+    assert upload_store.keep_alive([ref]) == ["kontrak.pdf"]
+    with pytest.raises(LookupError, match="kontrak.pdf"):
+        upload_store.get(ref)
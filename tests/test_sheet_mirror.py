@@ -0,0 +1,120 @@
+import pandas as pd
+import pytest
+
+import streamlit_app as app
+
+SHEET_URL = "https://docs.google.com/spreadsheets/d/uji"
+
+
+class FakeConnection:
+    """Pengganti GSheetsConnection: read() mengembalikan DataFrame yang sedang diset."""
+
+    def __init__(self, df):
+        self.df = df
+        self.reads = []
+
+    def read(self, spreadsheet, worksheet, ttl):
+        self.reads.append((spreadsheet, worksheet, ttl))
+        if isinstance(self.df, Exception):
+            raise self.df
+        return self.df.copy()
+
+
+def sheet(*rows):
+    return pd.DataFrame(rows, columns=["Title", "Budget", "Vendor"])
+
+
+@pytest.fixture
+def mirror(tmp_path):
+    return app.SheetMirror(str(tmp_path / "gsheet_mirror.sqlite3"), SHEET_URL, [], refresh_interval_s=600)
+
+
+def test_refresh_stores_rows_by_title(mirror):
+    mirror._refresh(FakeConnection(sheet(
+        ["Lisensi Oracle", 100, "PT A"],
+        [" Laptop TI ", 50, None],
+        [None, 1, "tanpa judul"],
+        ["Lisensi Oracle", 999, "duplikat"],
+    )))
+    assert mirror.last_error is None
+    assert mirror.titles == ("Lisensi Oracle", "Laptop TI")
+    row = mirror.get_row("Lisensi Oracle")
+    assert (row["Budget"], row["Vendor"]) == (100, "PT A")
+    assert pd.isna(mirror.get_row("Laptop TI")["Vendor"])
+    assert mirror.get_row("Tidak Ada") is None
+
+
+def test_refresh_upserts_changed_rows_and_deletes_missing_ones(mirror):
+    mirror._refresh(FakeConnection(sheet(["A", 1, "x"], ["B", 2, "y"], ["C", 3, "z"])))
+    mirror._refresh(FakeConnection(sheet(["A", 1, "x"], ["B", 20, "y"], ["D", 4, "w"])))
+    assert mirror.titles == ("A", "B", "D")
+    assert mirror.last_changes == 3 # B berubah, D baru, C dihapus
+    assert mirror.get_row("B")["Budget"] == 20
+    assert mirror.get_row("C") is None
+    mirror._refresh(FakeConnection(sheet(["A", 1, "x"], ["B", 20, "y"], ["D", 4, "w"])))
+    assert mirror.last_changes == 0
+
+
+def test_mirror_is_shared_through_the_file(mirror, tmp_path):
+    mirror._refresh(FakeConnection(sheet(["A", 1, "x"])))
+    reopened = app.SheetMirror(mirror.path, SHEET_URL, [], refresh_interval_s=600)
+    assert reopened.titles == ("A",)
+    assert reopened.last_refresh == pytest.approx(mirror.last_refresh, abs=1)
+    assert app.SheetMirror(mirror.path, "https://lain", [], refresh_interval_s=600).titles == ()
+
+
+def test_failed_refresh_keeps_the_previous_rows(mirror):
+    mirror._refresh(FakeConnection(sheet(["A", 1, "x"])))
+    mirror._refresh(FakeConnection(pd.DataFrame({"Judul": ["A"]})))
+    assert "Title" in mirror.last_error
+    mirror._refresh(FakeConnection(RuntimeError("kuota habis")))
+    assert mirror.last_error == "kuota habis"
+    assert mirror.titles == ("A",)
+
+
+def test_only_configured_columns_are_kept(tmp_path):
+    mirror = app.SheetMirror(str(tmp_path / "m.sqlite3"), SHEET_URL, ["budget", "Tidak_Ada"], refresh_interval_s=600)
+    mirror._refresh(FakeConnection(sheet(["A", 1, "x"])))
+    assert mirror.last_error is None
+    assert list(mirror.get_row("A").index) == ["Title", "Budget"]
+
+
+def test_columns_keep_their_types(mirror):
+    df = pd.DataFrame({"Title": ["A", "B"], "Budget": [17_500_000, 2], "Kurs": [1.5, None], "Vendor": ["PT A", None]})
+    mirror._refresh(FakeConnection(df))
+    row = mirror.get_row("A")
+    assert (type(row["Budget"]), type(row["Kurs"]), type(row["Vendor"])) == (int, float, str)
+    assert mirror.get_row("B")["Kurs"] is None
+
+
+def test_changed_sheet_columns_rebuild_the_table(mirror):
+    mirror._refresh(FakeConnection(sheet(["A", 1, "x"], ["B", 2, "y"])))
+    mirror._refresh(FakeConnection(pd.DataFrame({"Title": ["A"], "Anggaran": [5]})))
+    assert mirror.titles == ("A",)
+    assert mirror.get_row("A").to_dict() == {"Title": "A", "Anggaran": 5}
+
+
+def test_default_columns_are_the_recipe_fields(monkeypatch):
+    monkeypatch.setattr(app, "GSHEET_COLUMNS", [])
+    columns = app.gsheet_mirror_columns()
+    assert columns[0] == "Title" and "Usulan_anggaran" in columns
+    assert not any(column.endswith("_CALCULATED") for column in columns)
+    monkeypatch.setattr(app, "GSHEET_COLUMNS", ["*"])
+    assert app.gsheet_mirror_columns() == []
+
+
+def test_sheet_columns_match_recipe_fields_loosely(tmp_path):
+    mirror = app.SheetMirror(str(tmp_path / "m.sqlite3"), SHEET_URL, ["Title", "Usulan_anggaran"], refresh_interval_s=600)
+    mirror._refresh(FakeConnection(pd.DataFrame({"Title": ["A"], "Usulan Anggaran": ["1 M"], "Catatan": ["-"]})))
+    assert mirror.get_row("A").to_dict() == {"Title": "A", "Usulan Anggaran": "1 M"}
+
+
+def test_async_refresh_runs_once_per_interval(mirror):
+    connection = FakeConnection(sheet(["A", 1, "x"]))
+    assert mirror.maybe_refresh_async(connection) is True
+    deadline = pd.Timestamp.now() + pd.Timedelta(seconds=5)
+    while mirror.stats()["refreshing"] and pd.Timestamp.now() < deadline:
+        pass
+    assert mirror.titles == ("A",)
+    assert mirror.maybe_refresh_async(connection) is False
+    assert len(connection.reads) == 1
@@ -0,0 +1,153 @@
+import json
+
+import pytest
+
+import streamlit_app as app
+
+PLACEHOLDERS = {
+    "Title": {"instruction": "Judul pengadaan", "description": "teks"},
+    "Usulan_anggaran": {"instruction": None},
+    "Jumlah_unit": 5,
+    "Pembelian": {"instruction": "Daftar item"},
+    "Bukti_BA": {"instruction": "Daftar bukti"},
+    "PPN_CALCULATED": "Usulan_anggaran * 0.11",
+}
+EXAMPLES = {"pembelian": [{"NO": "1", "ITEM": "Laptop", "HARGA": "17.500.000"}]}
+
+
+@pytest.fixture
+def schema():
+    return app.build_response_schema(PLACEHOLDERS, EXAMPLES)
+
+
+class FakeGenerateText:
+    """Pengganti generate_text: mencatat prompt & skema, lalu mengembalikan respons berurutan."""
+
+    def __init__(self, *responses):
+        self.responses = list(responses)
+        self.calls = []
+
+    def __call__(self, prompt, generation_config=None, use_cache=True, cache_if=None, priority=None):
+        self.calls.append({"prompt": prompt, "schema": (generation_config or {}).get("response_schema")})
+        return self.responses.pop(0)
+
+
+def test_build_response_schema(schema):
+    properties = schema["properties"]
+    assert "PPN_CALCULATED" not in properties
+    assert properties["Title"] == {"type": "string", "nullable": True}
+    assert properties["Usulan_anggaran"] == {"type": "number", "nullable": True}
+    assert properties["Jumlah_unit"]["type"] == "number"
+    # Kolom tabel diambil dari contoh resep (key contoh tidak peka huruf besar/kecil)
+    assert list(properties["Pembelian"]["items"]["properties"]) == ["NO", "ITEM", "HARGA"]
+    assert list(properties["Bukti_BA"]["items"]["properties"]) == list(app.TABLE_DEFAULT_COLUMNS)
+    assert "required" not in schema
+
+
+def test_coerce_to_schema_cleans_and_flags(schema):
+    valid, invalid = app.coerce_to_schema({
+        "Title": 2025,
+        "Usulan_anggaran": "Rp 17.500.000,-",
+        "Jumlah_unit": "lima",
+        "Pembelian": json.dumps([{"NO": "1", "ITEM": "Laptop"}]),
+        "Bukti_BA": "lihat lampiran",
+        "Catatan_lain": {"bebas": True},
+        "Kosong": None,
+    }, schema)
+    assert valid == {
+        "Title": "2025",
+        "Usulan_anggaran": 17_500_000.0,
+        "Pembelian": [{"NO": "1", "ITEM": "Laptop"}],
+        "Catatan_lain": {"bebas": True}, # Di luar skema: diteruskan apa adanya
+    }
+    assert sorted(invalid) == ["Bukti_BA", "Jumlah_unit"]
+
+
+@pytest.mark.parametrize("value", [True, {"a": 1}, [1, 2]])
+def test_coerce_rejects_wrong_shapes(schema, value):
+    field = "Usulan_anggaran" if isinstance(value, bool) else "Title"
+    _, invalid = app.coerce_to_schema({field: value}, schema)
+    assert invalid == [field]
+
+
+def test_repair_requests_only_invalid_fields(schema, monkeypatch):
+    fake = FakeGenerateText('{"Jumlah_unit": "5 unit", "Bukti_BA": [{"NO": "1"}], "Title": "tidak diminta"}')
+    monkeypatch.setattr(app, "generate_text", fake)
+    repaired, still_invalid = app.repair_invalid_fields("PROMPT", ["Jumlah_unit", "Bukti_BA"], schema, use_cache=False)
+    assert repaired == {"Bukti_BA": [{"NO": "1"}]}
+    assert still_invalid == ["Jumlah_unit"]
+    assert set(fake.calls[0]["schema"]["properties"]) == {"Jumlah_unit", "Bukti_BA"}
+    assert fake.calls[0]["prompt"].startswith("PROMPT")
+
+
+def test_repair_survives_unparseable_response(schema, monkeypatch):
+    monkeypatch.setattr(app, "generate_text", FakeGenerateText("bukan json"))
+    assert app.repair_invalid_fields("P", ["Title"], schema, use_cache=False) == ({}, ["Title"])
+
+
+def test_extraction_repairs_only_the_invalid_field(schema, monkeypatch):
+    fake = FakeGenerateText(
+        '{"Title": "Laptop", "Usulan_anggaran": "tujuh belas juta", "Jumlah_unit": 5}',
+        '{"Usulan_anggaran": 17500000}',
+    )
+    monkeypatch.setattr(app, "generate_text", fake)
+    result = app.call_ai_extraction("P", use_cache=False, response_schema=schema)
+    assert result["error"] is None
+    assert result["data"] == {"Title": "Laptop", "Usulan_anggaran": 17_500_000, "Jumlah_unit": 5}
+    assert result["repaired"] == ["Usulan_anggaran"]
+    assert list(fake.calls[1]["schema"]["properties"]) == ["Usulan_anggaran"]
+
+
+def test_truncated_response_keeps_received_fields_and_requests_the_rest(schema, monkeypatch):
+    fake = FakeGenerateText(
+        '{"Title": "Laptop", "Usulan_anggaran": 17500000, "Jumlah_unit": 5, "Pembelian": [{"NO": "1", "IT',
+        '{"Pembelian": [{"NO": "1", "ITEM": "Laptop"}], "Bukti_BA": []}',
+    )
+    monkeypatch.setattr(app, "generate_text", fake)
+    result = app.call_ai_extraction("P", use_cache=False, response_schema=schema)
+    assert result["error"] is None
+    assert result["data"]["Title"] == "Laptop"
+    assert result["data"]["Pembelian"] == [{"NO": "1", "ITEM": "Laptop"}]
+    assert set(fake.calls[1]["schema"]["properties"]) == {"Pembelian", "Bukti_BA"}
+
+
+def test_response_cut_before_any_field_is_retried_once_not_repaired(schema, monkeypatch):
+    fake = FakeGenerateText('{"Tit', '{"Title": "Laptop", "Usulan_anggaran": 17500000}')
+    monkeypatch.setattr(app, "generate_text", fake)
+    result = app.call_ai_extraction("P", use_cache=False, response_schema=schema)
+    assert result["error"] is None and result["retried"] is True
+    assert result["data"] == {"Title": "Laptop", "Usulan_anggaran": 17_500_000}
+    assert result["repaired"] == []
+    assert [call["prompt"] for call in fake.calls] == ["P", "P"]
+    assert fake.calls[1]["schema"] == schema
+
+
+def test_second_empty_response_returns_the_error(schema, monkeypatch):
+    fake = FakeGenerateText("", "bukan json")
+    monkeypatch.setattr(app, "generate_text", fake)
+    result = app.call_ai_extraction("P", use_cache=False, response_schema=schema)
+    assert result["data"] is None and result["error"]
+    assert result["retried"] is True and result["repaired"] == []
+    assert len(fake.calls) == 2
+
+
+def test_parsed_response_is_not_retried(schema, monkeypatch):
+    fake = FakeGenerateText('{"Title": "Laptop"}')
+    monkeypatch.setattr(app, "generate_text", fake)
+    result = app.call_ai_extraction("P", use_cache=False, response_schema=schema)
+    assert (result["data"], result["retried"], len(fake.calls)) == ({"Title": "Laptop"}, False, 1)
+
+
+def test_streamed_fields_are_reported_including_repairs(schema, monkeypatch):
+    def fake_stream(prompt, on_text, generation_config=None, use_cache=True, cache_if=None, priority=None):
+        text = '{"Title": "Laptop", "Jumlah_unit": "banyak"}'
+        for start in range(0, len(text), 5):
+            on_text(text[start:start + 5])
+        return text
+    monkeypatch.setattr(app, "generate_text_stream", fake_stream)
+    monkeypatch.setattr(app, "generate_text", FakeGenerateText('{"Jumlah_unit": 5}'))
+    seen = []
+    result = app.call_ai_extraction("P", use_cache=False, on_field=lambda key, value: seen.append((key, value)),
+                                    response_schema=schema)
+    assert result["data"] == {"Title": "Laptop", "Jumlah_unit": 5}
+    assert seen == [("Title", "Laptop"), ("Jumlah_unit", "banyak"), ("Jumlah_unit", 5)]
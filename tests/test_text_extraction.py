@@ -0,0 +1,51 @@
+import io
+import uuid
+
+import pytest
+
+import streamlit_app as app
+
+pypdf = pytest.importorskip("pypdf")
+
+
+def blank_pdf(pages):
+    writer = pypdf.PdfWriter()
+    for _ in range(pages):
+        writer.add_blank_page(width=200, height=200)
+    buffer = io.BytesIO()
+    writer.write(buffer)
+    return buffer.getvalue()
+
+
+@pytest.fixture
+def counted_extraction(monkeypatch):
+    calls = []
+    original = app.extract_pdf_text
+
+    def extract_pdf_text(file_stream, file_buffer=None):
+        calls.append(file_stream)
+        return original(file_stream, file_buffer)
+    monkeypatch.setattr(app, "extract_pdf_text", extract_pdf_text)
+    return calls
+
+
+def extract(pdf_bytes, digest):
+    return app.extract_text(digest, "application/pdf", io.BytesIO(pdf_bytes), memoryview(pdf_bytes))
+
+
+def test_timed_out_extraction_is_not_cached(monkeypatch, counted_extraction):
+    monkeypatch.setattr(app, "PDF_EXTRACTION_TIMEOUT_S", -1)
+    pdf_bytes, digest = blank_pdf(2), uuid.uuid4().hex
+    text, notes = extract(pdf_bytes, digest)
+    assert text == "" and "Ekstraksi dihentikan" in notes[-1]
+    extract(pdf_bytes, digest)
+    assert len(counted_extraction) == 2
+
+
+def test_page_limited_extraction_is_cached(monkeypatch, counted_extraction):
+    monkeypatch.setattr(app, "PDF_MAX_PAGES", 1)
+    pdf_bytes, digest = blank_pdf(3), uuid.uuid4().hex
+    _, notes = extract(pdf_bytes, digest)
+    assert notes == ["Hanya 1 dari 3 halaman yang dibaca (batas PDF_MAX_PAGES)."]
+    assert extract(pdf_bytes, digest)[1] == notes
+    assert len(counted_extraction) == 1
@@ -0,0 +1,41 @@
+import streamlit_app as app
+
+TITLES = [
+    "Pengadaan Lisensi Oracle ASFU 2024",
+    "Pengadaan Laptop Personil TI",
+    "Renewal Lisensi Citrix",
+    "Pemeliharaan CCTV",
+]
+
+
+def test_best_title_ranks_first():
+    index = app.TitleIndex(TITLES)
+    results = index.search("perpanjangan lisensi citrix tahun ini", 3)
+    assert results[0][0] == "Renewal Lisensi Citrix"
+    assert all(first[1] >= second[1] for first, second in zip(results, results[1:]))
+
+
+def test_rare_tokens_weigh_more_than_common_ones():
+    index = app.TitleIndex(TITLES)
+    # "pengadaan" muncul di dua judul, "oracle" hanya di satu
+    scores = dict(index.search("pengadaan oracle", 4))
+    assert scores["Pengadaan Lisensi Oracle ASFU 2024"] > scores["Pengadaan Laptop Personil TI"]
+
+
+def test_typo_is_matched_by_trigram_similarity():
+    index = app.TitleIndex(TITLES)
+    with_typo = dict(index.search("pemeliharan cctv", 4))
+    without_token = dict(index.search("cctv", 4))
+    assert without_token["Pemeliharaan CCTV"] < with_typo["Pemeliharaan CCTV"] < 1.0
+
+
+def test_full_match_scores_one_and_no_match_returns_nothing():
+    index = app.TitleIndex(TITLES)
+    assert index.search("pemeliharaan cctv gedung", 1) == [("Pemeliharaan CCTV", 1.0)]
+    assert index.search("zzz qqq", 3) == []
+    assert app.TitleIndex([]).search("pengadaan", 3) == []
+
+
+def test_top_n_limits_results():
+    index = app.TitleIndex(TITLES)
+    assert len(index.search("pengadaan lisensi", 1)) == 1